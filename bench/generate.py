@@ -0,0 +1,171 @@
+"""
+Synthetic rules generator for the benchmark suite.
+
+    python3 -m bench.generate --lines N [--seed S] [--rules-dir DIR]
+
+Writes DIRECT/PROXY/REJECT/PROXY_US/PROXY_HK/FINAL.list into DIR (default
+.bench/rules; pass --rules-dir rules to replace the real rule files) with a
+mix close to real-world lists: mostly DOMAIN-SUFFIX, then DOMAIN, IP-CIDR,
+KEYWORD, IPv6, a few logical, GEOIP, USER-AGENT and URL-REGEX rules, comments
+and blank lines, and some duplicates. The same (lines, seed) always produces
+the same files.
+"""
+from __future__ import annotations
+
+import argparse
+import ipaddress
+import json
+import random
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+
+DEFAULT_DIR = Path(__file__).resolve().parent.parent / ".bench" / "rules"
+STAMP = "GENERATED.json"
+# bump when the generated mix changes, so cached rule directories are rewritten
+VERSION = 1
+
+# (policy file, share of the rule lines)
+_FILES: List[Tuple[str, float]] = [
+    ("DIRECT.list", 0.35),
+    ("PROXY.list", 0.40),
+    ("REJECT.list", 0.20),
+    ("PROXY_US.list", 0.025),
+    ("PROXY_HK.list", 0.025),
+]
+
+_WORDS = (
+    "ad api app apple bank blog cdn chat cloud data dev docs edge file game "
+    "google img live mail map media music news pay photo play shop social "
+    "static stream tech track video web wiki"
+).split()
+_TLDS = ("com", "com", "com", "net", "org", "io", "cn", "hk", "jp", "co.uk", "tv")
+_SUBS = ("www", "api", "cdn", "static", "m", "img", "s1", "edge")
+_AGENTS = ("Instagram*", "Twitter*", "*Telegram*", "WhatsApp*", "Spotify*", "YouTube*", "com.google.ios.youtube*", "NetEaseMusic*")
+_REGEXES = (
+    r"^https?:\/\/(www\.)?{d}\/ads\/",
+    r"^https?:\/\/[a-z0-9-]+\.{d}\/track",
+    r"^https?:\/\/{d}\/api\/v\d+\/banner",
+)
+_COUNTRIES = ("CN", "US", "HK", "JP", "SG", "TW")
+
+
+class _Gen:
+    def __init__(self, seed: int):
+        self.rng = random.Random(seed)
+        self.recent: List[str] = []
+
+    def domain(self) -> str:
+        rng = self.rng
+        # lists repeat themselves: sometimes re-use a recent name
+        if self.recent and rng.random() < 0.03:
+            return rng.choice(self.recent)
+        name = f"{rng.choice(_WORDS)}{rng.choice(_WORDS)}{rng.randrange(10000)}.{rng.choice(_TLDS)}"
+        if rng.random() < 0.25:
+            name = f"{rng.choice(_SUBS)}.{name}"
+        if len(self.recent) < 4096:
+            self.recent.append(name)
+        else:
+            self.recent[rng.randrange(4096)] = name
+        return name
+
+    def ipv4(self) -> str:
+        rng = self.rng
+        plen = rng.choice((8, 12, 16, 16, 20, 22, 24, 24, 24, 28, 32))
+        addr = rng.getrandbits(32) >> (32 - plen) << (32 - plen)
+        return f"{addr >> 24}.{addr >> 16 & 255}.{addr >> 8 & 255}.{addr & 255}/{plen}"
+
+    def ipv6(self) -> str:
+        rng = self.rng
+        plen = rng.choice((32, 48, 56, 64))
+        addr = (0x2 << 124 | rng.getrandbits(124)) >> (128 - plen) << (128 - plen)
+        return str(ipaddress.IPv6Network((addr, plen)))
+
+    def line(self) -> str:
+        rng = self.rng
+        x = rng.random()
+        if x < 0.04:
+            return f"# {rng.choice(_WORDS)} {rng.choice(_WORDS)}"
+        if x < 0.06:
+            return ""
+        if x < 0.62:
+            return f"DOMAIN-SUFFIX,{self.domain()}"
+        if x < 0.76:
+            return f"DOMAIN,{self.domain()}"
+        if x < 0.77:
+            # keywords are rare and repetitive in real lists
+            return f"DOMAIN-KEYWORD,{rng.choice(_WORDS)}{rng.randrange(50)}"
+        if x < 0.89:
+            return f"IP-CIDR,{self.ipv4()}" + (",no-resolve" if rng.random() < 0.5 else "")
+        if x < 0.93:
+            return f"IP-CIDR6,{self.ipv6()},no-resolve"
+        if x < 0.96:
+            d1, d2 = self.domain(), self.domain()
+            return rng.choice((
+                f"AND,((DOMAIN-SUFFIX,{d1}),(DST-PORT,443))",
+                f"OR,((DOMAIN,{d1}),(DOMAIN-SUFFIX,{d2}))",
+                f"AND,((DOMAIN-SUFFIX,{d1}),(NOT,((DST-PORT,80))))",
+            ))
+        if x < 0.97:
+            return f"GEOIP,{rng.choice(_COUNTRIES)}"
+        if x < 0.98:
+            return f"USER-AGENT,{rng.choice(_AGENTS)}"
+        if x < 0.985:
+            # a small pool of distinct patterns, as in real lists
+            return "URL-REGEX," + rng.choice(_REGEXES).replace("{d}", f"{rng.choice(_WORDS)}\\.com")
+        return f"DOMAIN-SUFFIX,{self.domain()}"
+
+
+def generate(rules_dir: Path, lines: int, seed: int = 0) -> Dict[str, int]:
+    """Write the rule files; returns the number of lines per file."""
+    rules_dir.mkdir(parents=True, exist_ok=True)
+    gen = _Gen(seed)
+    rng = random.Random(seed ^ 0x5EED)
+    names = [f for f, _ in _FILES]
+    weights = [w for _, w in _FILES]
+    files = {f: open(rules_dir / f, "w", encoding="utf-8", newline="\n") for f in names}
+    counts = dict.fromkeys(names, 0)
+    try:
+        # files are chosen in batches, so each one gets runs of related lines
+        done = 0
+        while done < lines:
+            f = rng.choices(names, weights)[0]
+            n = min(lines - done, rng.randrange(1, 64))
+            files[f].write("\n".join(gen.line() for _ in range(n)) + "\n")
+            counts[f] += n
+            done += n
+    finally:
+        for fh in files.values():
+            fh.close()
+    (rules_dir / "FINAL.list").write_text("FINAL,PROXY\n", encoding="utf-8")
+    counts["FINAL.list"] = 1
+    (rules_dir / STAMP).write_text(json.dumps({"version": VERSION, "lines": lines, "seed": seed}) + "\n", encoding="utf-8")
+    return counts
+
+
+def ensure_generated(rules_dir: Path, lines: int, seed: int = 0) -> bool:
+    """Generate unless the directory already holds the files of (lines, seed); True if it wrote them."""
+    try:
+        stamp = json.loads((rules_dir / STAMP).read_text(encoding="utf-8"))
+        if stamp == {"version": VERSION, "lines": lines, "seed": seed}:
+            return False
+    except (OSError, ValueError):
+        pass
+    generate(rules_dir, lines, seed)
+    return True
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--lines", type=int, default=100_000, help="Rule-file lines in total (10k .. 5M)")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--rules-dir", type=Path, default=DEFAULT_DIR, help="Where to write the *.list files")
+    args = ap.parse_args()
+
+    counts = generate(args.rules_dir, args.lines, args.seed)
+    for fname, n in counts.items():
+        print(f"{args.rules_dir / fname}: {n} lines")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+Build benchmark suite.
+
+    python3 -m bench.suite [--lines N] [--seed S] [--repeat R] [--no-memory]
+                           [--out FILE] [--baseline FILE] [--update-baseline]
+
+Generates N synthetic rule lines (bench.generate, cached in .bench/rules), then
+times each build stage on them:
+
+    parse_lines        dsl.parser.parse_lines over the text of every rules file
+    load_rules         build.load_rules without the cache
+    run_passes         lowering, optimizer, CIDR aggregation and the regex check
+    lower_rules        compiler.ir.lower_rules, the IR every target compiles from
+    compile_<target>   build.compile_target, writing into a scratch dist/
+
+Each stage is timed best-of-R; with memory on, one more run under tracemalloc
+records its peak allocation. Results are written as JSON (--out) and compared
+with the thresholds in bench/baseline.json for the same line count: a stage
+slower than its baseline time (scaled by a calibration loop, so the file holds
+across machines) or using more memory, beyond the tolerance, is a regression,
+and the suite exits with status 1. --update-baseline stores this run instead.
+"""
+from __future__ import annotations
+
+import argparse
+import gc
+import json
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+import build
+from bench.generate import DEFAULT_DIR, ensure_generated
+from compiler.ir import lower_rules
+from dsl.parser import parse_lines
+
+
+BASELINE = Path(__file__).resolve().parent / "baseline.json"
+DEFAULT_OUT = DEFAULT_DIR.parent / "results.json"
+
+TOLERANCE = 0.50       # allowed slowdown / memory growth over the baseline
+SLACK_SECONDS = 0.05   # absolute allowance, for stages too short to time precisely
+
+
+def calibrate() -> float:
+    """Seconds for a fixed pure-Python workload (string splitting, dict and list work), best of 5."""
+    best = float("inf")
+    for _ in range(5):
+        t0 = time.perf_counter()
+        d: Dict[str, List[str]] = {}
+        for i in range(200_000):
+            d[f"k{i & 4095}"] = f"DOMAIN-SUFFIX,ex{i}.com".split(",")
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def _measure(fn: Callable[[], Any], repeat: int, memory: bool) -> Dict[str, float]:
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    out = {"seconds": round(best, 4)}
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            fn()
+            out["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+        finally:
+            tracemalloc.stop()
+    return out
+
+
+def run_suite(rules_dir: Path, repeat: int, memory: bool) -> Dict[str, Dict[str, float]]:
+    stages: Dict[str, Dict[str, float]] = {}
+    files = [rules_dir / fname for _, fname in build.POLICY_FILES if (rules_dir / fname).exists()]
+    texts = [fp.read_text(encoding="utf-8") for fp in files]
+
+    def parse_all():
+        for text in texts:
+            parse_lines(text)
+
+    stages["parse_lines"] = _measure(parse_all, repeat, memory)
+
+    build.RULES_DIR = rules_dir
+    stages["load_rules"] = _measure(lambda: build.load_rules(None), repeat, memory)
+    rules_by_policy = build.load_rules(None)
+
+    flags = ("optimize",)
+    stages["run_passes"] = _measure(lambda: build.run_passes(rules_by_policy, flags), repeat, memory)
+    compiled_rules, _ = build.run_passes(rules_by_policy, flags)
+    stages["lower_rules"] = _measure(lambda: lower_rules(compiled_rules), repeat, memory)
+    ir = lower_rules(compiled_rules)
+
+    caps = build.load_capabilities()
+    args = argparse.Namespace(clash_mrs=False, v2ray_geosite=False, singbox_rule_sets=False)
+    header = "Generated by rulelist/bench"
+    base_raw_url = "https://raw.githubusercontent.com/USER/REPO/main/rulelist"
+    with tempfile.TemporaryDirectory(prefix="rulelist-bench-") as tmp:
+        build.DIST_DIR = Path(tmp)
+        for name, _ in build.TARGETS:
+            opts = build.target_options(name, args)
+            stages[f"compile_{name}"] = _measure(
+                lambda: build.compile_target(name, ir, caps[name], header, base_raw_url, opts),
+                repeat, memory,
+            )
+    return stages
+
+
+def compare(
+    result: Dict[str, Any],
+    baseline: Dict[str, Any],
+    tolerance: float,
+) -> List[Tuple[str, str]]:
+    """(stage, reason) for every stage over its baseline threshold."""
+    base = baseline.get("sizes", {}).get(str(result["lines"]))
+    if not base:
+        return []
+    scale = result["calibration"] / baseline["calibration"] if baseline.get("calibration") else 1.0
+    out: List[Tuple[str, str]] = []
+    for stage, ref in base.items():
+        got = result["stages"].get(stage)
+        if got is None:
+            continue
+        limit = ref["seconds"] * scale * (1 + tolerance) + SLACK_SECONDS
+        if got["seconds"] > limit:
+            out.append((stage, f"{got['seconds']:.3f}s > {limit:.3f}s (baseline {ref['seconds']:.3f}s x {scale:.2f})"))
+        if "peak_mb" in got and "peak_mb" in ref:
+            mem_limit = ref["peak_mb"] * (1 + tolerance) + 1
+            if got["peak_mb"] > mem_limit:
+                out.append((stage, f"peak {got['peak_mb']:.1f} MB > {mem_limit:.1f} MB (baseline {ref['peak_mb']:.1f} MB)"))
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--lines", type=int, default=100_000, help="Synthetic rule lines (10k .. 5M)")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--repeat", "-r", type=int, default=3, help="Timed runs per stage (best is kept)")
+    ap.add_argument("--no-memory", action="store_true", help="Skip the tracemalloc run of each stage")
+    ap.add_argument("--rules-dir", type=Path, default=DEFAULT_DIR, help="Where the synthetic *.list files are generated")
+    ap.add_argument("--out", type=Path, default=DEFAULT_OUT, help="Write the results JSON here")
+    ap.add_argument("--baseline", type=Path, default=BASELINE)
+    ap.add_argument("--tolerance", type=float, default=TOLERANCE)
+    ap.add_argument("--update-baseline", action="store_true", help="Store this run as the baseline for --lines")
+    args = ap.parse_args()
+
+    if ensure_generated(args.rules_dir, args.lines, args.seed):
+        print(f"generated {args.lines} lines into {args.rules_dir}")
+
+    calibration = calibrate()
+    stages = run_suite(args.rules_dir, args.repeat, not args.no_memory)
+    result = {
+        "lines": args.lines,
+        "seed": args.seed,
+        "python": platform.python_version(),
+        "calibration": round(calibration, 4),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "stages": stages,
+    }
+    args.out.parent.mkdir(parents=True, exist_ok=True)
+    args.out.write_text(json.dumps(result, indent=2) + "\n", encoding="utf-8")
+
+    for stage, m in stages.items():
+        mem = f"  peak {m['peak_mb']:8.1f} MB" if "peak_mb" in m else ""
+        print(f"{stage:22} {m['seconds']:9.3f}s{mem}")
+    print(f"results: {args.out}")
+
+    baseline = json.loads(args.baseline.read_text(encoding="utf-8")) if args.baseline.exists() else {}
+    if args.update_baseline:
+        sizes = baseline.get("sizes", {})
+        if baseline.get("calibration"):
+            # keep one calibration for the file: rescale this run's times to it
+            scale = baseline["calibration"] / calibration
+            stages = {s: dict(m, seconds=round(m["seconds"] * scale, 4)) for s, m in stages.items()}
+        else:
+            baseline["calibration"] = result["calibration"]
+        sizes[str(args.lines)] = stages
+        baseline["sizes"] = dict(sorted(sizes.items(), key=lambda kv: int(kv[0])))
+        args.baseline.write_text(json.dumps(baseline, indent=2) + "\n", encoding="utf-8")
+        print(f"baseline for {args.lines} lines written to {args.baseline}")
+        return
+
+    if str(args.lines) not in baseline.get("sizes", {}):
+        print(f"no baseline for {args.lines} lines; run with --update-baseline to record one")
+        return
+    regressions = compare(result, baseline, args.tolerance)
+    if regressions:
+        for stage, reason in regressions:
+            print(f"REGRESSION {stage}: {reason}", file=sys.stderr)
+        sys.exit(f"{len(regressions)} benchmark regressions against {args.baseline}")
+    print(f"no regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,57 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
+import gc
 import json
 import os
+import shutil
+import subprocess
+import sys
+import time
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from dsl.parser import parse_lines
-from dsl.ast import Rule
+from dsl.parser import RuleSyntaxError, iter_file_rules
+from dsl.ast import Logical, Rule, rule_text
 
-from compiler.base import Capability
+from compiler.base import Capability, CompileResult, CompileWarning
 from compiler.surge import compile_surge
+from compiler.loon import compile_loon
+from compiler.stash import compile_stash
 from compiler.quantumultx import compile_quantumultx
 from compiler.clash import compile_clash
 from compiler.singbox import compile_singbox
-from compiler.v2rayn import compile_v2rayn
+from compiler.v2rayn import compile_v2rayn, encode_geosite
+from compiler.ir import RuleIR, lower_rules
+
+from match.engine import NO_MATCH, Matcher, parse_probe
+from match.verify import format_reports, generate_probes, verify_dist
+
+from passes.cidr import aggregate_cidrs
+from passes.logic import normalize_logicals
+from passes.lower import lower_patterns
+from passes.optimize import optimize_rules
+from passes.redos import check_patterns
+from passes.reorder import read_hit_log, reorder_rules
+
+from pipeline.cache import BuildCache, digest_parts
+from pipeline.compress import precompress
+from pipeline.importer import FORMATS, import_lists
+from pipeline.parallel import compile_targets, map_ordered, parse_files, resolve_jobs
+from pipeline.profile import StageProfiler
+from pipeline.serve import serve
+from pipeline.watch import Poller, ResidentFile
+from pipeline.writer import AtomicWriter, run_tool_atomic, write_text_atomic
 
 
 ROOT = Path(__file__).resolve().parent
 RULES_DIR = ROOT / "rules"
 DIST_DIR = ROOT / "dist"
 CAP_PATH = ROOT / "capabilities.json"
+CACHE_DIR = ROOT / ".cache"
+# geosite file of --v2ray-geosite, under dist/v2rayn/; copy it next to v2ray's geosite.dat
+GEOSITE_DAT = "rulelist.dat"
 
 
 POLICY_FILES = [
@@ -38,53 +69,636 @@ def load_capabilities() -> Dict[str, Capability]:
     return {k: Capability(k, v) for k, v in data.items()}
 
 
-def load_rules() -> List[Tuple[str, List[Rule]]]:
-    out: List[Tuple[str, List[Rule]]] = []
+def load_rules(cache: Optional[BuildCache] = None, jobs: int = 1) -> List[Tuple[str, List[Rule]]]:
+    # AST nodes never form cycles; pausing the cyclic GC while millions of them
+    # are allocated avoids repeated full-heap collections during the load.
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _load_rules(cache, jobs)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def _load_rules(cache: Optional[BuildCache], jobs: int) -> List[Tuple[str, List[Rule]]]:
+    out: List[Tuple[str, Optional[List[Rule]]]] = []
+    to_parse: List[Tuple[int, Path, Optional[str]]] = []
     for policy, fname in POLICY_FILES:
         fp = RULES_DIR / fname
         if not fp.exists():
             # allow missing files
             continue
-        parsed = parse_lines(fp.read_text(encoding="utf-8"))
-        rules: List[Rule] = []
-        for pl in parsed:
-            if pl.error:
-                raise RuntimeError(f"Parse error in {fp}: {pl.raw}\nReason: {pl.error}")
-            if pl.rule is None:
-                continue
-            rules.append(pl.rule)
+        digest = None
+        rules = None
+        if cache is not None:
+            digest = cache.file_digest(fp)
+            rules = cache.load_snapshot(fname, digest)
+        if rules is None:
+            to_parse.append((len(out), fp, digest))
         out.append((policy, rules))
+
+    if jobs > 1 and len(to_parse) > 1:
+        parsed = parse_files(parse_rules_file, [fp for _, fp, _ in to_parse], jobs)
+    else:
+        parsed = [parse_rules_file(fp) for _, fp, _ in to_parse]
+    for (i, fp, digest), rules in zip(to_parse, parsed):
+        if cache is not None:
+            cache.store_snapshot(fp.name, digest, rules)
+        out[i] = (out[i][0], rules)
     return out
 
 
+def parse_rules_file(fp: Path) -> List[Rule]:
+    try:
+        return [rule for _, rule in iter_file_rules(fp)]
+    except RuleSyntaxError as e:
+        raise RuntimeError(f"Parse error in {fp}:{e.lineno}: {e.raw}\nReason: {e.reason}") from None
+
+
 def ensure_dirs():
     DIST_DIR.mkdir(parents=True, exist_ok=True)
 
 
+# target name (also its capabilities.json key) -> files it writes into dist/
+TARGETS: List[Tuple[str, Tuple[str, ...]]] = [
+    ("surge", ("surge.conf",)),
+    ("loon", ("loon.conf",)),
+    ("stash", ("stash.yaml",)),
+    ("quantumultx", ("quantumultx.conf",)),
+    ("clash", ("clash.yaml",)),
+    ("singbox", ("sing-box.json",)),
+    ("v2rayn", ("v2rayn.json",)),
+]
+
+# sources whose content decides a target's output, used as its "compiler version"
+_TARGET_SOURCES = {
+    "surge": ("compiler/surge.py",),
+    "loon": ("compiler/loon.py", "compiler/surge.py"),
+    "stash": ("compiler/stash.py", "compiler/clash.py"),
+    "quantumultx": ("compiler/quantumultx.py", "compiler/surge.py"),
+    "clash": ("compiler/clash.py",),
+    "singbox": ("compiler/singbox.py",),
+    "v2rayn": ("compiler/v2rayn.py",),
+}
+# targets whose output embeds base_raw_url (links to their external rule files)
+_URL_TARGETS = ("surge", "loon", "stash", "quantumultx", "clash")
+_COMMON_SOURCES = (
+    "build.py", "dsl/parser.py", "dsl/ast.py", "dsl/table.py", "compiler/base.py", "compiler/ir.py",
+    "passes/logic.py", "passes/lower.py", "passes/optimize.py", "passes/cidr.py", "passes/redos.py",
+    "passes/reorder.py", "match/engine.py",
+)
+# what the count of a pass in build_warnings.txt means (others count removed rules)
+_PASS_VERBS = {"regex": "flagged", "logic": "simplified", "reorder": "moved up"}
+# distinct targets `query` remembers the result of before starting over
+_QUERY_MEMO = 1 << 20
+
+
+def target_options(name: str, args: argparse.Namespace) -> Dict[str, object]:
+    """Per-target build switches; they are part of the target's cache key."""
+    if name == "singbox" and args.singbox_rule_sets:
+        return {"rule_sets": True, "tool": shutil.which("sing-box") or ""}
+    if name == "clash" and args.clash_mrs:
+        return {"mrs": True, "tool": shutil.which("mihomo") or ""}
+    if name == "v2rayn" and args.v2ray_geosite:
+        return {"geosite": True}
+    return {}
+
+
+# targets whose main config only references per-policy list files
+_SET_COMPILERS = {
+    "surge": compile_surge,
+    "loon": compile_loon,
+    "quantumultx": compile_quantumultx,
+}
+
+
+def compile_target(
+    name: str,
+    ir: RuleIR,
+    cap: Capability,
+    header: str,
+    base_raw_url: str,
+    options: Dict[str, object],
+) -> Tuple[CompileResult, Dict[str, Dict[str, object]]]:
+    """
+    Run one target's compiler over the lowered rules, streaming each dist file
+    through an AtomicWriter; returns the result and the on-disk record of every
+    file written.
+    """
+    if name in _SET_COMPILERS:
+        # Surge DOMAIN-SET / RULE-SET, Loon [Remote Rule], QX [filter_remote] files under dist/<name>/
+        outputs = {}
+        writer = _list_writer(base_raw_url, name, outputs)
+        res, main_out = _stream(f"{name}.conf", _SET_COMPILERS[name], ir, cap, header, set_writer=writer)
+        outputs.update(main_out)
+        return res, outputs
+    if name == "stash":
+        outputs = {}
+        extra = []
+        writer = _clash_provider_writer(base_raw_url, "stash", False, "", outputs, extra)
+        res, main_out = _stream("stash.yaml", compile_stash, ir, cap, header, base_raw_url, provider_writer=writer)
+        res.warnings.extend(extra)
+        outputs.update(main_out)
+        return res, outputs
+    if name == "clash":
+        outputs: Dict[str, Dict[str, object]] = {}
+        extra: List[CompileWarning] = []
+        writer = _clash_provider_writer(base_raw_url, "clash", bool(options.get("mrs")), str(options.get("tool") or ""), outputs, extra)
+        res, main_out = _stream("clash.yaml", compile_clash, ir, cap, header, base_raw_url, provider_writer=writer)
+        res.warnings.extend(extra)
+        outputs.update(main_out)
+        return res, outputs
+    if name == "singbox":
+        if not options.get("rule_sets"):
+            return _stream("sing-box.json", compile_singbox, ir, cap, header)
+        outputs = {}
+        extra = []
+        writer = _singbox_rule_set_writer(base_raw_url, str(options.get("tool") or ""), outputs, extra)
+        res, main_out = _stream("sing-box.json", compile_singbox, ir, cap, header, rule_set_writer=writer)
+        res.warnings.extend(extra)
+        outputs.update(main_out)
+        return res, outputs
+    if name == "v2rayn":
+        # v2rayN / v2ray routing json
+        if not options.get("geosite"):
+            return _stream("v2rayn.json", compile_v2rayn, ir, cap, header)
+        sites: List[Tuple[str, List[Tuple[int, str]]]] = []
+
+        def add_site(policy: str, domains: List[Tuple[int, str]]) -> str:
+            tag = policy.upper()
+            sites.append((tag, domains))
+            return f"ext:{GEOSITE_DAT}:{tag}"
+
+        res, outputs = _stream("v2rayn.json", compile_v2rayn, ir, cap, header, geosite_writer=add_site)
+        (DIST_DIR / "v2rayn").mkdir(exist_ok=True)
+        with AtomicWriter(DIST_DIR / "v2rayn" / GEOSITE_DAT) as fh:
+            fh.write_bytes(encode_geosite(sites))
+        outputs[f"v2rayn/{GEOSITE_DAT}"] = fh.record
+        return res, outputs
+    raise KeyError(name)
+
+
+def _compile_measured(
+    name: str,
+    ir: RuleIR,
+    cap: Capability,
+    header: str,
+    base_raw_url: str,
+    options: Dict[str, object],
+    profile: bool,
+) -> Tuple[Tuple[CompileResult, Dict[str, Dict[str, object]]], tuple]:
+    """compile_target plus its compile:/write: stage costs, measured where it runs (also in a worker)."""
+    prof = StageProfiler(profile)
+    with prof.stage(f"compile:{name}", write=f"write:{name}"):
+        result = compile_target(name, ir, cap, header, base_raw_url, options)
+    return result, prof.export()
+
+
+def _stream(fname: str, compile_fn, *args, **kwargs) -> Tuple[CompileResult, Dict[str, Dict[str, object]]]:
+    with AtomicWriter(DIST_DIR / fname) as out:
+        res = compile_fn(*args, out=out, **kwargs)
+    return res, {fname: out.record}
+
+
+def _list_writer(base_raw_url: str, subdir: str, outputs: Dict[str, Dict[str, object]]):
+    """Set writer for compile_surge / compile_loon: dist/<subdir>/<fname>, one rule per line."""
+    (DIST_DIR / subdir).mkdir(exist_ok=True)
+
+    def write(fname: str, lines: List[str]) -> str:
+        rel = f"{subdir}/{fname}"
+        with AtomicWriter(DIST_DIR / rel) as fh:
+            for line in lines:
+                fh.write(line + "\n")
+        outputs[rel] = fh.record
+        return f"{base_raw_url}/dist/{rel}"
+
+    return write
+
+
+def _clash_provider_writer(
+    base_raw_url: str,
+    subdir: str,
+    mrs: bool,
+    tool: str,
+    outputs: Dict[str, Dict[str, object]],
+    warnings: List[CompileWarning],
+):
+    """
+    Provider writer for compile_clash / compile_stash: dist/<subdir>/<PROVIDER>.txt
+    (text format), plus .mrs for domain/ipcidr providers when --clash-mrs is set
+    and a mihomo binary is available to convert them.
+    """
+    (DIST_DIR / subdir).mkdir(exist_ok=True)
+    if mrs and not tool:
+        warnings.append(CompileWarning(file="clash", line="rule-providers", reason="mihomo binary not found; providers are referenced in text format"))
+
+    def write(provider: str, behavior: str, lines: List[str]) -> Dict[str, object]:
+        stem = f"{subdir}/{provider}"
+        with AtomicWriter(DIST_DIR / f"{stem}.txt") as fh:
+            for line in lines:
+                fh.write(line + "\n")
+        outputs[f"{stem}.txt"] = fh.record
+        fmt, fname = "text", f"{stem}.txt"
+        if mrs and tool and behavior in ("domain", "ipcidr"):
+            try:
+                outputs[f"{stem}.mrs"] = run_tool_atomic(
+                    [tool, "convert-ruleset", behavior, "text", str(DIST_DIR / f"{stem}.txt"), "{out}"],
+                    DIST_DIR / f"{stem}.mrs",
+                )
+                fmt, fname = "mrs", f"{stem}.mrs"
+            except (OSError, subprocess.CalledProcessError) as e:
+                detail = getattr(e, "stderr", b"") or b""
+                warnings.append(CompileWarning(file="clash", line=f"{stem}.mrs", reason=f"mihomo convert-ruleset failed: {detail.decode(errors='replace').strip() or e}"))
+        return {
+            "type": "http",
+            "behavior": behavior,
+            "format": fmt,
+            "url": f"{base_raw_url}/dist/{fname}",
+            "path": f"./ruleset_cache/{provider}.{fname.rpartition('.')[2]}",
+            "interval": 86400,
+        }
+
+    return write
+
+
+def _singbox_rule_set_writer(
+    base_raw_url: str,
+    tool: str,
+    outputs: Dict[str, Dict[str, object]],
+    warnings: List[CompileWarning],
+):
+    """
+    Rule-set writer for compile_singbox: dist/singbox/<POLICY>.json (source
+    format) plus <POLICY>.srs when a sing-box binary is available to compile it.
+    """
+    (DIST_DIR / "singbox").mkdir(exist_ok=True)
+    if not tool:
+        warnings.append(CompileWarning(file="singbox", line="rule_set", reason="sing-box binary not found; rule-sets are referenced in source format"))
+
+    def write(policy: str, doc: Dict[str, object]) -> Dict[str, object]:
+        stem = f"singbox/{policy}"
+        with AtomicWriter(DIST_DIR / f"{stem}.json") as fh:
+            json.dump(doc, fh, ensure_ascii=False, indent=2)
+            fh.write("\n")
+        outputs[f"{stem}.json"] = fh.record
+        fmt, fname = "source", f"{stem}.json"
+        if tool:
+            try:
+                outputs[f"{stem}.srs"] = run_tool_atomic(
+                    [tool, "rule-set", "compile", "--output", "{out}", str(DIST_DIR / f"{stem}.json")],
+                    DIST_DIR / f"{stem}.srs",
+                )
+                fmt, fname = "binary", f"{stem}.srs"
+            except (OSError, subprocess.CalledProcessError) as e:
+                detail = getattr(e, "stderr", b"") or b""
+                warnings.append(CompileWarning(file="singbox", line=f"{stem}.srs", reason=f"sing-box rule-set compile failed: {detail.decode(errors='replace').strip() or e}"))
+        return {"type": "remote", "tag": f"rl-{policy}", "format": fmt, "url": f"{base_raw_url}/dist/{fname}"}
+
+    return write
+
+
+def input_digests(cache: BuildCache) -> List[Tuple[str, str]]:
+    out: List[Tuple[str, str]] = []
+    for _, fname in POLICY_FILES:
+        fp = RULES_DIR / fname
+        if fp.exists():
+            out.append((fname, cache.file_digest(fp)))
+    return out
+
+
+def passes_key(cache: BuildCache, inputs: List[Tuple[str, str]], flags: Tuple[str, ...]) -> str:
+    parts = list(flags)
+    for src in _COMMON_SOURCES:
+        parts.append(cache.file_digest(ROOT / src))
+    for fname, digest in inputs:
+        parts += [fname, digest]
+    return digest_parts(parts)
+
+
+def run_passes(
+    rules_by_policy: List[Tuple[str, List[Rule]]],
+    flags: Tuple[str, ...],
+    jobs: int = 1,
+) -> Tuple[List[Tuple[str, List[Rule]]], Dict[str, Tuple[int, List[CompileWarning]]]]:
+    """
+    Rule-set passes between load_rules and the compilers. Returns the new rules
+    and, per pass, (rules removed, report lines); for the "regex" check, which
+    runs on the source rules and removes nothing, (rules flagged, findings), and
+    for "logic", which rewrites AND/OR/NOT rules in place, (rules simplified, report lines).
+    """
+    files = dict(POLICY_FILES)
+    reports: Dict[str, Tuple[int, List[CompileWarning]]] = {}
+    findings, n = check_patterns(rules_by_policy, files, jobs)
+    reports["regex"] = (n, findings)
+    if "optimize" in flags:
+        rules_by_policy, simplified, n = normalize_logicals(rules_by_policy, files)
+        reports["logic"] = (n, simplified)
+        rules_by_policy, lowered, n = lower_patterns(rules_by_policy, files)
+        reports["lower"] = (n, lowered)
+        rules_by_policy, removed = optimize_rules(rules_by_policy, files)
+        reports["optimize"] = (len(removed), removed)
+        rules_by_policy, agg, n = aggregate_cidrs(rules_by_policy, files)
+        reports["cidr"] = (n, agg)
+    return rules_by_policy, reports
+
+
+def rule_counts(rules_by_policy: List[Tuple[str, List[Rule]]]) -> Dict[str, Dict[str, int]]:
+    """{policy: {rule type (AND/OR/NOT for logical rules): count}}"""
+    out: Dict[str, Dict[str, int]] = {}
+    for policy, rules in rules_by_policy:
+        counts: Dict[str, int] = {}
+        for r in rules:
+            t = r.op if isinstance(r, Logical) else r.rtype
+            counts[t] = counts.get(t, 0) + 1
+        out[policy] = dict(sorted(counts.items()))
+    return out
+
+
+def build_report(
+    prof: StageProfiler,
+    cache: BuildCache,
+    stale: List[str],
+    pass_reports: Dict[str, Tuple[int, List[CompileWarning]]],
+    rules: Dict[str, Dict[str, Any]],
+    jobs: int,
+) -> Dict[str, object]:
+    """Machine-readable summary of one build, written to dist/build_report.json."""
+    by_type: Dict[str, int] = {}
+    for counts in rules.get("source", {}).values():
+        for t, n in counts.items():
+            by_type[t] = by_type.get(t, 0) + n
+    targets: Dict[str, object] = {}
+    for name, _ in TARGETS:
+        ent = cache.target(name)
+        outputs = {f: rec["size"] for f, rec in sorted(ent.get("outputs", {}).items())}
+        stats = ent.get("stats", {})
+        targets[name] = {
+            "rebuilt": name in stale,
+            # clash names its counters emitted_rules / skipped_rules
+            "emitted": stats.get("emitted", stats.get("emitted_rules", 0)),
+            "skipped": stats.get("skipped", stats.get("skipped_rules", 0)),
+            "stats": stats,
+            "warnings": len(ent.get("warnings", [])),
+            "outputs": outputs,
+            "bytes": sum(outputs.values()),
+        }
+    report: Dict[str, object] = {
+        "python": sys.version.split()[0],
+        "jobs": jobs,
+        "profile": prof.profile,
+        "stages": prof.stages,
+        "rules": {
+            "total": sum(by_type.values()),
+            "by_type": dict(sorted(by_type.items())),
+            "by_policy": rules.get("source", {}),
+            "after_passes": {p: sum(c.values()) for p, c in rules.get("compiled", {}).items()},
+        },
+        "passes": {name: n for name, (n, _) in pass_reports.items()},
+        "targets": targets,
+        "bytes": sum(t["bytes"] for t in targets.values()),
+    }
+    if "reorder" in rules:
+        # --hit-log: rule comparisons per logged lookup before and after reordering
+        report["reorder"] = rules["reorder"]
+    return report
+
+
+def write_report(
+    pass_reports: Dict[str, Tuple[int, List[CompileWarning]]],
+    warnings_by_target: Dict[str, List[CompileWarning]],
+) -> None:
+    report_lines: List[str] = []
+    def dump(name: str, warns):
+        if not warns:
+            report_lines.append(f"{name}: no warnings")
+            return
+        report_lines.append(f"{name}: {len(warns)} warnings")
+        for w in warns:
+            report_lines.append(f"  - [{w.file}] {w.reason}: {w.line}")
+
+    for name, (n, lines) in pass_reports.items():
+        report_lines.append(f"{name}: {n} rules {_PASS_VERBS.get(name, 'removed')}")
+        for w in lines:
+            report_lines.append(f"  - [{w.file}] {w.reason}: {w.line}")
+
+    for name, _ in TARGETS:
+        if name in warnings_by_target:
+            dump(name, warnings_by_target[name])
+
+    write_text_atomic(DIST_DIR / "build_warnings.txt", "\n".join(report_lines) + "\n")
+
+
+def target_key(
+    name: str,
+    cache: BuildCache,
+    caps_raw: Dict[str, Dict[str, bool]],
+    inputs: List[Tuple[str, str]],
+    header: str,
+    base_raw_url: str,
+    flags: Tuple[str, ...],
+    options: Dict[str, object],
+) -> str:
+    parts = [name, header, json.dumps(caps_raw.get(name, {}), sort_keys=True), json.dumps(options, sort_keys=True), *flags]
+    for src in _COMMON_SOURCES + _TARGET_SOURCES[name]:
+        parts.append(cache.file_digest(ROOT / src))
+    for fname, digest in inputs:
+        parts += [fname, digest]
+    if name in _URL_TARGETS or options.get("rule_sets"):
+        parts.append(base_raw_url)
+    return digest_parts(parts)
+
+
+def precompress_all(cache: BuildCache, inputs: List[Tuple[str, str]], jobs: int) -> None:
+    """.gz/.br variants (pipeline/compress.py) of every dist artifact and rules file that lacks them."""
+    store = str(CACHE_DIR / "compressed")
+    items = [(str(RULES_DIR / fname), digest, store) for fname, digest in inputs]
+    for name, _ in TARGETS:
+        for fname, rec in cache.target(name).get("outputs", {}).items():
+            items.append((str(DIST_DIR / fname), rec["digest"], store))
+    if jobs > 1 and len(items) > 1:
+        map_ordered(precompress, items, jobs, chunksize=1)
+    else:
+        for item in items:
+            precompress(item)
+
+
+def query_main(argv: List[str]) -> int:
+    ap = argparse.ArgumentParser(prog="build.py query", description="Look up which rule and policy a host, IP, host:port or URL hits")
+    ap.add_argument("targets", nargs="*", help="Hosts, IPs, host:port or http(s) URLs")
+    ap.add_argument("--file", "-f", help="Read one target per line from this file ('-' for stdin)")
+    ap.add_argument("--no-cache", action="store_true", help="Parse the rules files instead of using .cache/ snapshots")
+    args = ap.parse_args(argv)
+    if not args.targets and not args.file:
+        ap.error("give targets or --file")
+
+    cache = BuildCache(CACHE_DIR, enabled=not args.no_cache)
+    matcher = Matcher(load_rules(cache if cache.enabled else None), dict(POLICY_FILES))
+    cache.save()
+    if matcher.unsupported:
+        kinds = ", ".join(f"{n} {t}" for t, n in sorted(matcher.unsupported.items()))
+        print(f"note: rules that cannot be evaluated locally never match: {kinds}", file=sys.stderr)
+
+    # the tail of every output line only depends on the rule hit
+    tails = [f"\t{m.policy}\t{m.file}:{m.lineno}\t{rule_text(m.rule)}\n" for m in matcher.entries]
+    rank = matcher.rank
+    out = sys.stdout
+    batch: List[str] = []
+
+    # lookup logs repeat their hosts a lot: remember the rank of each target
+    seen: Dict[str, int] = {}
+
+    def run(lines) -> int:
+        n = 0
+        for line in lines:
+            text = line.strip()
+            if not text or text[0] == "#":
+                continue
+            r = seen.get(text)
+            if r is None:
+                if len(seen) >= _QUERY_MEMO:
+                    seen.clear()
+                r = seen[text] = rank(parse_probe(text))
+            batch.append(text + (tails[r] if r != NO_MATCH else "\tNO-MATCH\n"))
+            n += 1
+            if len(batch) >= 4096:
+                out.writelines(batch)
+                batch.clear()
+        out.writelines(batch)
+        batch.clear()
+        return n
+
+    n = run(args.targets)
+    if args.file:
+        t0 = time.perf_counter()
+        if args.file == "-":
+            n += run(sys.stdin)
+        else:
+            with open(args.file, encoding="utf-8", errors="replace") as fh:
+                n += run(fh)
+        dt = time.perf_counter() - t0
+        print(f"{n} lookups in {dt:.2f}s ({n / dt if dt else 0:,.0f}/s)", file=sys.stderr)
+    out.flush()
+    return 0
+
+
+def verify_main(argv: List[str]) -> int:
+    ap = argparse.ArgumentParser(prog="build.py verify", description="Check that every dist/ artifact routes like the source rules")
+    ap.add_argument("--probes", "-n", type=int, default=200000, help="Number of generated hosts/IPs/ports to compare on")
+    ap.add_argument("--seed", type=int, default=0, help="Probe generator seed")
+    ap.add_argument("--target", "-t", action="append", help="Only check this dist file (repeatable), e.g. clash.yaml")
+    ap.add_argument("--examples", type=int, default=20, help="Divergent rule pairs to show per target")
+    ap.add_argument("--no-cache", action="store_true", help="Parse the rules files instead of using .cache/ snapshots")
+    args = ap.parse_args(argv)
+
+    t0 = time.perf_counter()
+    cache = BuildCache(CACHE_DIR, enabled=not args.no_cache)
+    rules_by_policy = load_rules(cache if cache.enabled else None)
+    cache.save()
+    probes = generate_probes(rules_by_policy, args.probes, args.seed)
+    reports = verify_dist(DIST_DIR, rules_by_policy, dict(POLICY_FILES), probes, args.target, args.examples)
+    lines = format_reports(reports, len(probes))
+    lines.append(f"{len(reports)} artifacts x {len(probes)} probes in {time.perf_counter() - t0:.1f}s")
+    print("\n".join(lines))
+    return 1 if any(r.divergent for r in reports) else 0
+
+
+def import_main(argv: List[str]) -> int:
+    ap = argparse.ArgumentParser(prog="build.py import", description="Convert hosts, adblock, dnsmasq or plain domain lists into a rules/*.list file")
+    ap.add_argument("sources", nargs="+", help="List files ('-' for stdin, *.gz read compressed)")
+    ap.add_argument("--out", "-o", required=True, type=Path, help="Rules file to write, e.g. rules/REJECT.list (replaced atomically)")
+    ap.add_argument("--format", "-f", choices=FORMATS, help="Format of every source (default: detected per file)")
+    ap.add_argument("--plain-type", choices=("DOMAIN", "DOMAIN-SUFFIX"), default="DOMAIN-SUFFIX", help="Rule type for names of a plain domain list without a '.' / '+.' prefix")
+    ap.add_argument("--append", action="store_true", help="Keep the current lines of --out and add the imported rules after them")
+    ap.add_argument("--dedup-mb", type=int, default=256, help="Memory for the duplicate filter (about 70 bytes per rule; later duplicates pass through once it is full)")
+    args = ap.parse_args(argv)
+
+    t0 = time.perf_counter()
+
+    def log(line: str) -> None:
+        print(line, file=sys.stderr)
+
+    try:
+        stats, seen = import_lists(args.sources, args.out, args.format, args.plain_type, args.append, args.dedup_mb << 20, log)
+    except (OSError, ValueError) as e:
+        print(f"import: {e}", file=sys.stderr)
+        return 1
+    if seen.full:
+        log(f"note: duplicate filter full after {seen.size} rules; raise --dedup-mb to drop later duplicates too")
+    dt = time.perf_counter() - t0
+    log(f"{args.out}: {stats} in {dt:.2f}s ({stats.lines / dt if dt else 0:,.0f} lines/s)")
+    return 0
+
+
+def serve_main(argv: List[str]) -> int:
+    ap = argparse.ArgumentParser(prog="build.py serve", description="Serve dist/ and rules/ over HTTP, as a local stand-in for --base-raw-url")
+    ap.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    ap.add_argument("--port", "-p", type=int, default=8080)
+    ap.add_argument("--no-fill", action="store_true", help="Only send .gz/.br variants written by build.py --precompress; never compress while serving")
+    args = ap.parse_args(argv)
+    try:
+        asyncio.run(serve(args.host, args.port, {"dist": DIST_DIR, "rules": RULES_DIR}, CACHE_DIR, fill=not args.no_fill))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+# build.py <command> ...; without a known command the arguments are build options
+COMMANDS = {
+    "query": query_main,
+    "verify": verify_main,
+    "import": import_main,
+    "serve": serve_main,
+}
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        sys.exit(COMMANDS[sys.argv[1]](sys.argv[2:]))
+
     ap = argparse.ArgumentParser()
     ap.add_argument("--base-raw-url", default="", help="Base raw URL of your GitHub repo, e.g. https://raw.githubusercontent.com/<user>/<repo>/main/rulelist")
     ap.add_argument("--final-policy", default="PROXY", help="If FINAL.list missing FINAL, force this policy for fallback")
+    ap.add_argument("--no-cache", action="store_true", help="Rebuild everything; neither read nor update the .cache/ build cache")
+    ap.add_argument("--no-optimize", action="store_true", help="Keep duplicate, subsumed and shadowed rules instead of removing them")
+    ap.add_argument("--jobs", "-j", type=int, default=None, help="Parse rule files and compile targets in N worker processes (0 = one per CPU; default 1, or one per CPU with --watch)")
+    ap.add_argument("--clash-mrs", action="store_true", help="Also convert Clash domain/ipcidr providers to mihomo's binary .mrs format (needs a mihomo binary on PATH)")
+    ap.add_argument("--v2ray-geosite", action="store_true", help=f"Pack each policy's v2rayN domain list into dist/v2rayn/{GEOSITE_DAT} and reference it as ext:{GEOSITE_DAT}:<POLICY>")
+    ap.add_argument("--singbox-rule-sets", action="store_true", help="Put each policy's sing-box rules into dist/singbox/<POLICY>.json (+ .srs if a sing-box binary is on PATH) and reference them from route.rule_set")
+    ap.add_argument("--profile", action="store_true", help="Add per-stage tracemalloc peaks to dist/build_report.json and dump the slowest stage's cProfile stats to dist/build_profile.prof")
+    ap.add_argument("--precompress", action="store_true", help="Write .gz (and .br, with the brotli module) variants of dist/ and rules/ files to .cache/compressed/ for build.py serve")
+    ap.add_argument("--watch", action="store_true", help="Stay running: keep the parsed rules in memory and rebuild dist/ whenever rules/*.list or capabilities.json change")
+    ap.add_argument("--watch-interval", type=float, default=0.2, help="Seconds between --watch polls")
+    ap.add_argument("--debounce", type=float, default=0.15, help="Wait until the inputs have been quiet this long before rebuilding")
+    ap.add_argument("--strict", action="store_true", help="Fail the build when a URL-REGEX or USER-AGENT pattern is flagged as catastrophic-backtracking")
+    ap.add_argument("--hit-log", type=Path, help="Move each policy's most-hit rules up, as far as first-match results allow, by the lookups in this log (one host, IP, host:port or URL per line, optionally with a count)")
     args = ap.parse_args()
+    if args.hit_log is not None and not args.hit_log.is_file():
+        ap.error(f"--hit-log: no such file: {args.hit_log}")
+    if args.watch:
+        sys.exit(watch(args))
+    build(args)
 
-    ensure_dirs()
-    caps = load_capabilities()
-    rules_by_policy = load_rules()
-
-    header = "Generated by rulelist/build.py"
 
-    # Surge
-    surge_res = compile_surge(rules_by_policy, caps["surge"], header)
-    (DIST_DIR / "surge.conf").write_text(surge_res.text, encoding="utf-8")
+def build(
+    args: argparse.Namespace,
+    load: Optional[Callable[[], List[Tuple[str, List[Rule]]]]] = None,
+) -> List[str]:
+    """
+    One build of dist/ from the parsed command line; returns the targets that
+    were rebuilt. `load` replaces load_rules (--watch passes its resident rules).
+    """
+    jobs = resolve_jobs(1 if args.jobs is None else args.jobs)
 
-    # Loon/Stash: for baseline, reuse Surge output (basic rules compatible in many cases)
-    # You can later add dedicated loon/stash compilers if you want strict syntax control.
-    (DIST_DIR / "loon.conf").write_text(surge_res.text, encoding="utf-8")
-    (DIST_DIR / "stash.conf").write_text(surge_res.text, encoding="utf-8")
+    ensure_dirs()
+    caps_raw = json.loads(CAP_PATH.read_text(encoding="utf-8"))
+    caps = {k: Capability(k, v) for k, v in caps_raw.items()}
+    cache = BuildCache(CACHE_DIR, enabled=not args.no_cache)
+    prof = StageProfiler(args.profile)
+    with prof.stage("read"):
+        inputs = input_digests(cache)
 
-    # Quantumult X
-    qx_res = compile_quantumultx(rules_by_policy, caps["quantumultx"], header)
-    (DIST_DIR / "quantumultx.conf").write_text(qx_res.text, encoding="utf-8")
+    header = "Generated by rulelist/build.py"
 
     # Clash/mihomo
     if not args.base_raw_url:
@@ -92,35 +706,169 @@ def main():
         base_raw_url = "https://raw.githubusercontent.com/USER/REPO/main/rulelist"
     else:
         base_raw_url = args.base_raw_url.rstrip("/")
-    clash_res = compile_clash(rules_by_policy, caps["clash"], header, base_raw_url)
-    (DIST_DIR / "clash.yaml").write_text(clash_res.text, encoding="utf-8")
 
-    # sing-box
-    sb_res = compile_singbox(rules_by_policy, caps["singbox"], header)
-    (DIST_DIR / "sing-box.json").write_text(sb_res.text, encoding="utf-8")
+    # build-wide switches that change what every target sees
+    flags: Tuple[str, ...] = () if args.no_optimize else ("optimize",)
+    hit_log: Optional[Path] = args.hit_log
+    if hit_log is not None:
+        flags += ("hit-log", cache.file_digest(hit_log))
 
-    # v2rayN / v2ray routing json
-    v2n_res = compile_v2rayn(rules_by_policy, caps["v2rayn"], header)
-    (DIST_DIR / "v2rayn.json").write_text(v2n_res.text, encoding="utf-8")
+    warnings_by_target: Dict[str, List[CompileWarning]] = {}
+    stale: List[Tuple[str, str]] = []
+    options = {name: target_options(name, args) for name, _ in TARGETS}
+    for name, _ in TARGETS:
+        key = target_key(name, cache, caps_raw, inputs, header, base_raw_url, flags, options[name])
+        if cache.target_fresh(name, key, DIST_DIR):
+            warnings_by_target[name] = [CompileWarning(*w) for w in cache.target(name).get("warnings", [])]
+        else:
+            stale.append((name, key))
 
-    # Write warnings report
-    report_lines: List[str] = []
-    def dump(name: str, warns):
-        if not warns:
-            report_lines.append(f"{name}: no warnings")
-            return
-        report_lines.append(f"{name}: {len(warns)} warnings")
-        for w in warns:
-            report_lines.append(f"  - [{w.file}] {w.reason}: {w.line}")
+    pass_reports: Dict[str, Tuple[int, List[CompileWarning]]] = {}
+    counts: Dict[str, Dict[str, Any]] = {}
+    rebuilt: List[str] = []
+    if stale:
+        with prof.stage("parse"):
+            rules_by_policy = load() if load is not None else load_rules(cache if cache.enabled else None, jobs)
+        counts["source"] = rule_counts(rules_by_policy)
+        with prof.stage("passes"):
+            rules_by_policy, pass_reports = run_passes(rules_by_policy, flags, jobs)
+        if hit_log is not None:
+            with prof.stage("reorder"):
+                lookups, unread = read_hit_log(hit_log)
+                rules_by_policy, moved, n, counts["reorder"] = reorder_rules(rules_by_policy, lookups, dict(POLICY_FILES), hit_log.name)
+            counts["reorder"]["unread_lines"] = unread
+            pass_reports["reorder"] = (n, moved)
+        with prof.stage("lower"):
+            # one IR for every target (and every compile worker)
+            ir = lower_rules(rules_by_policy)
+        counts["compiled"] = ir.type_counts()
+        cache.set_target("passes", {
+            "key": passes_key(cache, inputs, flags),
+            "reports": {p: [n, [[w.file, w.line, w.reason] for w in ws]] for p, (n, ws) in pass_reports.items()},
+            "rules": counts,
+        })
+        if args.strict and pass_reports["regex"][0]:
+            # fail before anything in dist/ is replaced
+            write_report(pass_reports, warnings_by_target)
+            cache.save()
+            sys.exit(f"--strict: {pass_reports['regex'][0]} URL-REGEX/USER-AGENT rules flagged, see dist/build_warnings.txt")
 
-    dump("surge", surge_res.warnings)
-    dump("quantumultx", qx_res.warnings)
-    dump("clash", clash_res.warnings)
-    dump("singbox", sb_res.warnings)
-    dump("v2rayn", v2n_res.warnings)
+        # a target is a function of the lowered rules: when those did not change
+        # (a comment edit, a rule the passes drop, ...) its outputs are kept
+        rules_key = ir.digest() if cache.enabled else ""
+        compile_keys = {name: target_key(name, cache, caps_raw, [("rules", rules_key)], header, base_raw_url, flags, options[name]) for name, _ in stale}
+        for name, key in stale:
+            if cache.target_fresh(name, compile_keys[name], DIST_DIR, field="rules"):
+                ent = cache.target(name)
+                cache.set_target(name, dict(ent, key=key))
+                warnings_by_target[name] = [CompileWarning(*w) for w in ent.get("warnings", [])]
+            else:
+                rebuilt.append(name)
 
-    (DIST_DIR / "build_warnings.txt").write_text("\n".join(report_lines) + "\n", encoding="utf-8")
+        compile_args = {name: (caps[name], header, base_raw_url, options[name], args.profile) for name in rebuilt}
+        if jobs > 1 and len(rebuilt) > 1:
+            compiled = compile_targets(_compile_measured, rebuilt, ir, compile_args, jobs)
+        else:
+            compiled = {name: _compile_measured(name, ir, *compile_args[name]) for name in rebuilt}
+
+        # results are recorded in TARGETS order whatever order the workers finished in
+        for name, key in stale:
+            if name not in compiled:
+                continue
+            (res, outputs), costs = compiled[name]
+            prof.merge(costs)
+            warnings_by_target[name] = res.warnings
+            cache.set_target(name, {
+                "key": key,
+                "rules": compile_keys[name],
+                "outputs": outputs,
+                "warnings": [[w.file, w.line, w.reason] for w in res.warnings],
+                "stats": res.stats,
+            })
+
+    if args.precompress:
+        with prof.stage("precompress"):
+            precompress_all(cache, inputs, jobs)
+
+    if not stale:
+        ent = cache.target("passes")
+        if ent.get("key") == passes_key(cache, inputs, flags):
+            pass_reports = {p: (n, [CompileWarning(*w) for w in ws]) for p, (n, ws) in ent["reports"].items()}
+            counts = ent.get("rules", {})
+    write_report(pass_reports, warnings_by_target)
+    report = build_report(prof, cache, rebuilt, pass_reports, counts, jobs)
+    if args.profile:
+        report["cprofile"] = {"stage": prof.dump_slowest(DIST_DIR / "build_profile.prof"), "file": "build_profile.prof"}
+    write_text_atomic(DIST_DIR / "build_report.json", json.dumps(report, indent=2, ensure_ascii=False) + "\n")
+    cache.save()
+    if args.strict and pass_reports.get("regex", (0, []))[0]:
+        sys.exit(f"--strict: {pass_reports['regex'][0]} URL-REGEX/USER-AGENT rules flagged, see dist/build_warnings.txt")
+    return rebuilt
+
+
+# code the --watch daemon runs; an edit restarts it
+_WATCH_CODE_DIRS = ("compiler", "dsl", "match", "passes", "pipeline")
+
+
+def watch(args: argparse.Namespace) -> int:
+    """
+    build.py --watch: build once, then poll the rules files and
+    capabilities.json and rebuild on every change. Parsed rules stay resident
+    and only the edited part of a changed file is parsed again; target keys
+    then decide what is recompiled (a capabilities.json edit only rebuilds the
+    targets whose entry changed, a rules edit rebuilds every target unless the
+    lowered rules came out the same, and unchanged dist files are not rewritten).
+    """
+    if args.jobs is None:
+        # rebuild latency is what matters here: compile the targets side by side
+        args.jobs = 0
+    cache = BuildCache(CACHE_DIR, enabled=not args.no_cache)
+    resident: Dict[str, ResidentFile] = {}
+    for _, fname in POLICY_FILES:
+        resident[fname] = ResidentFile(RULES_DIR / fname, lambda digest, fname=fname: cache.load_snapshot(fname, digest))
+
+    def load() -> List[Tuple[str, List[Rule]]]:
+        return [(policy, resident[fname].rules) for policy, fname in POLICY_FILES if resident[fname].path.exists()]
+
+    def rebuild(label: str) -> None:
+        t0 = time.perf_counter()
+        try:
+            rebuilt = build(args, load)
+        except SystemExit as e:  # --strict findings: report and keep watching
+            print(e, file=sys.stderr)
+            return
+        took = time.perf_counter() - t0
+        print(f"[watch] {label}: rebuilt {', '.join(rebuilt) or 'nothing'} in {took:.3f}s", flush=True)
+
+    rebuild("initial build")
+    code = [ROOT / "build.py"] + sorted(p for d in _WATCH_CODE_DIRS for p in (ROOT / d).glob("*.py"))
+    inputs = [f.path for f in resident.values()] + [CAP_PATH]
+    poller = Poller(inputs + code)
+    print(f"[watch] watching {RULES_DIR} and {CAP_PATH.name} (Ctrl-C to stop)", flush=True)
+    try:
+        while True:
+            changed = poller.wait(args.watch_interval, args.debounce)
+            if any(p in changed for p in code):
+                print("[watch] build code changed, restarting", flush=True)
+                os.execv(sys.executable, [sys.executable] + sys.argv)
+            edited: List[str] = []
+            try:
+                for fname, rf in resident.items():
+                    if rf.path in changed and rf.update():
+                        edited.append(fname)
+            except RuleSyntaxError as e:
+                # keep serving the last good build until the file is fixed
+                print(f"[watch] {rf.path.name}:{e.lineno}: {e.reason}", file=sys.stderr, flush=True)
+                continue
+            if not edited and CAP_PATH not in changed:
+                continue
+            rebuild(", ".join(edited + ([CAP_PATH.name] if CAP_PATH in changed else [])))
+            # parse snapshots for the next cold start, off the latency path
+            for fname in edited:
+                cache.store_snapshot(fname, resident[fname].digest, resident[fname].rules)
+    except KeyboardInterrupt:
+        return 0
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
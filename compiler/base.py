@@ -1,7 +1,9 @@
 from __future__ import annotations
 
+import io
+import json
 from dataclasses import dataclass
-from typing import Dict, List, Optional, Set, Tuple
+from typing import AbstractSet, Any, Dict, FrozenSet, Iterable, List, Optional, Protocol, Set, Tuple
 
 from dsl.ast import Atom, Logical, Rule
 
@@ -15,11 +17,48 @@ class CompileWarning:
 
 @dataclass
 class CompileResult:
-    text: str
+    text: str  # empty when the output was streamed into a caller's writer
     warnings: List[CompileWarning]
     stats: Dict[str, int]
 
 
+class TextSink(Protocol):
+    def write(self, s: str) -> int: ...
+
+
+def open_sink(out: Optional[TextSink]) -> Tuple[TextSink, Optional[io.StringIO]]:
+    """
+    Compilers emit their output chunk by chunk into `out`. Without one they
+    collect into a StringIO (returned second) so CompileResult.text is filled.
+    """
+    if out is not None:
+        return out, None
+    buf = io.StringIO()
+    return buf, buf
+
+
+def sink_text(buf: Optional[io.StringIO]) -> str:
+    return buf.getvalue() if buf is not None else ""
+
+
+def json_str(s: str) -> str:
+    return json.dumps(s, ensure_ascii=False)
+
+
+def write_json_array(write, items: Iterable[Any], depth: int) -> None:
+    """
+    Stream `items` as the array value of a key nested `depth` levels deep, in the
+    exact layout json.dumps(..., ensure_ascii=False, indent=2) gives, one item at a time.
+    """
+    pad = "  " * (depth + 1)
+    first = True
+    for it in items:
+        chunk = json.dumps(it, ensure_ascii=False, indent=2).replace("\n", "\n" + pad)
+        write(("[\n" if first else ",\n") + pad + chunk)
+        first = False
+    write("[]" if first else "\n" + "  " * depth + "]")
+
+
 class Capability:
     """
     Extremely simplified capability flags.
@@ -27,10 +66,23 @@ class Capability:
     def __init__(self, name: str, caps: Dict[str, bool]):
         self.name = name
         self.caps = {k.upper(): bool(v) for k, v in caps.items()}
+        # can_emit results by type set; the compiler IR shares one frozenset per
+        # distinct set, so this stays as small as the set of rule shapes
+        self._emit_memo: Dict[FrozenSet[str], bool] = {}
 
     def supports(self, rtype_or_op: str) -> bool:
         return self.caps.get(rtype_or_op.upper(), False)
 
+    def can_emit(self, types: FrozenSet[str]) -> bool:
+        """Whether every rule type / logical op in `types` is supported."""
+        ok = self._emit_memo.get(types)
+        if ok is None:
+            ok = self._emit_memo[types] = all(self.supports(t) for t in types)
+        return ok
+
+    def unsupported(self, types: AbstractSet[str]) -> List[str]:
+        return sorted(t for t in types if not self.supports(t))
+
 
 def normalize_policy(policy: str) -> str:
     return policy.strip()
@@ -48,7 +100,4 @@ def rule_types_in(rule: Rule) -> Set[str]:
 
 
 def can_emit_rule(cap: Capability, rule: Rule) -> bool:
-    for t in rule_types_in(rule):
-        if not cap.supports(t):
-            return False
-    return True
\ No newline at end of file
+    return cap.can_emit(frozenset(rule_types_in(rule)))
\ No newline at end of file
@@ -1,18 +1,32 @@
 from __future__ import annotations
 
 import yaml
-from typing import Dict, List, Tuple
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
-from dsl.ast import Atom, Logical, Rule
-from compiler.base import Capability, CompileResult, CompileWarning, normalize_policy
+from dsl.ast import Atom
+from passes.logic import Term
+from passes.lower import lower_wildcard, subdomain_base
+from compiler.base import Capability, CompileResult, CompileWarning, TextSink, open_sink, sink_text
+from compiler.ir import PolicyIR, RuleIR, expand_logical
 
 
 # We generate a minimal Clash/mihomo config fragment:
-# - rule-providers pointing to raw URLs for each policy file (classical)
+# - rule-providers whose payload files are generated into dist/clash/
 # - rules referencing RULE-SET providers
 #
 # mihomo rule-providers content supports classical/domain/ipcidr. classical supports many rule types. [oai_citation:11‡Metacubex Wiki](https://wiki.metacubex.one/en/config/rule-providers/content/?utm_source=chatgpt.com)
 #
+# Each policy is split by provider behavior, fastest first:
+#   domain     DOMAIN (x), DOMAIN-SUFFIX (+.x) and DOMAIN-WILDCARD *.x (.x)
+#   classical  every other type the capability allows (keyword, wildcard, ...)
+#   ipcidr     IP-CIDR / IP-CIDR6, the no-resolve ones in their own provider so the
+#              RULE-SET line can carry no-resolve; resolving IP rules go last so
+#              domains of this policy never trigger a DNS lookup first
+# Every rule of one policy routes to the same policy, so reordering inside it
+# keeps first-match behaviour. For the same reason an AND/OR/NOT rule, which the
+# capabilities leave out, is expanded into the rules its OR is made of
+# (passes.logic); terms that AND or negate rules are skipped.
+#
 # IMPORTANT: user will host this repo. build.py fills base_raw_url.
 
 SUPPORTED_CLASSICAL = {
@@ -21,50 +35,166 @@ SUPPORTED_CLASSICAL = {
     "FINAL",
 }
 
+# provider writer: (provider name, behavior, payload lines) -> rule-providers entry
+ProviderWriter = Callable[[str, str, List[str]], Dict[str, Any]]
+
+_IP_TYPES = ("IP-CIDR", "IP-CIDR6")
+
 
 def compile_clash(
-    rules_by_policy: List[Tuple[str, List[Rule]]],
+    ir: RuleIR,
     cap: Capability,
     header_comment: str,
     base_raw_url: str,
+    out: Optional[TextSink] = None,
+    provider_writer: Optional[ProviderWriter] = None,
+    target: str = "clash",
 ) -> CompileResult:
+    """
+    Without a provider_writer the payloads are inlined into `rules` instead,
+    which keeps the config self-contained. `target` labels the warnings.
+    """
     warnings: List[CompileWarning] = []
     stats = {"emitted_rules": 0, "skipped_rules": 0, "providers": 0}
 
-    # rule-providers (one per policy list file) using "classical"
     rule_providers: Dict[str, Dict] = {}
-
     # rules: use RULE-SET,provider_name,policy
     rules_out: List[str] = []
+    has_match = False
 
-    for policy, rules in rules_by_policy:
-        pol = normalize_policy(policy)
-        provider_name = f"RL_{pol}"
-        rule_providers[provider_name] = {
-            "type": "http",
-            "behavior": "classical",
-            "url": f"{base_raw_url}/rules/{pol}.list",
-            "path": f"./ruleset_cache/{provider_name}.yaml",
-            "interval": 86400,
-        }
-        stats["providers"] += 1
-
-        # Reference provider in rules (RULE-SET)
-        # Clash syntax: RULE-SET,<provider>,<policy>
-        # Note: We do not inline each rule because we want external syncing.
-        rules_out.append(f"RULE-SET,{provider_name},{pol}")
-        stats["emitted_rules"] += 1
+    for p in ir:
+        pol = p.policy
+        buckets = _split_policy(p, cap, target, warnings, stats)
 
-    # FINAL: if user has FINAL.list, it will still be referenced above; but Clash needs a real MATCH at end.
-    # We'll force a trailing MATCH if FINAL.list is absent; otherwise, we still add MATCH to be safe.
-    rules_out.append("MATCH,PROXY")
-    stats["emitted_rules"] += 1
+        for suffix, behavior, lines, opts in (
+            ("domain", "domain", buckets["domain"], ""),
+            ("", "classical", buckets["classical"], ""),
+            ("ipcidr_nr", "ipcidr", buckets["ipcidr_nr"], ",no-resolve"),
+            ("ipcidr", "ipcidr", buckets["ipcidr"], ""),
+        ):
+            if not lines:
+                continue
+            if provider_writer is None:
+                rules_out.extend(_inline(behavior, lines, pol, opts))
+                continue
+            provider_name = f"RL_{pol}_{suffix}" if suffix else f"RL_{pol}"
+            rule_providers[provider_name] = provider_writer(provider_name, behavior, lines)
+            stats["providers"] += 1
+            # Clash syntax: RULE-SET,<provider>,<policy>[,no-resolve]
+            rules_out.append(f"RULE-SET,{provider_name},{pol}{opts}")
+
+        if "FINAL" in p.index:
+            rules_out.append(f"MATCH,{pol}")
+            has_match = True
+
+    # Clash needs a real MATCH at the end; FINAL rules already provide one.
+    if not has_match:
+        rules_out.append("MATCH,PROXY")
+        stats["emitted_rules"] += 1
 
     doc = {
         "#": header_comment,
         "rule-providers": rule_providers,
         "rules": rules_out,
     }
-    text = yaml.safe_dump(doc, sort_keys=False, allow_unicode=True)
+    sink, buf = open_sink(out)
+    yaml.safe_dump(doc, sink, sort_keys=False, allow_unicode=True)
+
+    return CompileResult(text=sink_text(buf), warnings=warnings, stats=stats)
+
+
+def _split_policy(
+    p: PolicyIR,
+    cap: Capability,
+    target: str,
+    warnings: List[CompileWarning],
+    stats: Dict[str, int],
+) -> Dict[str, List[str]]:
+    """Payload lines of one policy per bucket (deduplicated, source order)."""
+    buckets: Dict[str, Dict[str, None]] = {"domain": {}, "classical": {}, "ipcidr_nr": {}, "ipcidr": {}}
+    for run in p.runs:
+        t = run.kind
+        if t == "FINAL":
+            stats["emitted_rules"] += len(run)
+            continue
+        if run.logical:
+            for r, terms in zip(run.rules, run.disjuncts()):
+                ok = expand_logical(target, r, terms, lambda term: _add_term(buckets, term, cap, target), warnings)
+                stats["emitted_rules" if ok else "skipped_rules"] += 1
+            continue
+        if t == "DOMAIN-WILDCARD":
+            for r in run.rules:
+                bad = _add_atom(buckets, r, cap)
+                if bad is None:
+                    stats["emitted_rules"] += 1
+                else:
+                    stats["skipped_rules"] += 1
+                    warnings.append(CompileWarning(file=target, line=bad, reason=f"Unsupported type for {target.title()}"))
+            continue
+        if not cap.supports(t):
+            stats["skipped_rules"] += len(run)
+            warnings += [CompileWarning(file=target, line=f"{t},{r.value.strip()}", reason=f"Unsupported type for {target.title()}") for r in run.rules]
+            continue
+        if t == "DOMAIN":
+            buckets["domain"].update(dict.fromkeys([r.value.strip() for r in run.rules]))
+        elif t == "DOMAIN-SUFFIX":
+            buckets["domain"].update(dict.fromkeys([f"+.{r.value.strip().lstrip('.')}" for r in run.rules]))
+        elif t in _IP_TYPES:
+            for r in run.rules:
+                buckets["ipcidr_nr" if "no-resolve" in r.options else "ipcidr"][r.value.strip()] = None
+        else:
+            buckets["classical"].update(dict.fromkeys([_classical(t, r.value.strip(), r.options) for r in run.rules]))
+        stats["emitted_rules"] += len(run)
+    return {k: list(v) for k, v in buckets.items()}
+
+
+def _classical(t: str, v: str, options: Tuple[str, ...]) -> str:
+    opts = [o for o in options if o == "no-resolve"]
+    return ",".join([t, v, *opts])
+
+
+def _add_atom(buckets: Dict[str, Dict[str, None]], r: Atom, cap: Capability) -> Optional[str]:
+    """Put one atom into its bucket; returns its "TYPE,value" instead if the capability leaves it out."""
+    t, v = r.rtype, r.value.strip()
+    if t == "DOMAIN-WILDCARD" and not r.options:
+        t, v = lower_wildcard(v) or (t, v)
+        base = subdomain_base(v) if t == "DOMAIN-WILDCARD" else None
+        if base is not None:
+            # domain behavior ".x" matches only below x, like *.x
+            buckets["domain"]["." + base] = None
+            return None
+    if t == "FINAL" or not cap.supports(t):
+        return f"{t},{v}"
+    if t == "DOMAIN":
+        buckets["domain"][v] = None
+    elif t == "DOMAIN-SUFFIX":
+        buckets["domain"][f"+.{v.lstrip('.')}"] = None
+    elif t in _IP_TYPES:
+        buckets["ipcidr_nr" if "no-resolve" in r.options else "ipcidr"][v] = None
+    else:
+        buckets["classical"][_classical(t, v, r.options)] = None
+    return None
+
+
+def _add_term(buckets: Dict[str, Dict[str, None]], t: Term, cap: Capability, target: str) -> Optional[str]:
+    if len(t) != 1 or t[0][1]:
+        return f"{target.title()} providers cannot AND or negate rules"
+    bad = _add_atom(buckets, t[0][0], cap)
+    return None if bad is None else f"Unsupported type for {target.title()}: {bad}"
+
 
-    return CompileResult(text=text, warnings=warnings, stats=stats)
\ No newline at end of file
+def _inline(behavior: str, lines: Iterable[str], pol: str, opts: str) -> Iterable[str]:
+    for line in lines:
+        if behavior == "domain":
+            if line.startswith("+."):
+                yield f"DOMAIN-SUFFIX,{line[2:]},{pol}"
+            elif line.startswith("."):
+                yield f"DOMAIN-WILDCARD,*{line},{pol}"
+            else:
+                yield f"DOMAIN,{line},{pol}"
+        elif behavior == "ipcidr":
+            yield f"{'IP-CIDR6' if ':' in line else 'IP-CIDR'},{line},{pol}{opts}"
+        else:
+            t, _, rest = line.partition(",")
+            v, sep, o = rest.partition(",")
+            yield f"{t},{v},{pol}{',' + o if sep else ''}"
@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import hashlib
+from typing import Callable, Dict, FrozenSet, Iterator, List, Optional, Tuple
+
+from dsl.ast import Atom, Logical, Rule, rule_text
+from passes.logic import MAX_TERMS, Term, disjuncts, term_rule
+from compiler.base import CompileWarning, normalize_policy, rule_types_in
+
+
+# The lowered form every backend compiles from. build.py builds it once per
+# build, after the passes, and hands the same object to all targets:
+#
+#   RuleIR.policies   one PolicyIR per policy, in first-match order
+#   PolicyIR.runs     the policy's rules cut into maximal runs of consecutive
+#                     rules with the same kind (atom type, or AND / OR / NOT)
+#                     and the same set of types inside; the runs concatenated
+#                     give back the source order
+#   PolicyIR.index    {kind: [runs]}, the per-type index of one policy
+#
+# Types are normalized and the types inside a logical rule collected here, once,
+# so a backend dispatches on run.kind once per run, checks a target's support
+# with one memoized Capability.can_emit(run.types) per run, and its inner loops
+# only touch values. Targets without logical rules expand those through
+# Run.disjuncts(), computed on first use and then shared by every such target.
+
+_ATOM_TYPES: Dict[str, FrozenSet[str]] = {}
+
+
+class Run:
+    __slots__ = ("kind", "types", "logical", "rules", "_terms")
+
+    def __init__(self, kind: str, types: FrozenSet[str], logical: bool, rules: List[Rule]):
+        self.kind = kind  # atom type, or the op of a logical rule
+        self.types = types  # every type and op used by the rules
+        self.logical = logical
+        self.rules = rules
+        self._terms: Optional[List[Optional[List[Term]]]] = None
+
+    def disjuncts(self) -> List[Optional[List[Term]]]:
+        """passes.logic.disjuncts() of each rule of a logical run, in order."""
+        if self._terms is None:
+            self._terms = [disjuncts(r) for r in self.rules]
+        return self._terms
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def __repr__(self):
+        return f"Run({self.kind!r}, {len(self.rules)} rules)"
+
+
+class PolicyIR:
+    __slots__ = ("policy", "runs", "index")
+
+    def __init__(self, policy: str, runs: List[Run]):
+        self.policy = policy  # normalized
+        self.runs = runs
+        self.index: Dict[str, List[Run]] = {}
+        for run in runs:
+            self.index.setdefault(run.kind, []).append(run)
+
+    def count(self, kind: str) -> int:
+        return sum(len(run) for run in self.index.get(kind, ()))
+
+    def rules(self) -> Iterator[Rule]:
+        for run in self.runs:
+            yield from run.rules
+
+
+class RuleIR:
+    __slots__ = ("policies",)
+
+    def __init__(self, policies: List[PolicyIR]):
+        self.policies = policies
+
+    def __iter__(self) -> Iterator[PolicyIR]:
+        return iter(self.policies)
+
+    def type_counts(self) -> Dict[str, Dict[str, int]]:
+        """{policy: {rule type (AND/OR/NOT for logical rules): count}}, as build.rule_counts gives."""
+        return {p.policy: {k: p.count(k) for k in sorted(p.index)} for p in self.policies}
+
+    def digest(self) -> str:
+        """Content digest of the policies and their rules in order; backends never read line numbers."""
+        h = hashlib.blake2b(digest_size=16)
+        for p in self.policies:
+            h.update(p.policy.encode("utf-8") + b"\0")
+            for run in p.runs:
+                h.update("\n".join(map(rule_text, run.rules)).encode("utf-8") + b"\0")
+        return h.hexdigest()
+
+
+def _atom_types(t: str) -> FrozenSet[str]:
+    types = _ATOM_TYPES.get(t)
+    if types is None:
+        types = _ATOM_TYPES[t] = frozenset((t,))
+    return types
+
+
+def lower_rules(rules_by_policy: List[Tuple[str, List[Rule]]]) -> RuleIR:
+    policies: List[PolicyIR] = []
+    for policy, rules in rules_by_policy:
+        runs: List[Run] = []
+        kind = None
+        types: FrozenSet[str] = frozenset()
+        logical = False
+        add = None
+        for r in rules:
+            if type(r) is Atom:
+                if r.rtype != kind or logical:
+                    kind, types, logical = r.rtype, _atom_types(r.rtype), False
+                    run = Run(kind, types, False, [])
+                    runs.append(run)
+                    add = run.rules.append
+            elif isinstance(r, Logical):
+                t = frozenset(rule_types_in(r))
+                if r.op != kind or t != types:
+                    kind, types, logical = r.op, t, True
+                    run = Run(kind, types, True, [])
+                    runs.append(run)
+                    add = run.rules.append
+            else:
+                raise TypeError(f"not a rule node: {r!r}")
+            add(r)
+        policies.append(PolicyIR(normalize_policy(policy), runs))
+    return RuleIR(policies)
+
+
+def expand_logical(
+    target: str,
+    rule: Rule,
+    terms: Optional[List[Term]],
+    emit_term: Callable[[Term], Optional[str]],
+    warnings: List[CompileWarning],
+) -> bool:
+    """
+    Compile a logical rule as consecutive rules, one per term of its
+    disjuncts(): emit_term(term) writes one and returns None, or returns why the
+    target cannot express it (reported; that term is left out). Returns whether
+    the rule was compiled, i.e. is not skipped as a whole.
+    """
+    if terms is None:
+        warnings.append(CompileWarning(file=target, line=rule_text(rule), reason=f"AND/OR/NOT too large to expand into {MAX_TERMS} rules"))
+        return False
+    # a rule that can never match compiles to nothing
+    ok = not terms
+    for t in terms:
+        why = emit_term(t)
+        if why is None:
+            ok = True
+        else:
+            if len(terms) == 1:
+                warnings.append(CompileWarning(file=target, line=rule_text(rule), reason=why))
+            else:
+                warnings.append(CompileWarning(file=target, line=rule_text(term_rule(t)), reason=f"{why} (part of {rule_text(rule)})"))
+    return ok
@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+from typing import Dict, List, Optional, Tuple
+
+from dsl.ast import rule_text
+from compiler.base import Capability, CompileResult, CompileWarning, TextSink, open_sink, sink_text
+from compiler.ir import RuleIR
+from compiler.surge import SetWriter, emit_opts, rule_line
+
+
+# Loon has no DOMAIN-SET; external rule files are listed under [Remote Rule]:
+#   <url>, policy=<policy>, tag=<tag>, enabled=true
+# with "TYPE,VALUE[,options]" lines in the file. Loon evaluates [Rule] before
+# [Remote Rule] (FINAL always last), so every rule except FINAL goes into the
+# policy's remote file; [Rule] only carries the FINAL lines. Without a set
+# writer the rules are inlined into [Rule] instead.
+
+
+def compile_loon(
+    ir: RuleIR,
+    cap: Capability,
+    header_comment: str,
+    out: Optional[TextSink] = None,
+    set_writer: Optional[SetWriter] = None,
+) -> CompileResult:
+    warnings: List[CompileWarning] = []
+    stats = {"emitted": 0, "skipped": 0, "sets": 0}
+
+    rule_lines: List[str] = []
+    remote_lines: List[str] = []
+    for p in ir:
+        pol = p.policy
+        lines: Dict[Tuple[str, str], None] = {}
+        for run in p.runs:
+            if run.kind == "FINAL":
+                stats["emitted"] += len(run)
+                continue
+            if not cap.can_emit(run.types):
+                unsupported = ", ".join(cap.unsupported(run.types))
+                stats["skipped"] += len(run)
+                warnings += [CompileWarning(file="loon", line=rule_text(r), reason=f"Unsupported type for Loon: {unsupported}") for r in run.rules]
+                continue
+            lines.update(dict.fromkeys([(rule_line(r), emit_opts(r)) for r in run.rules]))
+            stats["emitted"] += len(run)
+
+        if set_writer is None:
+            rule_lines += [f"{line},{pol}{opts}" for line, opts in lines]
+        elif lines:
+            url = set_writer(f"{pol}.list", [line + opts for line, opts in lines])
+            remote_lines.append(f"{url}, policy={pol}, tag=RL_{pol}, enabled=true")
+            stats["sets"] += 1
+        if "FINAL" in p.index:
+            rule_lines.append(f"FINAL,{pol}")
+
+    sink, buf = open_sink(out)
+    w = sink.write
+    w(f"# {header_comment}\n")
+    if remote_lines:
+        w("[Remote Rule]\n")
+        for line in remote_lines:
+            w(line + "\n")
+        w("\n")
+    w("[Rule]\n")
+    for line in rule_lines:
+        w(line + "\n")
+    return CompileResult(text=sink_text(buf), warnings=warnings, stats=stats)
@@ -1,9 +1,12 @@
 from __future__ import annotations
 
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional
 
-from dsl.ast import Atom, Logical, Rule
-from compiler.base import Capability, CompileResult, CompileWarning, normalize_policy
+from dsl.ast import Atom, rule_text
+from passes.logic import Term
+from compiler.base import Capability, CompileResult, CompileWarning, TextSink, open_sink, sink_text
+from compiler.ir import RuleIR, expand_logical
+from compiler.surge import SetWriter
 
 
 # QX Filter rules commonly use: HOST / HOST-SUFFIX / HOST-KEYWORD / USER-AGENT / URL-REGEX etc.
@@ -14,7 +17,18 @@ from compiler.base import Capability, CompileResult, CompileWarning, normalize_p
 # DOMAIN-KEYWORD -> HOST-KEYWORD
 # URL-REGEX -> URL-REGEX
 # USER-AGENT -> USER-AGENT
-# IP-CIDR / GEOIP / DST-PORT etc: QX supports some but formats differ; we conservatively skip unsupported unless you extend.
+# IP-CIDR -> IP-CIDR, IP-CIDR6 -> IP6-CIDR, GEOIP -> GEOIP (IP-CIDR / IP6-CIDR keep no-resolve;
+#   any other option on these lines is dropped with a warning)
+# DST-PORT etc: no QX filter type; skipped.
+# AND/OR/NOT: QX filters have no logical rules, so a logical rule is expanded
+# into the rules its OR is made of (passes.logic); terms that AND or negate
+# rules cannot be written and are skipped.
+#
+# With a set writer, each policy's rules go into a remote filter resource
+# (dist/quantumultx/<POLICY>.list) listed under [filter_remote] with
+# force-policy=<POLICY>. QX checks [filter_local] before remote filters, so only
+# FINAL stays local. Every rule of one policy routes to the same policy, so
+# moving them into one resource keeps first-match behaviour.
 
 _TYPE_MAP = {
     "DOMAIN": "HOST",
@@ -23,49 +37,96 @@ _TYPE_MAP = {
     "DOMAIN-WILDCARD": "HOST-WILDCARD",
     "USER-AGENT": "USER-AGENT",
     "URL-REGEX": "URL-REGEX",
+    "IP-CIDR": "IP-CIDR",
+    "IP-CIDR6": "IP6-CIDR",
+    "GEOIP": "GEOIP",
 }
 
+_IP_TYPES = ("IP-CIDR", "IP6-CIDR", "GEOIP")
+_NO_RESOLVE_TYPES = ("IP-CIDR", "IP6-CIDR")
+
 
 def compile_quantumultx(
-    rules_by_policy: List[Tuple[str, List[Rule]]],
+    ir: RuleIR,
     cap: Capability,
     header_comment: str,
+    out: Optional[TextSink] = None,
+    set_writer: Optional[SetWriter] = None,
 ) -> CompileResult:
     warnings: List[CompileWarning] = []
-    stats = {"emitted": 0, "skipped": 0}
-
-    lines: List[str] = []
-    lines.append(f"# {header_comment}")
-    lines.append("[filter]")
-
-    for policy, rules in rules_by_policy:
-        pol = normalize_policy(policy)
-        for r in rules:
-            if isinstance(r, Atom) and r.norm_type() == "FINAL":
-                lines.append(f"FINAL,{pol}")
-                stats["emitted"] += 1
+    stats = {"emitted": 0, "skipped": 0, "sets": 0}
+
+    local_lines: List[str] = []
+    remote_lines: List[str] = []
+    for p in ir:
+        pol = p.policy
+        lines: Dict[str, None] = {}
+        for run in p.runs:
+            rt = run.kind
+            if rt == "FINAL":
+                stats["emitted"] += len(run)
                 continue
 
-            if isinstance(r, Logical):
-                # QX does not have Surge-style logical rule syntax in filter section.
-                stats["skipped"] += 1
-                warnings.append(CompileWarning(file="quantumultx", line=str(r), reason="QX filter does not support AND/OR/NOT in this compiler"))
+            if run.logical:
+                for r, terms in zip(run.rules, run.disjuncts()):
+                    ok = expand_logical("quantumultx", r, terms, lambda t: _add_term(lines, t, pol, cap, warnings), warnings)
+                    stats["emitted" if ok else "skipped"] += 1
                 continue
 
-            if isinstance(r, Atom):
-                rt = r.norm_type()
-                if rt in _TYPE_MAP:
-                    qx_t = _TYPE_MAP[rt]
-                    # options: we keep as trailing flags when possible (e.g. resolve-on-proxy/force-remote-dns)
-                    opt = ""
-                    if r.options:
-                        opt = "," + ",".join(r.options)
-                    lines.append(f"{qx_t},{r.value},{pol}{opt}")
-                    stats["emitted"] += 1
-                    continue
-
-                stats["skipped"] += 1
-                warnings.append(CompileWarning(file="quantumultx", line=r.raw if hasattr(r, "raw") else str(r), reason=f"Unsupported rule type for QX: {rt}"))
+            qx_t = _qx_type(rt, cap)
+            if qx_t is not None:
+                lines.update(dict.fromkeys([_qx_line(qx_t, r, pol, warnings) for r in run.rules]))
+                stats["emitted"] += len(run)
                 continue
 
-    return CompileResult(text="\n".join(lines) + "\n", warnings=warnings, stats=stats)
\ No newline at end of file
+            stats["skipped"] += len(run)
+            warnings += [CompileWarning(file="quantumultx", line=rule_text(r), reason=f"Unsupported rule type for QX: {rt}") for r in run.rules]
+
+        if set_writer is None:
+            local_lines += lines
+        elif lines:
+            url = set_writer(f"{pol}.list", list(lines))
+            remote_lines.append(f"{url}, tag=RL_{pol}, force-policy={pol}, update-interval=86400, opt-parser=false, enabled=true")
+            stats["sets"] += 1
+        if "FINAL" in p.index:
+            local_lines.append(f"FINAL,{pol}")
+
+    sink, buf = open_sink(out)
+    w = sink.write
+    w(f"# {header_comment}\n")
+    if remote_lines:
+        w("[filter_remote]\n")
+        for line in remote_lines:
+            w(line + "\n")
+        w("\n")
+    w("[filter_local]\n")
+    for line in local_lines:
+        w(line + "\n")
+    return CompileResult(text=sink_text(buf), warnings=warnings, stats=stats)
+
+
+def _qx_type(rt: str, cap: Capability) -> Optional[str]:
+    if rt in _TYPE_MAP and cap.supports(rt):
+        return _TYPE_MAP[rt]
+    return None
+
+
+def _qx_line(qx_t: str, r: Atom, pol: str, warnings: List[CompileWarning]) -> str:
+    if qx_t in _IP_TYPES:
+        opts = [o for o in r.options if o == "no-resolve" and qx_t in _NO_RESOLVE_TYPES]
+        if len(opts) != len(r.options):
+            warnings += [CompileWarning(file="quantumultx", line=rule_text(r), reason=f"Option dropped for QX {qx_t}: {o}") for o in r.options if o not in opts]
+        return ",".join([qx_t, r.value, pol, *opts])
+    # options: we keep as trailing flags when possible (e.g. resolve-on-proxy/force-remote-dns)
+    return ",".join([qx_t, r.value, pol, *r.options])
+
+
+def _add_term(lines: Dict[str, None], t: Term, pol: str, cap: Capability, warnings: List[CompileWarning]) -> Optional[str]:
+    if len(t) != 1 or t[0][1]:
+        return "QX filters cannot AND or negate rules"
+    a = t[0][0]
+    qx_t = _qx_type(a.rtype, cap)
+    if qx_t is None:
+        return f"Unsupported rule type for QX: {a.rtype}"
+    lines[_qx_line(qx_t, a, pol, warnings)] = None
+    return None
@@ -1,85 +1,257 @@
 from __future__ import annotations
 
-import json
-from typing import Any, Dict, List, Tuple
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
-from dsl.ast import Atom, Logical, Rule
-from compiler.base import Capability, CompileResult, CompileWarning, normalize_policy
+from dsl.ast import Atom, Logical, Rule, rule_text
+from passes.lower import host_pattern, lower_wildcard, merge_regexes, subdomain_base
+from compiler.base import (
+    Capability, CompileResult, CompileWarning, TextSink,
+    json_str, open_sink, sink_text, write_json_array,
+)
+from compiler.ir import PolicyIR, RuleIR
 
 
 # sing-box route rules fields include domain/domain_suffix/domain_keyword/domain_regex/geoip/ip_cidr/port, etc. [oai_citation:12‡Sing Box](https://sing-box.sagernet.org/configuration/route/rule/?utm_source=chatgpt.com)
 # We'll map to sing-box route rules, and output "route.rules" list.
 # For unsupported (USER-AGENT etc), we warn+skip by default.
+#
+# Rules are grouped per policy. sing-box ORs the destination fields of one rule
+# (domain, domain_suffix, domain_keyword, domain_regex, geoip, ip_cidr) and ANDs
+# that group with port/port_range, so a policy compiles to at most:
+#   {<all destination fields>, outbound}, {port, port_range, outbound}, {outbound}
+# Every rule of one policy file routes to the same outbound, so merging them in
+# any order keeps first-match behaviour; only the policy order has to be kept.
+#
+# Patterns are lowered where sing-box has a cheaper exact field: *.example.com
+# becomes domain_suffix ".example.com" (subdomains only), host regexes of a
+# known shape become domain / domain_suffix / domain_keyword, and the
+# domain_regex values left in a policy are merged into one alternation.
+#
+# AND/OR/NOT rules: the operands of a top-level OR are compiled as consecutive
+# rules (atoms join the merged fields above). Anything else becomes a route rule
+# of type "logical" (mode and / or) over headless rules, with NOT as "invert";
+# an AND of one destination atom and one port atom, and an OR of destination
+# atoms only (or port atoms only), fit a plain rule. These rules come after
+# the merged ones; a rule is only skipped for an atom sing-box has no field for.
+#
+# With a rule-set writer, the destination and port rules of a policy go into a
+# headless rule-set instead and the route rule just references its tag (geoip
+# stays inline: headless rules have no geoip field).
+
+RULE_SET_VERSION = 2
+
+# rule-set writer: (policy, headless rule-set document) -> route.rule_set entry
+RuleSetWriter = Callable[[str, Dict[str, Any]], Dict[str, Any]]
+
+_ADDRESS_FIELDS = ("domain", "domain_suffix", "domain_keyword", "domain_regex", "ip_cidr")
+_PORT_FIELDS = ("port", "port_range")
+
 
 def compile_singbox(
-    rules_by_policy: List[Tuple[str, List[Rule]]],
+    ir: RuleIR,
     cap: Capability,
     header_comment: str,
+    out: Optional[TextSink] = None,
+    rule_set_writer: Optional[RuleSetWriter] = None,
 ) -> CompileResult:
     warnings: List[CompileWarning] = []
-    stats = {"emitted": 0, "skipped": 0}
+    stats = {"emitted": 0, "skipped": 0, "route_rules": 0, "rule_sets": 0}
+    rule_sets: List[Dict[str, Any]] = []
 
-    sb_rules: List[Dict[str, Any]] = []
+    # {"_comment": ..., "route": {"rules": [...], "rule_set": [...]}}, streamed rule by rule
+    sink, buf = open_sink(out)
+    w = sink.write
+    w("{\n")
+    w(f'  "_comment": {json_str(header_comment)},\n')
+    w('  "route": {\n')
+    w('    "rules": ')
+    write_json_array(w, _iter_route_rules(ir, warnings, stats, rule_set_writer, rule_sets), 2)
+    if rule_sets:
+        w(',\n    "rule_set": ')
+        write_json_array(w, rule_sets, 2)
+    w("\n  }\n}\n")
+    return CompileResult(text=sink_text(buf), warnings=warnings, stats=stats)
 
-    for policy, rules in rules_by_policy:
-        pol = normalize_policy(policy)
 
-        for r in rules:
-            if isinstance(r, Atom) and r.norm_type() == "FINAL":
-                sb_rules.append({"outbound": pol})
-                stats["emitted"] += 1
-                continue
+def _iter_route_rules(
+    ir: RuleIR,
+    warnings: List[CompileWarning],
+    stats: Dict[str, int],
+    rule_set_writer: Optional[RuleSetWriter],
+    rule_sets: List[Dict[str, Any]],
+) -> Iterator[Dict[str, Any]]:
+    for p in ir:
+        pol = p.policy
+        fields, logical, final = _collect_policy(p, warnings, stats)
+
+        address = {k: fields[k] for k in _ADDRESS_FIELDS if fields[k]}
+        ports = {k: fields[k] for k in _PORT_FIELDS if fields[k]}
+        if rule_set_writer is not None and (address or ports):
+            doc = {"version": RULE_SET_VERSION, "rules": [r for r in (address, ports) if r]}
+            entry = rule_set_writer(pol, doc)
+            rule_sets.append(entry)
+            stats["rule_sets"] += 1
+            yield {"rule_set": [entry["tag"]], "outbound": pol}
+            stats["route_rules"] += 1
+            address, ports = {}, {}
+        if fields["geoip"]:
+            address["geoip"] = fields["geoip"]
+        for node in (address, ports, *logical):
+            if node:
+                node["outbound"] = pol
+                yield node
+                stats["route_rules"] += 1
+        if final:
+            yield {"outbound": pol}
+            stats["route_rules"] += 1
 
-            if isinstance(r, Logical):
-                # sing-box has "rule_set" and multiple fields combined as AND semantics, but not Surge-style nested boolean.
-                # We skip with warning; you can later extend to translate to multiple rules.
+
+def _collect_policy(
+    p: PolicyIR,
+    warnings: List[CompileWarning],
+    stats: Dict[str, int],
+) -> Tuple[Dict[str, List[Any]], List[Dict[str, Any]], bool]:
+    """
+    Field arrays (deduplicated, in source order) of one policy, the rules its
+    AND/OR/NOT rules compile to, and whether it has a FINAL.
+    """
+    fields: Dict[str, Dict[Any, None]] = {k: {} for k in (*_ADDRESS_FIELDS, *_PORT_FIELDS, "geoip")}
+    logical: List[Dict[str, Any]] = []
+    for run in p.runs:
+        t = run.kind
+        if t == "FINAL":
+            stats["emitted"] += len(run)
+            continue
+
+        if run.logical:
+            for r in run.rules:
+                ok = False
+                for x in (r.items if r.op == "OR" else (r,)):
+                    fv = _atom_to_singbox(x.rtype, x.value) if type(x) is Atom else None
+                    node = _headless(x) if type(x) is Logical else None
+                    if fv is not None:
+                        fields[fv[0]][fv[1]] = None
+                    elif node is not None:
+                        logical.append(node)
+                    else:
+                        part = "" if x is r else f" (part of {rule_text(r)})"
+                        warnings.append(CompileWarning(file="singbox", line=rule_text(x), reason=f"Unsupported type in sing-box route rules{part}"))
+                        continue
+                    ok = True
+                stats["emitted" if ok else "skipped"] += 1
+            continue
+
+        field = _PLAIN_FIELDS.get(t)
+        if field is not None:
+            fields[field].update(dict.fromkeys([r.value for r in run.rules]))
+            stats["emitted"] += len(run)
+            continue
+
+        for r in run.rules:
+            fv = _atom_to_singbox(t, r.value)
+            if fv is None:
                 stats["skipped"] += 1
-                warnings.append(CompileWarning(file="singbox", line=str(r), reason="Nested AND/OR/NOT not compiled in baseline"))
+                warnings.append(CompileWarning(file="singbox", line=f"{t},{r.value}", reason="Unsupported type in sing-box route rules"))
                 continue
+            fields[fv[0]][fv[1]] = None
+            stats["emitted"] += 1
+    out = {k: list(v) for k, v in fields.items()}
+    out["domain_regex"] = merge_regexes(out["domain_regex"])
+    return out, logical, "FINAL" in p.index
+
+
+def _headless(r: Rule) -> Optional[Dict[str, Any]]:
+    """A headless rule matching what `r` matches; None if an atom in it has no field."""
+    if type(r) is Atom:
+        fv = _atom_to_singbox(r.rtype, r.value)
+        return None if fv is None else {fv[0]: [fv[1]]}
+    if r.op == "NOT":
+        # NOT(a, b) matches when none of its operands does
+        inner = _headless(r.items[0] if len(r.items) == 1 else Logical("OR", r.items))
+        if inner is not None and not inner.pop("invert", False):
+            inner["invert"] = True
+        return inner
+    nodes = []
+    for x in r.items:
+        node = _headless(x)
+        if node is None:
+            return None
+        nodes.append(node)
+    return _plain_rule(r.op, nodes) or {"type": "logical", "mode": r.op.lower(), "rules": nodes}
+
+
+def _plain_rule(op: str, nodes: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    One plain rule equal to the AND / OR of single-field `nodes`, where the
+    field semantics allow it: destination fields OR, port fields OR, and the
+    two groups AND.
+    """
+    if any(len(n) != 1 for n in nodes):
+        return None  # inverted, logical or several fields
+    groups = [_PORT_FIELDS if next(iter(n)) in _PORT_FIELDS else _ADDRESS_FIELDS for n in nodes]
+    if op == "AND":
+        if len(nodes) != 2 or groups[0] is groups[1]:
+            return None
+        return {**nodes[0], **nodes[1]}
+    if any(g is not groups[0] for g in groups):
+        return None
+    out: Dict[str, List[Any]] = {}
+    for n in nodes:
+        for k, v in n.items():
+            out.setdefault(k, [])
+            out[k] += [x for x in v if x not in out[k]]
+    return out
+
+
+_HOST_FIELDS = {"DOMAIN": "domain", "DOMAIN-SUFFIX": "domain_suffix", "DOMAIN-KEYWORD": "domain_keyword"}
+
+
+def _host_field(rx: str) -> Tuple[str, str]:
+    """Cheapest field matching hosts like the regex `rx` does."""
+    lowered = host_pattern(rx)
+    if lowered is None:
+        return "domain_regex", rx
+    t, v = lowered
+    if t == "DOMAIN-WILDCARD":
+        return "domain_suffix", v[1:]
+    return _HOST_FIELDS[t], v
+
+
+# types whose value is the field value as it is
+_PLAIN_FIELDS = {
+    "DOMAIN": "domain",
+    "DOMAIN-SUFFIX": "domain_suffix",
+    "DOMAIN-KEYWORD": "domain_keyword",
+    "IP-CIDR": "ip_cidr",
+    "IP-CIDR6": "ip_cidr",
+    "GEOIP": "geoip",
+}
+
 
-            if isinstance(r, Atom):
-                node = _atom_to_singbox(r, pol)
-                if node is None:
-                    stats["skipped"] += 1
-                    warnings.append(CompileWarning(file="singbox", line=f"{r.norm_type()},{r.value}", reason="Unsupported type in baseline sing-box compiler"))
-                    continue
-                sb_rules.append(node)
-                stats["emitted"] += 1
-
-    doc = {
-        "_comment": header_comment,
-        "route": {
-            "rules": sb_rules
-        }
-    }
-    text = json.dumps(doc, ensure_ascii=False, indent=2) + "\n"
-    return CompileResult(text=text, warnings=warnings, stats=stats)
-
-
-def _atom_to_singbox(a: Atom, outbound: str) -> Dict[str, Any] | None:
-    t = a.norm_type()
-    v = a.value
-
-    if t == "DOMAIN":
-        return {"domain": [v], "outbound": outbound}
-    if t == "DOMAIN-SUFFIX":
-        return {"domain_suffix": [v], "outbound": outbound}
-    if t == "DOMAIN-KEYWORD":
-        return {"domain_keyword": [v], "outbound": outbound}
+def _atom_to_singbox(t: str, v: str) -> Optional[Tuple[str, Any]]:
+    """(route rule field, value) for an atom of type `t` and value `v`."""
+    if t in _PLAIN_FIELDS:
+        return _PLAIN_FIELDS[t], v
     if t == "DOMAIN-WILDCARD":
+        lowered = lower_wildcard(v)
+        if lowered is not None:
+            return _HOST_FIELDS[lowered[0]], lowered[1]
+        base = subdomain_base(v)
+        if base is not None:
+            # a leading dot matches only below the domain, like the wildcard
+            return "domain_suffix", "." + base
         # sing-box supports domain_regex; convert wildcard to regex crudely
-        # *.example.com -> ^(.+\.)?example\.com$
-        rx = wildcard_to_regex(v)
-        return {"domain_regex": [rx], "outbound": outbound}
+        return _host_field(wildcard_to_regex(v))
     if t == "URL-REGEX":
         # sing-box route has domain_regex but not full URL regex matching in core routing; treat as domain_regex if you pass a domain regex.
-        return {"domain_regex": [v], "outbound": outbound}
-    if t == "IP-CIDR":
-        return {"ip_cidr": [v], "outbound": outbound}
-    if t == "GEOIP":
-        return {"geoip": [v], "outbound": outbound}
+        return _host_field(v)
     if t == "DST-PORT":
-        return {"port": [int(v)], "outbound": outbound}
+        lo, sep, hi = v.partition("-")
+        if not lo.strip().isdigit() or (sep and not hi.strip().isdigit()):
+            return None
+        if sep:
+            return "port_range", f"{int(lo)}:{int(hi)}"
+        return "port", int(lo)
     if t == "IP-ASN":
         # sing-box supports ip_asn in newer builds? not in baseline docs page; skip.
         return None
@@ -92,4 +264,4 @@ def wildcard_to_regex(pat: str) -> str:
     # very small converter
     import re
     s = re.escape(pat).replace(r"\*", ".*")
-    return "^" + s + "$"
\ No newline at end of file
+    return "^" + s + "$"
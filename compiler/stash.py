@@ -0,0 +1,24 @@
+from __future__ import annotations
+
+from typing import Optional
+
+from compiler.base import Capability, CompileResult, TextSink
+from compiler.clash import ProviderWriter, compile_clash
+from compiler.ir import RuleIR
+
+
+# Stash reads Clash-style YAML: rule-providers (behavior domain / ipcidr /
+# classical, format text) referenced by RULE-SET rules, so it gets the same
+# per-policy provider split as compile_clash, checked against Stash's own
+# capabilities and written to dist/stash/. Stash has no .mrs support.
+
+
+def compile_stash(
+    ir: RuleIR,
+    cap: Capability,
+    header_comment: str,
+    base_raw_url: str,
+    out: Optional[TextSink] = None,
+    provider_writer: Optional[ProviderWriter] = None,
+) -> CompileResult:
+    return compile_clash(ir, cap, header_comment, base_raw_url, out, provider_writer, target="stash")
@@ -1,50 +1,118 @@
 from __future__ import annotations
 
-from typing import List, Tuple
+from typing import Callable, Dict, List, Optional
 
 from dsl.ast import Atom, Logical, Rule
-from compiler.base import Capability, CompileResult, CompileWarning, normalize_policy
+from compiler.base import Capability, CompileResult, CompileWarning, TextSink, open_sink, sink_text
+from compiler.ir import PolicyIR, RuleIR
+
+
+# With a set writer, each policy's rules move out of [Rule] into external files
+# the main config references:
+#   DOMAIN-SET,<url>,<policy>   DOMAIN / DOMAIN-SUFFIX without options, one per
+#                               line ("x" or ".x"), matched through Surge's domain
+#                               trie (a domain set line has no room for options)
+#   RULE-SET,<url>,<policy>     every other rule, "TYPE,VALUE[,options]" per line
+# RULE-SET / DOMAIN-SET / SCRIPT rules of the source stay inline (they cannot be
+# nested in a rule set) and FINAL stays last. Every rule of one policy routes to
+# the same policy, so reordering inside it keeps first-match behaviour.
+
+# set writer: (file name, lines) -> URL the main config references
+SetWriter = Callable[[str, List[str]], str]
+
+_INLINE_TYPES = ("RULE-SET", "DOMAIN-SET", "SCRIPT")
 
 
 def compile_surge(
-    rules_by_policy: List[Tuple[str, List[Rule]]],
+    ir: RuleIR,
     cap: Capability,
     header_comment: str,
+    out: Optional[TextSink] = None,
+    set_writer: Optional[SetWriter] = None,
 ) -> CompileResult:
     warnings: List[CompileWarning] = []
-    stats = {"emitted": 0, "skipped": 0}
-
-    lines: List[str] = []
-    lines.append(f"# {header_comment}")
-    lines.append("[Rule]")
-
-    for policy, rules in rules_by_policy:
-        pol = normalize_policy(policy)
-        for r in rules:
-            if isinstance(r, Atom) and r.norm_type() == "FINAL":
-                lines.append(f"FINAL,{pol}")
-                stats["emitted"] += 1
-                continue
-
-            if isinstance(r, Logical):
-                # Surge supports AND/OR/NOT logical rules. [oai_citation:9‡NSSurge Manual](https://manual.nssurge.com/rule/logical-rule.html?utm_source=chatgpt.com)
-                lines.append(f"{_emit_logical(r)},{pol}")
-                stats["emitted"] += 1
-                continue
-
-            if isinstance(r, Atom):
-                lines.append(f"{r.norm_type()},{r.value},{pol}{_emit_opts(r)}")
-                stats["emitted"] += 1
-                continue
-
-            stats["skipped"] += 1
-            warnings.append(CompileWarning(file="surge", line=str(r), reason="Unknown rule node"))
-
-    return CompileResult(text="\n".join(lines) + "\n", warnings=warnings, stats=stats)
+    stats = {"emitted": 0, "skipped": 0, "sets": 0}
+
+    sink, buf = open_sink(out)
+    w = sink.write
+    w(f"# {header_comment}\n")
+    w("[Rule]\n")
+
+    for p in ir:
+        if set_writer is not None:
+            _emit_sets(w, p, set_writer, stats)
+            continue
+        pol = p.policy
+        for run in p.runs:
+            t = run.kind
+            if t == "FINAL":
+                w(f"FINAL,{pol}\n" * len(run))
+            elif run.logical:
+                for r in run.rules:
+                    w(f"{_emit_logical(r)},{pol}\n")
+            else:
+                for r in run.rules:
+                    w(f"{t},{r.value},{pol}{emit_opts(r)}\n")
+            stats["emitted"] += len(run)
+
+    return CompileResult(text=sink_text(buf), warnings=warnings, stats=stats)
+
+
+def _emit_sets(
+    w: Callable[[str], object],
+    p: PolicyIR,
+    set_writer: SetWriter,
+    stats: Dict[str, int],
+) -> None:
+    pol = p.policy
+    domains: Dict[str, None] = {}
+    classical: Dict[str, None] = {}
+    inline: List[str] = []
+    for run in p.runs:
+        t = run.kind
+        rules = run.rules
+        if t == "FINAL":
+            pass
+        elif t in ("DOMAIN", "DOMAIN-SUFFIX"):
+            plain = [r for r in rules if not r.options]
+            if len(plain) != len(rules):
+                classical.update(dict.fromkeys([f"{t},{r.value}{emit_opts(r)}" for r in rules if r.options]))
+            if t == "DOMAIN":
+                domains.update(dict.fromkeys([r.value.strip() for r in plain]))
+            else:
+                domains.update(dict.fromkeys(["." + r.value.strip().lstrip(".") for r in plain]))
+        elif t in _INLINE_TYPES:
+            inline += [f"{t},{r.value},{pol}{emit_opts(r)}" for r in rules]
+        elif run.logical:
+            classical.update(dict.fromkeys([_emit_logical(r) for r in rules]))
+        else:
+            classical.update(dict.fromkeys([f"{t},{r.value}{emit_opts(r)}" for r in rules]))
+        stats["emitted"] += len(rules)
+
+    if domains:
+        w(f"DOMAIN-SET,{set_writer(f'{pol}_domain.txt', list(domains))},{pol}\n")
+        stats["sets"] += 1
+    if classical:
+        w(f"RULE-SET,{set_writer(f'{pol}.list', list(classical))},{pol}\n")
+        stats["sets"] += 1
+    for line in inline:
+        w(line + "\n")
+    if "FINAL" in p.index:
+        w(f"FINAL,{pol}\n")
+
+
+def rule_line(r: Rule) -> Optional[str]:
+    """A rule without its policy and options: "TYPE,VALUE" or a logical expression."""
+    if isinstance(r, Logical):
+        # Surge supports AND/OR/NOT logical rules. [oai_citation:9‡NSSurge Manual](https://manual.nssurge.com/rule/logical-rule.html?utm_source=chatgpt.com)
+        return _emit_logical(r)
+    if isinstance(r, Atom):
+        return f"{r.norm_type()},{r.value}"
+    return None
 
 
-def _emit_opts(a: Atom) -> str:
-    if not a.options:
+def emit_opts(a: Rule) -> str:
+    if not isinstance(a, Atom) or not a.options:
         return ""
     # Surge options: appended as extra params for certain rules/ruleset
     # Keep them as-is
@@ -54,7 +122,7 @@ def _emit_opts(a: Atom) -> str:
 def _emit_logical(l: Logical) -> str:
     op = l.norm_op()
     inner = ",".join(f"({ _emit_any(x) })" for x in l.items)
-    return f"{op},(({inner}))"
+    return f"{op},({inner})"
 
 
 def _emit_any(r: Rule) -> str:
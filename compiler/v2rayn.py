@@ -1,10 +1,13 @@
 from __future__ import annotations
 
-import json
-from typing import Any, Dict, List, Tuple
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
-from dsl.ast import Atom, Logical, Rule
-from compiler.base import Capability, CompileResult, CompileWarning, normalize_policy
+from passes.logic import Term
+from compiler.base import (
+    Capability, CompileResult, CompileWarning, TextSink,
+    json_str, open_sink, sink_text, write_json_array,
+)
+from compiler.ir import PolicyIR, RuleIR, expand_logical
 
 
 # v2ray-core routing rules JSON. [oai_citation:13‡V2Ray](https://www.v2ray.com/en/configuration/routing.html?utm_source=chatgpt.com)
@@ -20,77 +23,208 @@ from compiler.base import Capability, CompileResult, CompileWarning, normalize_p
 #
 # Limitation: v2ray "field" supports domain, ip, port, network, protocol, inboundTag, user, attrs... geoip/geosite via special forms.
 # We'll map what we can:
-# - DOMAIN / DOMAIN-SUFFIX / DOMAIN-KEYWORD -> "domain": ["domain:xxx", "domain:keyword"]
+# - DOMAIN -> "domain": ["full:xxx"], DOMAIN-SUFFIX -> "domain:xxx", DOMAIN-KEYWORD -> "keyword:xxx"
 # - URL-REGEX -> not directly supported -> skip
 # - USER-AGENT -> skip
+# - DOMAIN-WILDCARD / RULE-SET / DOMAIN-SET / SCRIPT / IP-ASN -> skip
 # - GEOIP -> "ip": ["geoip:CN"]
-# - IP-CIDR -> "ip": ["1.2.3.0/24"]
-# - DST-PORT -> "port": "443" (or "80-90")
+# - IP-CIDR / IP-CIDR6 -> "ip": ["1.2.3.0/24"]
+# - DST-PORT -> "port": "443,80-90"
 # - FINAL -> add a catch-all rule at end (no domain/ip => matches all) as fallback
+#
+# v2ray ANDs the fields of one rule and ORs the values inside a field, so each
+# policy compiles to at most one rule per field:
+#   {domain: [...]}, {ip: [...]}, {port: "..."}, {} (FINAL)
+# Every rule of one policy file routes to the same outboundTag, so merging them
+# keeps first-match behaviour; only the policy order has to be kept.
+#
+# AND/OR/NOT rules are expanded into the terms of their OR (passes.logic): a
+# term of one atom joins the policy's merged rules, and a term ANDing atoms of
+# different fields (DOMAIN-SUFFIX and DST-PORT, say) becomes a field rule of
+# its own, after the merged ones. Negations and terms ANDing two atoms of one
+# field cannot be written and are skipped.
+#
+# With a geosite writer, a policy's domain list goes into a geosite-format .dat
+# instead (see encode_geosite) and the domain rule references it as
+# "ext:<file>:<tag>", which v2ray loads into its indexed domain matcher.
+
+# geosite writer: (policy, [(domain type, value)]) -> "ext:<file>:<tag>" reference
+GeositeWriter = Callable[[str, List[Tuple[int, str]]], str]
+
+# routercommon.Domain.Type
+GEOSITE_PLAIN, GEOSITE_REGEX, GEOSITE_DOMAIN, GEOSITE_FULL = 0, 1, 2, 3
+
+_DOMAIN_PREFIX = {GEOSITE_PLAIN: "keyword:", GEOSITE_REGEX: "regexp:", GEOSITE_DOMAIN: "domain:", GEOSITE_FULL: "full:"}
+
 
 def compile_v2rayn(
-    rules_by_policy: List[Tuple[str, List[Rule]]],
+    ir: RuleIR,
     cap: Capability,
     header_comment: str,
+    out: Optional[TextSink] = None,
+    geosite_writer: Optional[GeositeWriter] = None,
 ) -> CompileResult:
     warnings: List[CompileWarning] = []
-    stats = {"emitted": 0, "skipped": 0}
-
-    vrules: List[Dict[str, Any]] = []
-
-    for policy, rules in rules_by_policy:
-        pol = normalize_policy(policy)
-
-        for r in rules:
-            if isinstance(r, Atom) and r.norm_type() == "FINAL":
-                vrules.append({
-                    "type": "field",
-                    "outboundTag": pol
-                })
-                stats["emitted"] += 1
-                continue
-
-            if isinstance(r, Logical):
-                stats["skipped"] += 1
-                warnings.append(CompileWarning(file="v2rayn", line=str(r), reason="AND/OR/NOT not supported in v2ray field rules"))
-                continue
-
-            if isinstance(r, Atom):
-                node = _atom_to_v2ray_field(r, pol)
-                if node is None:
-                    stats["skipped"] += 1
-                    warnings.append(CompileWarning(file="v2rayn", line=f"{r.norm_type()},{r.value}", reason="Unsupported type in v2ray routing"))
-                    continue
-                vrules.append(node)
-                stats["emitted"] += 1
-
-    doc = {
-        "_comment": header_comment,
-        "routing": {
-            "domainStrategy": "AsIs",
-            "rules": vrules
-        }
-    }
-    text = json.dumps(doc, ensure_ascii=False, indent=2) + "\n"
-    return CompileResult(text=text, warnings=warnings, stats=stats)
-
-
-def _atom_to_v2ray_field(a: Atom, outbound: str) -> Dict[str, Any] | None:
-    t = a.norm_type()
-    v = a.value
+    stats = {"emitted": 0, "skipped": 0, "field_rules": 0}
+
+    sink, buf = open_sink(out)
+    w = sink.write
+    w("{\n")
+    w(f'  "_comment": {json_str(header_comment)},\n')
+    w('  "routing": {\n')
+    w('    "domainStrategy": "AsIs",\n')
+    w('    "rules": ')
+    write_json_array(w, _iter_field_rules(ir, warnings, stats, geosite_writer), 2)
+    w("\n  }\n}\n")
+    return CompileResult(text=sink_text(buf), warnings=warnings, stats=stats)
+
+
+def _iter_field_rules(
+    ir: RuleIR,
+    warnings: List[CompileWarning],
+    stats: Dict[str, int],
+    geosite_writer: Optional[GeositeWriter],
+) -> Iterator[Dict[str, Any]]:
+    for p in ir:
+        pol = p.policy
+        domains, ips, ports, combined, final = _collect_policy(p, warnings, stats)
+
+        if domains:
+            if geosite_writer is not None:
+                values = [geosite_writer(pol, domains)]
+            else:
+                values = [_DOMAIN_PREFIX[t] + v for t, v in domains]
+            yield {"type": "field", "domain": values, "outboundTag": pol}
+            stats["field_rules"] += 1
+        if ips:
+            yield {"type": "field", "ip": ips, "outboundTag": pol}
+            stats["field_rules"] += 1
+        if ports:
+            yield {"type": "field", "port": ",".join(ports), "outboundTag": pol}
+            stats["field_rules"] += 1
+        for fields in combined:
+            node: Dict[str, Any] = {"type": "field"}
+            if "domain" in fields:
+                t, v = fields["domain"]
+                node["domain"] = [_DOMAIN_PREFIX[t] + v]
+            if "ip" in fields:
+                node["ip"] = [fields["ip"]]
+            if "port" in fields:
+                node["port"] = fields["port"]
+            node["outboundTag"] = pol
+            yield node
+            stats["field_rules"] += 1
+        if final:
+            yield {"type": "field", "outboundTag": pol}
+            stats["field_rules"] += 1
+
+
+def _collect_policy(
+    p: PolicyIR,
+    warnings: List[CompileWarning],
+    stats: Dict[str, int],
+) -> Tuple[List[Tuple[int, str]], List[str], List[str], List[Dict[str, Any]], bool]:
+    """
+    Domain, ip and port values (deduplicated, in source order) of one policy,
+    the {field: value} of its AND terms, and whether it has a FINAL.
+    """
+    fields: Dict[str, Dict[Any, None]] = {"domain": {}, "ip": {}, "port": {}}
+    combined: Dict[Tuple[Tuple[str, Any], ...], None] = {}
+    for run in p.runs:
+        t = run.kind
+        if t == "FINAL":
+            stats["emitted"] += len(run)
+            continue
 
+        if run.logical:
+            for r, terms in zip(run.rules, run.disjuncts()):
+                ok = expand_logical("v2rayn", r, terms, lambda term: _add_term(fields, combined, term), warnings)
+                stats["emitted" if ok else "skipped"] += 1
+            continue
+
+        field = _run_field(t, [r.value.strip() for r in run.rules])
+        if field is None:
+            stats["skipped"] += len(run)
+            warnings += [CompileWarning(file="v2rayn", line=f"{t},{r.value}", reason="Unsupported type in v2ray routing") for r in run.rules]
+            continue
+        fields[field[0]].update(dict.fromkeys(field[1]))
+        stats["emitted"] += len(run)
+    return list(fields["domain"]), list(fields["ip"]), list(fields["port"]), [dict(c) for c in combined], "FINAL" in p.index
+
+
+def _add_term(
+    fields: Dict[str, Dict[Any, None]],
+    combined: Dict[Tuple[Tuple[str, Any], ...], None],
+    t: Term,
+) -> Optional[str]:
+    node: Dict[str, Any] = {}
+    for a, neg in t:
+        if neg:
+            return "v2ray field rules cannot negate a rule"
+        field = _run_field(a.rtype, [a.value.strip()])
+        if field is None:
+            return f"Unsupported type in v2ray routing: {a.rtype}"
+        if field[0] in node:
+            # the values of one field are OR-ed
+            return f"v2ray field rules cannot AND two {field[0]} values"
+        node[field[0]] = field[1][0]
+    if len(node) == 1:
+        ((name, value),) = node.items()
+        fields[name][value] = None
+    elif node:
+        combined[tuple(node.items())] = None
+    else:
+        return "v2ray field rules cannot express an empty AND"
+    return None
+
+
+def _run_field(t: str, values: List[str]) -> Optional[Tuple[str, List[Any]]]:
+    """(field, field values) for stripped values of type `t`; domain values are (geosite type, domain)."""
     if t == "DOMAIN":
-        return {"type": "field", "domain": [f"domain:{v}"], "outboundTag": outbound}
+        return "domain", [(GEOSITE_FULL, v) for v in values]
     if t == "DOMAIN-SUFFIX":
-        return {"type": "field", "domain": [f"domain:{v}"], "outboundTag": outbound}
+        return "domain", [(GEOSITE_DOMAIN, v.lstrip(".")) for v in values]
     if t == "DOMAIN-KEYWORD":
-        return {"type": "field", "domain": [f"keyword:{v}"], "outboundTag": outbound}
-    if t == "IP-CIDR":
-        return {"type": "field", "ip": [v], "outboundTag": outbound}
+        return "domain", [(GEOSITE_PLAIN, v) for v in values]
+    if t in ("IP-CIDR", "IP-CIDR6"):
+        return "ip", values
     if t == "GEOIP":
-        return {"type": "field", "ip": [f"geoip:{v}"], "outboundTag": outbound}
+        return "ip", [f"geoip:{v}" for v in values]
     if t == "DST-PORT":
-        return {"type": "field", "port": str(v), "outboundTag": outbound}
-    if t in ("URL-REGEX", "USER-AGENT", "DOMAIN-WILDCARD", "RULE-SET", "DOMAIN-SET", "SCRIPT", "IP-ASN"):
-        return None
-    return None
\ No newline at end of file
+        return "port", [v.replace(" ", "") for v in values]
+    return None
+
+
+# ---- geosite .dat ----
+#
+# v2ray's geosite files are a serialized routercommon.GeoSiteList:
+#   GeoSiteList { repeated GeoSite entry = 1; }
+#   GeoSite     { string country_code = 1; repeated Domain domain = 2; }
+#   Domain      { Type type = 1; string value = 2; }
+# Encoded by hand so the build does not need protobuf.
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _field_bytes(num: int, data: bytes) -> bytes:
+    # wire type 2: length-delimited
+    return _varint(num << 3 | 2) + _varint(len(data)) + data
+
+
+def encode_geosite(entries: List[Tuple[str, List[Tuple[int, str]]]]) -> bytes:
+    """GeoSiteList bytes for [(tag, [(domain type, value)])]."""
+    parts: List[bytes] = []
+    for tag, domains in entries:
+        site = [_field_bytes(1, tag.encode("utf-8"))]
+        for t, v in domains:
+            # type 0 (Plain) is the proto3 default and is left out
+            dom = (_varint(1 << 3) + _varint(t) if t else b"") + _field_bytes(2, v.encode("utf-8"))
+            site.append(_field_bytes(2, dom))
+        parts.append(_field_bytes(1, b"".join(site)))
+    return b"".join(parts)
@@ -1,31 +1,96 @@
 from __future__ import annotations
 
-from dataclasses import dataclass, field
-from typing import List, Optional, Sequence
+import sys
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional, Sequence
+
+
+# Rule types / logical ops are normalized (strip + upper) and interned once at
+# construction, so every compiler can compare them by identity-cheap equality
+# instead of re-normalizing per call.
+_NAME_CACHE: Dict[str, str] = {}
+_NAME_CACHE_MAX = 4096
+
+
+def norm_name(name: str) -> str:
+    try:
+        return _NAME_CACHE[name]
+    except KeyError:
+        pass
+    n = sys.intern(name.strip().upper())
+    if len(_NAME_CACHE) < _NAME_CACHE_MAX:
+        _NAME_CACHE[name] = n
+    return n
 
 
-@dataclass(frozen=True)
 class Rule:
-    """Base class."""
+    """
+    Base class. Nodes are immutable and slotted; `lineno` is the 1-based source
+    line of a top-level rule (0 when unknown) and takes no part in equality.
+    """
+    __slots__ = ("lineno",)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+
+_set = object.__setattr__
 
 
-@dataclass(frozen=True)
 class Atom(Rule):
-    rtype: str
-    value: str = ""
-    options: Sequence[str] = field(default_factory=tuple)
+    __slots__ = ("rtype", "value", "options")
+
+    def __init__(self, rtype: str, value: str = "", options: Sequence[str] = (), lineno: int = 0):
+        _set(self, "rtype", norm_name(rtype))
+        _set(self, "value", value)
+        _set(self, "options", options if type(options) is tuple else tuple(options))
+        _set(self, "lineno", lineno)
 
     def norm_type(self) -> str:
-        return self.rtype.strip().upper()
+        return self.rtype
+
+    def __eq__(self, other):
+        if type(other) is not Atom:
+            return NotImplemented
+        return self.rtype == other.rtype and self.value == other.value and self.options == other.options
+
+    def __hash__(self):
+        return hash((self.rtype, self.value, self.options))
+
+    def __repr__(self):
+        return f"Atom(rtype={self.rtype!r}, value={self.value!r}, options={self.options!r})"
+
+    def __reduce__(self):
+        return (Atom, (self.rtype, self.value, self.options, self.lineno))
 
 
-@dataclass(frozen=True)
 class Logical(Rule):
-    op: str  # AND / OR / NOT
-    items: List[Rule]
+    __slots__ = ("op", "items")
+
+    def __init__(self, op: str, items: Iterable[Rule], lineno: int = 0):  # op: AND / OR / NOT
+        _set(self, "op", norm_name(op))
+        _set(self, "items", tuple(items))
+        _set(self, "lineno", lineno)
 
     def norm_op(self) -> str:
-        return self.op.strip().upper()
+        return self.op
+
+    def __eq__(self, other):
+        if type(other) is not Logical:
+            return NotImplemented
+        return self.op == other.op and self.items == other.items
+
+    def __hash__(self):
+        return hash((self.op, self.items))
+
+    def __repr__(self):
+        return f"Logical(op={self.op!r}, items={list(self.items)!r})"
+
+    def __reduce__(self):
+        return (Logical, (self.op, self.items, self.lineno))
 
 
 @dataclass(frozen=True)
@@ -33,3 +98,18 @@ class ParsedLine:
     raw: str
     rule: Optional[Rule]
     error: Optional[str] = None
+
+
+
+def rule_text(rule: Rule) -> str:
+    """Render a rule back to a DSL line (commas inside values are re-escaped)."""
+    if isinstance(rule, Logical):
+        inner = ",".join(f"({rule_text(x)})" for x in rule.items)
+        return f"{rule.op},({inner})"
+    if isinstance(rule, Atom):
+        if not rule.value and not rule.options:
+            return rule.rtype
+        parts = [rule.rtype, rule.value.replace(",", "\\,")]
+        parts.extend(rule.options)
+        return ",".join(parts)
+    return repr(rule)
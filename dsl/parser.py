@@ -1,13 +1,32 @@
 from __future__ import annotations
 
+import mmap
+import os
 import re
-from typing import List, Optional, Tuple
+from typing import Iterable, Iterator, List, Optional, Tuple
 
 from .ast import Atom, Logical, ParsedLine, Rule
 
 _COMMENT_RE = re.compile(r"^\s*(#|;)")
 _WS = re.compile(r"\s+")
 
+# byte values used by the mmap scanner to skip blank/comment lines without decoding them
+_BLANK_BYTES = frozenset(b" \t\r\f\v")
+_COMMENT_BYTES = frozenset(b"#;")
+
+
+class RuleSyntaxError(ValueError):
+    """A rule line that could not be parsed; carries its 1-based source line number."""
+
+    def __init__(self, lineno: int, raw: str, reason: str):
+        super().__init__(f"line {lineno}: {reason}")
+        self.lineno = lineno
+        self.raw = raw
+        self.reason = reason
+
+    def __reduce__(self):
+        return (RuleSyntaxError, (self.lineno, self.raw, self.reason))
+
 
 def parse_lines(text: str) -> List[ParsedLine]:
     out: List[ParsedLine] = []
@@ -24,78 +43,130 @@ def parse_lines(text: str) -> List[ParsedLine]:
     return out
 
 
-def parse_rule(line: str) -> Rule:
+def iter_rules(lines: Iterable[str], first_lineno: int = 1) -> Iterator[Tuple[int, Rule]]:
+    """
+    Streaming counterpart of parse_lines: consume any iterable of lines (e.g. an open
+    text file) and yield (lineno, rule) for rule lines only. Blank and comment lines
+    are dropped; the first bad line raises RuleSyntaxError. `first_lineno` numbers
+    the first line, for re-parsing a slice of a file.
+    """
+    lineno = first_lineno - 1
+    for raw in lines:
+        lineno += 1
+        line = raw.strip()
+        if not line or line[0] in "#;":
+            continue
+        yield lineno, _parse_checked(lineno, raw, line)
+
+
+def iter_file_rules(path: "os.PathLike[str] | str") -> Iterator[Tuple[int, Rule]]:
+    """
+    Like iter_rules, but scans a memory-mapped file. Comment and blank lines are
+    skipped on the raw bytes, so only rule lines are ever decoded.
+    """
+    with open(path, "rb") as fh:
+        size = os.fstat(fh.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = 0
+            lineno = 0
+            while pos < size:
+                lineno += 1
+                end = mm.find(b"\n", pos)
+                if end < 0:
+                    end = size
+                i = pos
+                while i < end and mm[i] in _BLANK_BYTES:
+                    i += 1
+                if i < end and mm[i] not in _COMMENT_BYTES:
+                    raw = mm[pos:end].decode("utf-8")
+                    line = raw.strip()
+                    # non-ASCII whitespace is only visible after decoding
+                    if line and line[0] not in "#;":
+                        yield lineno, _parse_checked(lineno, raw, line)
+                pos = end + 1
+
+
+def _parse_checked(lineno: int, raw: str, line: str) -> Rule:
+    try:
+        return parse_rule(line, lineno)
+    except Exception as e:
+        raise RuleSyntaxError(lineno, raw, str(e)) from e
+
+
+def parse_rule(line: str, lineno: int = 0) -> Rule:
+    head, sep, rest = line.partition(",")
+    head = head.strip().upper()
+
     # FINAL special
-    if line.strip().upper() == "FINAL":
-        return Atom("FINAL", "")
+    if not sep and head == "FINAL":
+        return Atom("FINAL", "", lineno=lineno)
 
     # Logical rules: AND,((...)), OR,((...)), NOT,((...))
-    head = line.split(",", 1)[0].strip().upper()
     if head in ("AND", "OR", "NOT"):
-        return _parse_logical(line)
+        return _parse_logical(head, rest.strip(), line, lineno)
 
     # Atom: TYPE,VALUE[,OPTION...]
+    if not sep:
+        return Atom(rtype=line.strip(), value="", lineno=lineno)
     parts = _split_csv_like(line)
-    if len(parts) < 1:
-        raise ValueError("Empty rule")
     rtype = parts[0].strip()
     value = parts[1].strip() if len(parts) >= 2 else ""
     opts = tuple(p.strip() for p in parts[2:]) if len(parts) >= 3 else tuple()
-    return Atom(rtype=rtype, value=value, options=opts)
+    return Atom(rtype=rtype, value=value, options=opts, lineno=lineno)
 
 
-def _parse_logical(line: str) -> Rule:
+def _parse_logical(op: str, payload: str, line: str, lineno: int) -> Rule:
     # Expect: OP,((<RULE>),(<RULE>),...)
-    parts = _split_csv_like(line, maxsplit=1)
-    if len(parts) != 2:
+    if not payload:
         raise ValueError(f"Logical rule must be 'OP,((...))': {line}")
-    op = parts[0].strip().upper()
-    payload = parts[1].strip()
 
     # payload like: ((...),(....))
     if not (payload.startswith("((") and payload.endswith("))")):
         raise ValueError(f"Logical payload must start with '(( ' and end with ' ))': {line}")
 
-    inner = payload[2:-2].strip()
+    # drop the outer pair only, leaving "(<RULE>),(<RULE>)"; escapes inside the
+    # items are left for the recursive parse_rule calls
+    inner = payload[1:-1].strip()
     # split top-level "(...)" items by commas, respecting nesting
     items_raw = _split_top_level_items(inner)
     items: List[Rule] = []
     for it in items_raw:
-        it = it.strip()
         if not (it.startswith("(") and it.endswith(")")):
             raise ValueError(f"Each logical item must be wrapped by (): {it}")
         sub = it[1:-1].strip()
         items.append(parse_rule(sub))
     if op == "NOT" and len(items) != 1:
         raise ValueError("NOT must contain exactly one sub-rule")
-    return Logical(op=op, items=items)
+    return Logical(op=op, items=items, lineno=lineno)
+
+
+_DELIM_RE = re.compile(r"[(),]")
 
 
 def _split_top_level_items(s: str) -> List[str]:
+    """
+    Split "(a),(b,(c))" on the commas at paren depth 0. Only the delimiter
+    positions are visited; the text between them is sliced, never copied per char.
+    """
     out: List[str] = []
-    buf: List[str] = []
     depth = 0
-    i = 0
-    while i < len(s):
-        c = s[i]
+    start = 0
+    for m in _DELIM_RE.finditer(s):
+        c = m.group()
         if c == "(":
             depth += 1
-            buf.append(c)
         elif c == ")":
             depth -= 1
             if depth < 0:
                 raise ValueError("Unbalanced parentheses")
-            buf.append(c)
-        elif c == "," and depth == 0:
-            out.append("".join(buf).strip())
-            buf = []
-        else:
-            buf.append(c)
-        i += 1
+        elif depth == 0:
+            out.append(s[start:m.start()].strip())
+            start = m.end()
     if depth != 0:
         raise ValueError("Unbalanced parentheses in logical items")
-    if buf:
-        out.append("".join(buf).strip())
+    out.append(s[start:].strip())
     return [x for x in out if x]
 
 
@@ -104,23 +175,23 @@ def _split_csv_like(s: str, maxsplit: Optional[int] = None) -> List[str]:
     Split by commas but support escaping '\,'.
     Also does not treat parentheses specially (handled by logical parser).
     """
+    if "\\" not in s:
+        return s.split(",") if maxsplit is None else s.split(",", maxsplit)
+
+    # slow path: "\," can only sit at a piece boundary, so glue pieces back
+    # together wherever the left one ends in a backslash
+    pieces = s.split(",")
     res: List[str] = []
-    cur: List[str] = []
-    i = 0
-    splits = 0
-    while i < len(s):
-        c = s[i]
-        if c == "\\" and i + 1 < len(s) and s[i + 1] == ",":
-            cur.append(",")
-            i += 2
-            continue
-        if c == "," and (maxsplit is None or splits < maxsplit):
-            res.append("".join(cur))
-            cur = []
-            splits += 1
-            i += 1
+    cur = pieces[0]
+    for i in range(1, len(pieces)):
+        if cur.endswith("\\"):
+            cur = cur[:-1] + "," + pieces[i]
             continue
-        cur.append(c)
-        i += 1
-    res.append("".join(cur))
+        if maxsplit is not None and len(res) >= maxsplit:
+            rest = ",".join(pieces[i:]).replace("\\,", ",")
+            res.append(cur + "," + rest)
+            return res
+        res.append(cur)
+        cur = pieces[i]
+    res.append(cur)
     return res
@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+from array import array
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+from .ast import Atom, Rule
+
+
+class RuleTable:
+    """
+    Columnar storage for large atom-only rule lists.
+
+    Row i is described by three parallel arrays: a type code, an index into the
+    deduplicated value pool and a policy index. Options are rare, so they live in
+    a sparse row -> options dict. Walking the table touches machine ints and
+    shared strings instead of one Python object per rule.
+    """
+    __slots__ = (
+        "types", "values", "policies",
+        "type_codes", "value_idx", "policy_idx", "linenos", "options",
+        "_type_ix", "_value_ix", "_policy_ix",
+    )
+
+    def __init__(self):
+        self.types: List[str] = []
+        self.values: List[str] = []
+        self.policies: List[str] = []
+        self.type_codes = array("H")
+        self.value_idx = array("I")
+        self.policy_idx = array("H")
+        self.linenos = array("I")
+        self.options: Dict[int, Tuple[str, ...]] = {}
+        self._type_ix: Dict[str, int] = {}
+        self._value_ix: Dict[str, int] = {}
+        self._policy_ix: Dict[str, int] = {}
+
+    @classmethod
+    def from_rules(cls, rules_by_policy: Sequence[Tuple[str, Sequence[Rule]]]) -> "RuleTable":
+        t = cls()
+        for policy, rules in rules_by_policy:
+            for r in rules:
+                t.append(policy, r)
+        return t
+
+    def __len__(self) -> int:
+        return len(self.type_codes)
+
+    def append(self, policy: str, rule: Rule) -> None:
+        if type(rule) is not Atom:
+            raise TypeError(f"RuleTable only stores atoms, got {rule!r}")
+        row = len(self.type_codes)
+        if self.values and not self._value_ix:
+            self._value_ix = {v: i for i, v in enumerate(self.values)}
+        self.type_codes.append(_code(self.types, self._type_ix, rule.rtype))
+        self.value_idx.append(_code(self.values, self._value_ix, rule.value))
+        self.policy_idx.append(_code(self.policies, self._policy_ix, policy))
+        self.linenos.append(rule.lineno)
+        if rule.options:
+            self.options[row] = rule.options
+
+    def columns(self) -> tuple:
+        """
+        The table as values marshal can write:
+        (types, values, policies, type_codes, value_idx, policy_idx, linenos, options)
+        with the arrays as bytes; from_columns() reads it back.
+        """
+        return (
+            self.types, self.values, self.policies,
+            self.type_codes.tobytes(), self.value_idx.tobytes(), self.policy_idx.tobytes(), self.linenos.tobytes(),
+            self.options,
+        )
+
+    @classmethod
+    def from_columns(cls, cols: tuple) -> "RuleTable":
+        t = cls()
+        t.types, t.values, t.policies, type_codes, value_idx, policy_idx, linenos, t.options = cols
+        t.type_codes.frombytes(type_codes)
+        t.value_idx.frombytes(value_idx)
+        t.policy_idx.frombytes(policy_idx)
+        t.linenos.frombytes(linenos)
+        t._type_ix = {s: i for i, s in enumerate(t.types)}
+        t._policy_ix = {s: i for i, s in enumerate(t.policies)}
+        return t
+
+    def compact(self) -> "RuleTable":
+        """Drop the value lookup index once the table is complete; append() rebuilds it."""
+        self._value_ix = {}
+        return self
+
+    def atom(self, row: int) -> Atom:
+        return Atom(
+            self.types[self.type_codes[row]],
+            self.values[self.value_idx[row]],
+            self.options.get(row, ()),
+            self.linenos[row],
+        )
+
+    def atoms(self) -> List[Atom]:
+        """Every row as an Atom, in row order."""
+        types, values, opts = self.types, self.values, self.options
+        if not opts:
+            return [Atom(types[tc], values[vi], (), ln) for tc, vi, ln in zip(self.type_codes, self.value_idx, self.linenos)]
+        get = opts.get
+        return [
+            Atom(types[tc], values[vi], get(row, ()), ln)
+            for row, (tc, vi, ln) in enumerate(zip(self.type_codes, self.value_idx, self.linenos))
+        ]
+
+    def policy(self, row: int) -> str:
+        return self.policies[self.policy_idx[row]]
+
+    def rows(self) -> Iterator[Tuple[str, str, str, Tuple[str, ...]]]:
+        """Yield (policy, rtype, value, options) per row without building Atom objects."""
+        types, values, policies, opts = self.types, self.values, self.policies, self.options
+        for row, (tc, vi, pi) in enumerate(zip(self.type_codes, self.value_idx, self.policy_idx)):
+            yield policies[pi], types[tc], values[vi], opts.get(row, ())
+
+    def runs(self) -> Iterator[Tuple[str, str, List[str]]]:
+        """
+        Yield (policy, rtype, values) for each maximal run of consecutive rows that
+        share policy and type and carry no options. Rows with options form runs of one.
+        """
+        types, values, policies, opts = self.types, self.values, self.policies, self.options
+        cur_key = None
+        cur: List[str] = []
+        for row, (tc, vi, pi) in enumerate(zip(self.type_codes, self.value_idx, self.policy_idx)):
+            key = (pi, tc) if row not in opts else None
+            if key is None or key != cur_key:
+                if cur:
+                    yield policies[cur_key[0]], types[cur_key[1]], cur
+                cur = []
+                cur_key = key
+            if key is None:
+                yield policies[pi], types[tc], [values[vi]]
+                continue
+            cur.append(values[vi])
+        if cur:
+            yield policies[cur_key[0]], types[cur_key[1]], cur
+
+    def to_rules_by_policy(self) -> List[Tuple[str, List[Rule]]]:
+        out: List[Tuple[str, List[Rule]]] = []
+        last = -1
+        for row in range(len(self.type_codes)):
+            pi = self.policy_idx[row]
+            if pi != last:
+                out.append((self.policies[pi], []))
+                last = pi
+            out[-1][1].append(self.atom(row))
+        return out
+
+
+def _code(pool: List[str], index: Dict[str, int], s: str) -> int:
+    i = index.get(s)
+    if i is None:
+        i = index[s] = len(pool)
+        pool.append(s)
+    return i
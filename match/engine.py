@@ -0,0 +1,645 @@
+from __future__ import annotations
+
+import re
+import socket
+from bisect import bisect_right
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from dsl.ast import Atom, Logical, Rule
+from passes.cidr import parse_cidr
+
+
+# Local first-match evaluation of a parsed rule set.
+#
+# Every rule gets a global rank (its position when the policy files are read in
+# order), and a lookup returns the smallest rank that matches. Each rule type
+# lives in an index that can report the smallest matching rank directly:
+#   DOMAIN / DOMAIN-SUFFIX   flat reversed-label trie (dict keyed by dotted suffix)
+#   DOMAIN-KEYWORD           Aho-Corasick automaton, behind a C-level regex prefilter
+#   IP-CIDR / IP-CIDR6       path-compressed binary radix tree per address family,
+#                            flattened to sorted ranges once built
+#   DST-PORT                 dict of single ports plus a short list of ranges
+#   FINAL                    a single rank
+# A logical rule is a precompiled predicate filed under a "gate": an atom of one
+# of the indexed types that must match whenever the rule does (the first
+# indexable operand of an AND, every operand of an OR). The gates live in
+# indexes of their own, and a lookup only evaluates the rules whose gate it hit.
+# Everything else (DOMAIN-WILDCARD, URL-REGEX, USER-AGENT, NOT and other logical
+# rules without a gate, and the DOMAIN-REGEX used for client configs read back
+# by match.readers) is a predicate in a rank-ordered list per probe field it
+# needs, only tried while it could still beat the best rank found so far.
+#
+# Nothing is resolved: IP rules only see an IP that is part of the probe, so
+# no-resolve makes no difference here. GEOIP, IP-ASN, RULE-SET, DOMAIN-SET and
+# SCRIPT need data this engine does not have and never match; they are counted
+# in Matcher.unsupported.
+
+NO_MATCH = 1 << 62
+
+
+class Probe(NamedTuple):
+    host: Optional[str] = None              # lower-case, no trailing dot
+    ip: Optional[Tuple[int, int]] = None    # (version, integer address)
+    port: Optional[int] = None
+    url: Optional[str] = None
+    ua: Optional[str] = None
+
+
+class Match(NamedTuple):
+    policy: str
+    rule: Rule
+    file: str
+    lineno: int
+
+
+def parse_ip(text: str) -> Optional[Tuple[int, int]]:
+    family, version = (socket.AF_INET6, 6) if ":" in text else (socket.AF_INET, 4)
+    try:
+        return version, int.from_bytes(socket.inet_pton(family, text), "big")
+    except OSError:
+        return None
+
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def parse_probe(text: str) -> Probe:
+    """
+    Probe for one query token: a host name or IP, optionally with :port
+    ([v6]:port for IPv6), or a full http(s) URL.
+    """
+    text = text.strip()
+    if ":" not in text and "/" not in text:
+        # bare host name or IPv4 address, by far the common case
+        if text[-1:].isdigit():
+            ip = parse_ip(text)
+            if ip is not None:
+                return Probe(None, ip)
+        return Probe(text.lower().rstrip(".") or None)
+    url = None
+    scheme, sep, rest = text.partition("://")
+    if sep:
+        url = text
+        text = rest.split("/", 1)[0].split("?", 1)[0].rpartition("@")[2]
+    port = None
+    if text.startswith("["):
+        addr, _, tail = text[1:].partition("]")
+        if tail.startswith(":") and tail[1:].isdigit():
+            port = int(tail[1:])
+        text = addr
+    elif text.count(":") == 1:
+        head, _, tail = text.partition(":")
+        if tail.isdigit():
+            text, port = head, int(tail)
+    if port is None and url is not None:
+        port = _DEFAULT_PORTS.get(scheme.lower())
+    ip = parse_ip(text) if text and (text[-1].isdigit() or ":" in text) else None
+    if ip is not None:
+        return Probe(None, ip, port, url)
+    host = text.lower().rstrip(".")
+    return Probe(host or None, None, port, url)
+
+
+def _literal_regex(words: Iterable[str]) -> "re.Pattern[str]":
+    """
+    Regex matching any of `words`, shaped as their prefix trie (ad(?:s|min)
+    rather than ads|admin) so the regex engine never retries a shared prefix.
+    """
+    words = list(words)
+    trie: Dict[str, dict] = {}
+    for w in words:
+        node = trie
+        for ch in w:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def emit(node: Dict[str, dict]) -> str:
+        alts = [re.escape(ch) + emit(child) for ch, child in sorted(node.items()) if ch]
+        if not alts:
+            return ""
+        body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        if "" in node:
+            return (body if len(alts) > 1 else "(?:" + body + ")") + "?"
+        return body
+
+    try:
+        return re.compile(emit(trie))
+    except (RecursionError, re.error):  # a keyword of hundreds of characters
+        return re.compile("|".join(re.escape(w) for w in sorted(words, key=len, reverse=True)))
+
+
+class _AhoCorasick:
+    """Keyword automaton whose states carry the smallest rank of any keyword ending there."""
+
+    def __init__(self, words: Dict[str, int]):
+        goto: List[Dict[str, int]] = [{}]
+        out: List[int] = [NO_MATCH]
+        for w, rank in words.items():
+            s = 0
+            for ch in w:
+                nxt = goto[s].get(ch)
+                if nxt is None:
+                    nxt = goto[s][ch] = len(goto)
+                    goto.append({})
+                    out.append(NO_MATCH)
+                s = nxt
+            if rank < out[s]:
+                out[s] = rank
+        # breadth-first, so a state's fail target (always shallower) is final first
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        for s in queue:
+            for ch, t in goto[s].items():
+                queue.append(t)
+                if s:
+                    f = fail[s]
+                    while f and ch not in goto[f]:
+                        f = fail[f]
+                    fail[t] = goto[f].get(ch, 0)
+                if out[fail[t]] < out[t]:
+                    out[t] = out[fail[t]]
+        self._goto = goto
+        self._fail = fail
+        self._out = out
+        # most hosts contain no keyword at all; let the regex engine say so in C
+        self._rx = _literal_regex(words)
+
+    def min_rank(self, text: str) -> int:
+        if self._rx.search(text) is None:
+            return NO_MATCH
+        goto, fail, out = self._goto, self._fail, self._out
+        best = NO_MATCH
+        s = 0
+        for ch in text:
+            while s and ch not in goto[s]:
+                s = fail[s]
+            s = goto[s].get(ch, 0)
+            if out[s] < best:
+                best = out[s]
+        return best
+
+
+class _RadixTree:
+    """
+    Path-compressed binary trie of prefixes. A node is [network, prefix length,
+    rank, child0, child1]; glue nodes created by splits have rank NO_MATCH.
+
+    Walking the tree costs one Python step per level, and random prefixes give
+    it log2(n) levels, so freeze() flattens it into sorted range starts with the
+    smallest covering rank of each range; a lookup is then one bisect.
+    """
+
+    def __init__(self, bits: int):
+        self.bits = bits
+        self.root: Optional[list] = None
+        self._starts: List[int] = [0]
+        self._ranks: List[int] = [NO_MATCH]
+
+    def insert(self, net: int, plen: int, rank: int) -> None:
+        bits = self.bits
+        new = [net, plen, rank, None, None]
+        if self.root is None:
+            self.root = new
+            return
+        parent, side, cur = None, 0, self.root
+        while True:
+            cplen = cur[1]
+            diff = (net ^ cur[0]).bit_length()
+            common = min(bits - diff, plen, cplen)
+            if common == cplen and common == plen:
+                if rank < cur[2]:
+                    cur[2] = rank
+                return
+            if common == cplen:
+                # cur is a prefix of the new network: descend
+                b = 3 + ((net >> (bits - 1 - cplen)) & 1)
+                if cur[b] is None:
+                    cur[b] = new
+                    return
+                parent, side, cur = cur, b, cur[b]
+                continue
+            if common == plen:
+                # the new network is a prefix of cur: insert above it
+                new[3 + ((cur[0] >> (bits - 1 - plen)) & 1)] = cur
+                node = new
+            else:
+                # diverge below `common`: glue node with both as children
+                glue_net = net >> (bits - common) << (bits - common)
+                node = [glue_net, common, NO_MATCH, None, None]
+                node[3 + ((net >> (bits - 1 - common)) & 1)] = new
+                node[3 + ((cur[0] >> (bits - 1 - common)) & 1)] = cur
+            if parent is None:
+                self.root = node
+            else:
+                parent[side] = node
+            return
+
+    def freeze(self) -> None:
+        bits = self.bits
+        bounds: List[Tuple[int, int]] = [(0, NO_MATCH)]
+
+        def mark(start: int, rank: int) -> None:
+            if bounds[-1][0] == start:
+                bounds[-1] = (start, rank)
+            else:
+                bounds.append((start, rank))
+
+        def walk(node: list, inherited: int) -> None:
+            rank = min(inherited, node[2])
+            mark(node[0], rank)
+            for child in (node[3], node[4]):
+                if child is not None:
+                    walk(child, rank)
+                    mark(child[0] + (1 << (bits - child[1])), rank)
+
+        if self.root is not None:
+            walk(self.root, NO_MATCH)
+            mark(self.root[0] + (1 << (bits - self.root[1])), NO_MATCH)
+        starts: List[int] = []
+        ranks: List[int] = []
+        for start, rank in bounds:
+            if start >> bits:
+                break
+            if not ranks or ranks[-1] != rank:
+                starts.append(start)
+                ranks.append(rank)
+        self._starts, self._ranks = starts, ranks
+
+    def min_rank(self, ip: int) -> int:
+        return self._ranks[bisect_right(self._starts, ip) - 1]
+
+
+def _glob_regex(pattern: str, flags: int = 0) -> "re.Pattern[str]":
+    rx = re.escape(pattern).replace(r"\*", ".*").replace(r"\?", ".")
+    return re.compile(rx, flags)
+
+
+def _parse_ports(value: str) -> Optional[Tuple[int, int]]:
+    lo, sep, hi = value.strip().partition("-")
+    if not lo.isdigit() or (sep and not hi.isdigit()):
+        return None
+    return int(lo), int(hi) if sep else int(lo)
+
+
+_UNSUPPORTED = ("GEOIP", "IP-ASN", "RULE-SET", "DOMAIN-SET", "SCRIPT")
+
+
+def _complete(r: Rule) -> bool:
+    """Whether _predicate(r) checks every operand of r (an OR skips unsupported ones)."""
+    if isinstance(r, Logical):
+        return all(_complete(x) for x in r.items)
+    return _predicate(r) is not None
+
+
+def _predicate(r: Rule) -> Optional[Callable[[Probe], bool]]:
+    """Standalone matcher for one rule (used for logical operands and the slow list)."""
+    if isinstance(r, Logical):
+        preds = [_predicate(x) for x in r.items]
+        if r.op == "NOT":
+            # negating an unsupported operand, or an OR that only checks some of
+            # its operands, would match what the rule may not: undecidable
+            if any(p is None for p in preds) or not all(_complete(x) for x in r.items):
+                return None
+            return lambda q: not any(p(q) for p in preds)
+        if any(p is None for p in preds):
+            if r.op == "AND":
+                return None
+            preds = [p for p in preds if p is not None]
+            if not preds:
+                return None
+        if r.op == "AND":
+            return lambda q: all(p(q) for p in preds)
+        if r.op == "OR":
+            return lambda q: any(p(q) for p in preds)
+        return None
+
+    t, v = r.rtype, r.value.strip()
+    if t == "DOMAIN":
+        v = v.lower().rstrip(".")
+        return lambda q: q.host == v
+    if t == "DOMAIN-SUFFIX":
+        v = v.lower().rstrip(".")
+        dv = "." + v
+        return lambda q: q.host is not None and (q.host == v or q.host.endswith(dv))
+    if t == "DOMAIN-KEYWORD":
+        v = v.lower()
+        return lambda q: q.host is not None and v in q.host
+    if t == "DOMAIN-WILDCARD":
+        rx = _glob_regex(v.lower().rstrip("."))
+        return lambda q: q.host is not None and rx.fullmatch(q.host) is not None
+    if t == "DOMAIN-REGEX":
+        # not a DSL type: how sing-box domain_regex / v2ray regexp: rules read back
+        try:
+            rx = re.compile(v)
+        except re.error:
+            return None
+        return lambda q: q.host is not None and rx.search(q.host) is not None
+    if t == "USER-AGENT":
+        rx = _glob_regex(v)
+        return lambda q: q.ua is not None and rx.fullmatch(q.ua) is not None
+    if t == "URL-REGEX":
+        try:
+            rx = re.compile(v)
+        except re.error:
+            return None
+        return lambda q: q.url is not None and rx.search(q.url) is not None
+    if t in ("IP-CIDR", "IP-CIDR6"):
+        parsed = parse_cidr(v)
+        if parsed is None:
+            return None
+        version, first, last = parsed
+        return lambda q: q.ip is not None and q.ip[0] == version and first <= q.ip[1] <= last
+    if t == "DST-PORT":
+        ports = _parse_ports(v)
+        if ports is None:
+            return None
+        lo, hi = ports
+        return lambda q: q.port is not None and lo <= q.port <= hi
+    if t == "FINAL":
+        return lambda q: True
+    return None
+
+
+# gate kinds, best first: the fewer rules share a gate, the fewer are evaluated
+_GATE_ORDER = {"exact": 0, "suffix": 1, "ip": 2, "port": 3, "keyword": 4}
+# the probe field a pattern type needs; a rule of it never matches without
+_FIELDS = {"DOMAIN-WILDCARD": "host", "DOMAIN-REGEX": "host", "URL-REGEX": "url", "USER-AGENT": "ua"}
+
+
+def _gates(r: Rule) -> Optional[List[tuple]]:
+    """Indexed atoms one of which matches whenever `r` does, or None."""
+    if isinstance(r, Logical):
+        if r.op == "AND":
+            options = [g for g in map(_gates, r.items) if g is not None]
+            if not options:
+                return None
+            return min(options, key=lambda g: (max(_GATE_ORDER[k[0]] for k in g), len(g)))
+        if r.op == "OR":
+            out: List[tuple] = []
+            for x in r.items:
+                g = _gates(x)
+                if g is None:
+                    return None
+                out += g
+            return out or None
+        return None
+    t, v = r.rtype, r.value.strip()
+    if t in ("DOMAIN", "DOMAIN-SUFFIX"):
+        v = v.lower().rstrip(".")
+        return [("exact" if t == "DOMAIN" else "suffix", v)] if v else None
+    if t == "DOMAIN-KEYWORD":
+        v = v.lower()
+        return [("keyword", v)] if v else None
+    if t in ("IP-CIDR", "IP-CIDR6"):
+        parsed = parse_cidr(v)
+        if parsed is None:
+            return None
+        version, first, last = parsed
+        return [("ip", version, first, (32 if version == 4 else 128) - (last - first).bit_length())]
+    if t == "DST-PORT":
+        ports = _parse_ports(v)
+        return [("port", *ports)] if ports is not None else None
+    return None
+
+
+def _field(r: Rule) -> Optional[str]:
+    """The probe field `r` cannot match without, if any."""
+    if isinstance(r, Logical):
+        fields = [_field(x) for x in r.items]
+        if r.op == "AND":
+            return next((f for f in fields if f is not None), None)
+        if r.op == "OR" and len(set(fields)) == 1:
+            return fields[0]
+        return None
+    return _FIELDS.get(r.rtype)
+
+
+class Matcher:
+    """First-match evaluator over rules_by_policy (in POLICY_FILES order)."""
+
+    def __init__(
+        self,
+        rules_by_policy: Iterable[Tuple[str, List[Rule]]],
+        files: Optional[Dict[str, str]] = None,
+        origins: Optional[List[str]] = None,
+    ):
+        """
+        `files` maps a policy to the file its rules came from; `origins`, when
+        given, names the file of each (policy, rules) group instead.
+        """
+        files = files or {}
+        prefilters: Dict[str, List[str]] = {"url": [], "ua": []}
+        self.entries: List[Match] = []
+        self.unsupported: Dict[str, int] = {}
+
+        self._exact: Dict[str, int] = {}
+        self._suffix: Dict[str, int] = {}
+        keywords: Dict[str, int] = {}
+        self._trees = {4: _RadixTree(32), 6: _RadixTree(128)}
+        self._ip_min = NO_MATCH
+        self._ports: Dict[int, int] = {}
+        self._port_ranges: List[Tuple[int, int, int]] = []
+        self._final = NO_MATCH
+        # gated predicates: rank -> predicate, and the gate indexes holding ranks
+        self._gated: Dict[int, Callable[[Probe], bool]] = {}
+        self._gate_exact: Dict[str, List[int]] = {}
+        self._gate_suffix: Dict[str, List[int]] = {}
+        self._gate_keywords: Dict[str, List[int]] = {}
+        self._gate_nets: Dict[int, Dict[int, Dict[int, List[int]]]] = {4: {}, 6: {}}  # version -> plen -> network
+        self._gate_ports: Dict[int, List[int]] = {}
+        self._gate_port_ranges: List[Tuple[int, int, int]] = []
+        self._patterns: Set[Tuple[str, str]] = set()
+        # ungated predicates, per probe field they need (None: no single one)
+        self._slow: Dict[Optional[str], List[Tuple[int, Callable[[Probe], bool]]]] = {
+            None: [], "host": [], "url": [], "ua": [],
+        }
+
+        for i, (policy, rules) in enumerate(rules_by_policy):
+            fname = origins[i] if origins is not None else files.get(policy, policy)
+            for r in rules:
+                rank = len(self.entries)
+                self.entries.append(Match(policy, r, fname, r.lineno))
+                if not self._index(r, rank, keywords, prefilters):
+                    key = r.op if isinstance(r, Logical) else r.rtype
+                    self.unsupported[key] = self.unsupported.get(key, 0) + 1
+
+        for tree in self._trees.values():
+            tree.freeze()
+        self._keywords = _AhoCorasick(keywords) if keywords else None
+        self._kw_min = min(keywords.values()) if keywords else NO_MATCH
+        self._port_min = min([*self._ports.values(), *(r for _, _, r in self._port_ranges)], default=NO_MATCH)
+        self._gate_min = min(self._gated, default=NO_MATCH)
+        # a URL / user agent none of the patterns of its list can match skips it
+        self._prefilter: Dict[str, "re.Pattern[str]"] = {}
+        for field, patterns in prefilters.items():
+            if len(patterns) > 1 and len(patterns) == len(self._slow[field]):
+                try:
+                    self._prefilter[field] = re.compile("|".join(f"(?:{p})" for p in patterns))
+                except re.error:  # back-references do not survive the join
+                    pass
+        self._slow_lists = [(f, rules, self._prefilter.get(f)) for f, rules in self._slow.items() if rules]
+        self._gate_kw_rx = _literal_regex(self._gate_keywords) if self._gate_keywords else None
+
+    def _index(self, r: Rule, rank: int, keywords: Dict[str, int], prefilters: Dict[str, List[str]]) -> bool:
+        if isinstance(r, Atom):
+            t = r.rtype
+            if t in ("DOMAIN", "DOMAIN-SUFFIX", "DOMAIN-KEYWORD"):
+                v = r.value.strip().lower()
+                if t == "DOMAIN-KEYWORD":
+                    d = keywords
+                else:
+                    v = v.rstrip(".")
+                    d = self._exact if t == "DOMAIN" else self._suffix
+                if v and v not in d:
+                    d[v] = rank
+                return bool(v)
+            if t in ("IP-CIDR", "IP-CIDR6"):
+                parsed = parse_cidr(r.value)
+                if parsed is None:
+                    return False
+                version, first, last = parsed
+                self._trees[version].insert(first, self._trees[version].bits - (last - first).bit_length(), rank)
+                self._ip_min = min(self._ip_min, rank)
+                return True
+            if t == "DST-PORT":
+                ports = _parse_ports(r.value)
+                if ports is None:
+                    return False
+                if ports[0] == ports[1]:
+                    self._ports.setdefault(ports[0], rank)
+                else:
+                    self._port_ranges.append((ports[0], ports[1], rank))
+                return True
+            if t == "FINAL":
+                self._final = min(self._final, rank)
+                return True
+            if t in _UNSUPPORTED:
+                return False
+            # a repeat of an earlier pattern can never be the first match
+            key = (t, r.value.strip())
+            if key in self._patterns:
+                return True
+        pred = _predicate(r)
+        if pred is None:
+            return False
+        gates = _gates(r) if isinstance(r, Logical) else None
+        if gates is None:
+            if isinstance(r, Atom):
+                self._patterns.add((r.rtype, r.value.strip()))
+            field = _field(r)
+            self._slow[field].append((rank, pred))
+            if field in prefilters and isinstance(r, Atom):
+                v = r.value.strip()
+                prefilters[field].append(v if field == "url" else rf"\A(?:{_glob_regex(v).pattern})\Z")
+            return True
+        self._gated[rank] = pred
+        for g in gates:
+            kind = g[0]
+            if kind == "exact":
+                self._gate_exact.setdefault(g[1], []).append(rank)
+            elif kind == "suffix":
+                self._gate_suffix.setdefault(g[1], []).append(rank)
+            elif kind == "keyword":
+                self._gate_keywords.setdefault(g[1], []).append(rank)
+            elif kind == "ip":
+                _, version, first, plen = g
+                bits = self._trees[version].bits
+                nets = self._gate_nets[version].setdefault(plen, {})
+                nets.setdefault(first >> (bits - plen), []).append(rank)
+            elif g[1] == g[2]:
+                self._gate_ports.setdefault(g[1], []).append(rank)
+            else:
+                self._gate_port_ranges.append((g[1], g[2], rank))
+        return True
+
+    def _gated_rank(self, q: Probe, best: int, cands: List[int]) -> int:
+        """Smallest rank below `best` of a gated rule matching `q`; `cands` has the host suffix gates hit."""
+        host = q.host
+        if host is not None:
+            cands += self._gate_exact.get(host, ())
+            if self._gate_kw_rx is not None and self._gate_kw_rx.search(host) is not None:
+                for w, ranks in self._gate_keywords.items():
+                    if w in host:
+                        cands += ranks
+        ip = q.ip
+        if ip is not None:
+            bits = self._trees[ip[0]].bits
+            for plen, nets in self._gate_nets[ip[0]].items():
+                cands += nets.get(ip[1] >> (bits - plen), ())
+        port = q.port
+        if port is not None:
+            cands += self._gate_ports.get(port, ())
+            for lo, hi, r in self._gate_port_ranges:
+                if r < best and lo <= port <= hi:
+                    cands.append(r)
+        if not cands:
+            return best
+        gated = self._gated
+        for r in sorted(cands):
+            if r >= best:
+                break
+            if gated[r](q):
+                return r
+        return best
+
+    def rank(self, q: Probe) -> int:
+        """Smallest matching rank for `q`, or NO_MATCH."""
+        best = self._final
+        host = q.host
+        cands: List[int] = []
+        if host is not None:
+            r = self._exact.get(host, NO_MATCH)
+            if r < best:
+                best = r
+            suffix = self._suffix
+            gates = self._gate_suffix
+            if suffix or gates:
+                # host itself, then each parent: a.b.c, b.c, c
+                name, i = host, 0
+                while True:
+                    r = suffix.get(name, NO_MATCH)
+                    if r < best:
+                        best = r
+                    if gates:
+                        g = gates.get(name)
+                        if g:
+                            cands += g
+                    i = host.find(".", i) + 1
+                    if not i:
+                        break
+                    name = host[i:]
+            if self._kw_min < best:
+                r = self._keywords.min_rank(host)
+                if r < best:
+                    best = r
+        ip = q.ip
+        if ip is not None and self._ip_min < best:
+            r = self._trees[ip[0]].min_rank(ip[1])
+            if r < best:
+                best = r
+        port = q.port
+        if port is not None and self._port_min < best:
+            r = self._ports.get(port, NO_MATCH)
+            if r < best:
+                best = r
+            for lo, hi, r in self._port_ranges:
+                if r < best and lo <= port <= hi:
+                    best = r
+        if self._gate_min < best:
+            best = self._gated_rank(q, best, cands)
+        for field, slow, rx in self._slow_lists:
+            if field is not None:
+                value = getattr(q, field)
+                if value is None or (rx is not None and rx.search(value) is None):
+                    continue
+            for r, pred in slow:
+                if r >= best:
+                    break
+                if pred(q):
+                    best = r
+                    break
+        return best
+
+    def lookup(self, q: Probe) -> Optional[Match]:
+        r = self.rank(q)
+        return self.entries[r] if r != NO_MATCH else None
@@ -0,0 +1,613 @@
+from __future__ import annotations
+
+import json
+import re
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from dsl.ast import Atom, Logical, Rule
+from dsl.parser import RuleSyntaxError, iter_file_rules, parse_rule
+
+
+# Readers turn a dist/ artifact back into rule groups the matcher understands,
+# following what the *client* would do with the file rather than what the
+# compiler meant: a type the client does not know is dropped, a field the client
+# reads with other semantics is read with those semantics. Each reader returns
+#   (groups, notes)
+# where groups is [(policy, rules, origin file)] in evaluation order and notes
+# lists anything that could not be modelled. For JSON/YAML artifacts a rule's
+# lineno is its 1-based index in the rules array.
+
+Group = Tuple[str, List[Rule], str]
+ReadResult = Tuple[List[Group], List[str]]
+
+
+def _append(groups: List[Group], policy: str, rule: Rule, origin: str) -> None:
+    if groups and groups[-1][0] == policy and groups[-1][2] == origin:
+        groups[-1][1].append(rule)
+    else:
+        groups.append((policy, [rule], origin))
+
+
+def _any_of(items: List[Rule]) -> Optional[Rule]:
+    if not items:
+        return None
+    return items[0] if len(items) == 1 else Logical("OR", items)
+
+
+def _split_policy_line(line: str, lineno: int) -> Tuple[Rule, str]:
+    """
+    Split a "<rule>,<policy>[,<option>...]" line as written by Surge-like
+    configs into the rule and its policy.
+    """
+    head = line.partition(",")[0].strip().upper()
+    if head in ("AND", "OR", "NOT"):
+        rule, _, policy = line.rpartition(",")
+        return parse_rule(rule, lineno), policy.strip()
+    r = parse_rule(line, lineno)
+    if r.rtype in ("FINAL", "MATCH"):
+        return Atom("FINAL", "", (), lineno), r.value
+    if not r.options:
+        return Atom(r.rtype, r.value, (), lineno), ""
+    return Atom(r.rtype, r.value, r.options[1:], lineno), r.options[0]
+
+
+def _section_lines(path: Path, section: str):
+    """(lineno, line) of the non-comment lines inside `[section]` of an ini-like config."""
+    inside = False
+    with open(path, encoding="utf-8") as fh:
+        for lineno, raw in enumerate(fh, 1):
+            line = raw.strip()
+            if not line or line[0] in "#;" or line.startswith("//"):
+                continue
+            if line[0] == "[" and line[-1] == "]":
+                inside = line[1:-1].strip().lower() == section
+                continue
+            if inside:
+                yield lineno, line
+
+
+# ---- Surge / Loon ----
+
+def _dist_file(url: str, root: Path) -> Optional[Path]:
+    """A rule file this build wrote under dist/; other links are left to the matcher."""
+    path = _resolve_local(url, root)
+    if path is None or path.relative_to(root).parts[0] != "dist":
+        return None
+    return path
+
+
+def _read_rule_file(path: Path, root: Path, domain_set: bool, notes: List[str]) -> Tuple[List[Rule], str]:
+    """Rules of a Surge DOMAIN-SET ("x" / ".x" lines) or RULE-SET / Loon remote rule file."""
+    origin = str(path.relative_to(root))
+    rules: List[Rule] = []
+    with open(path, encoding="utf-8") as fh:
+        for lineno, raw in enumerate(fh, 1):
+            line = raw.strip()
+            if not line or line[0] in "#;" or line.startswith("//"):
+                continue
+            if domain_set:
+                # ".x" matches x and everything below it
+                rules.append(Atom("DOMAIN-SUFFIX", line[1:], (), lineno) if line[0] == "." else Atom("DOMAIN", line, (), lineno))
+                continue
+            try:
+                rules.append(parse_rule(line, lineno))
+            except RuleSyntaxError as e:
+                notes.append(f"{origin}:{lineno}: unreadable rule ({e.reason})")
+    return rules, origin
+
+
+def read_surge(path: Path) -> ReadResult:
+    root = path.resolve().parent.parent
+    groups: List[Group] = []
+    notes: List[str] = []
+    for lineno, line in _section_lines(path, "rule"):
+        try:
+            rule, policy = _split_policy_line(line, lineno)
+        except RuleSyntaxError as e:
+            notes.append(f"{path.name}:{lineno}: unreadable rule ({e.reason})")
+            continue
+        target = _dist_file(rule.value, root) if isinstance(rule, Atom) and rule.rtype in ("DOMAIN-SET", "RULE-SET") else None
+        if target is None:
+            _append(groups, policy, rule, path.name)
+            continue
+        rules, origin = _read_rule_file(target, root, rule.rtype == "DOMAIN-SET", notes)
+        for r in rules:
+            _append(groups, policy, r, origin)
+    return groups, notes
+
+
+def read_loon(path: Path) -> ReadResult:
+    # Loon evaluates [Rule], then [Remote Rule] in order, and FINAL last
+    root = path.resolve().parent.parent
+    groups: List[Group] = []
+    notes: List[str] = []
+    finals: List[Tuple[str, Rule]] = []
+    for lineno, line in _section_lines(path, "rule"):
+        try:
+            rule, policy = _split_policy_line(line, lineno)
+        except RuleSyntaxError as e:
+            notes.append(f"{path.name}:{lineno}: unreadable rule ({e.reason})")
+            continue
+        if isinstance(rule, Atom) and rule.rtype == "FINAL":
+            finals.append((policy, rule))
+        else:
+            _append(groups, policy, rule, path.name)
+    for lineno, line in _section_lines(path, "remote rule"):
+        url, *params = [x.strip() for x in line.split(",")]
+        opts = dict(p.partition("=")[::2] for p in params)
+        if opts.get("enabled", "true").strip().lower() == "false":
+            continue
+        target = _dist_file(url, root)
+        if target is None:
+            notes.append(f"{path.name}:{lineno}: no local file for {url}; treated as empty")
+            continue
+        rules, origin = _read_rule_file(target, root, False, notes)
+        for r in rules:
+            _append(groups, opts.get("policy", "").strip(), r, origin)
+    for policy, rule in finals:
+        _append(groups, policy, rule, path.name)
+    return groups, notes
+
+
+# ---- Quantumult X ----
+
+# QX filter type -> rule type with the same meaning
+_QX_TYPES = {
+    "HOST": "DOMAIN",
+    "HOST-SUFFIX": "DOMAIN-SUFFIX",
+    "HOST-KEYWORD": "DOMAIN-KEYWORD",
+    "HOST-WILDCARD": "DOMAIN-WILDCARD",
+    "USER-AGENT": "USER-AGENT",
+    "URL-REGEX": "URL-REGEX",
+    "IP-CIDR": "IP-CIDR",
+    "IP6-CIDR": "IP-CIDR6",
+    "GEOIP": "GEOIP",
+    "FINAL": "FINAL",
+}
+
+
+def _qx_rule(line: str, lineno: int, origin: str, notes: List[str]) -> Optional[Tuple[Rule, str]]:
+    try:
+        rule, policy = _split_policy_line(line, lineno)
+    except RuleSyntaxError as e:
+        notes.append(f"{origin}:{lineno}: unreadable rule ({e.reason})")
+        return None
+    t = _QX_TYPES.get(rule.rtype.upper()) if isinstance(rule, Atom) else None
+    if t is None:
+        notes.append(f"{origin}:{lineno}: QX has no filter type {line.partition(',')[0]}")
+        return None
+    return Atom(t, rule.value, rule.options, lineno), policy
+
+
+def read_quantumultx(path: Path) -> ReadResult:
+    # QX evaluates [filter_local], then [filter_remote] resources in order, and FINAL last
+    root = path.resolve().parent.parent
+    groups: List[Group] = []
+    notes: List[str] = []
+    finals: List[Tuple[str, Rule]] = []
+    local = [*_section_lines(path, "filter_local"), *_section_lines(path, "filter")]
+    for lineno, line in local:
+        parsed = _qx_rule(line, lineno, path.name, notes)
+        if parsed is None:
+            continue
+        rule, policy = parsed
+        if rule.rtype == "FINAL":
+            finals.append((policy, rule))
+        else:
+            _append(groups, policy, rule, path.name)
+    for lineno, line in _section_lines(path, "filter_remote"):
+        url, *params = [x.strip() for x in line.split(",")]
+        opts = {k.strip().lower(): v.strip() for k, _, v in (p.partition("=") for p in params)}
+        if opts.get("enabled", "true").lower() == "false":
+            continue
+        target = _dist_file(url, root)
+        if target is None:
+            notes.append(f"{path.name}:{lineno}: no local file for {url}; treated as empty")
+            continue
+        origin = str(target.relative_to(root))
+        with open(target, encoding="utf-8") as fh:
+            for i, raw in enumerate(fh, 1):
+                text = raw.strip()
+                if not text or text[0] in "#;":
+                    continue
+                parsed = _qx_rule(text, i, origin, notes)
+                if parsed is not None:
+                    _append(groups, opts.get("force-policy") or parsed[1], parsed[0], origin)
+    for policy, rule in finals:
+        _append(groups, policy, rule, path.name)
+    return groups, notes
+
+
+# ---- Clash / mihomo ----
+
+# what a mihomo "classical" provider accepts from our rule types
+_CLASSICAL = {
+    "DOMAIN", "DOMAIN-SUFFIX", "DOMAIN-KEYWORD", "DOMAIN-WILDCARD",
+    "IP-CIDR", "IP-CIDR6", "IP-ASN", "GEOIP", "DST-PORT", "URL-REGEX",
+    "AND", "OR", "NOT",
+}
+
+
+def _classical_ok(r: Rule) -> bool:
+    if isinstance(r, Logical):
+        return r.op in _CLASSICAL and all(_classical_ok(x) for x in r.items)
+    return r.rtype in _CLASSICAL
+
+
+def _resolve_local(url: str, root: Path) -> Optional[Path]:
+    """Map a URL of this repo (…/rules/X.list, …/dist/sub/X) onto the checkout."""
+    parts = [p for p in url.split("?", 1)[0].split("/") if p]
+    for n in (3, 2, 1):
+        if len(parts) >= n:
+            p = root.joinpath(*parts[-n:])
+            if p.is_file():
+                return p
+    return None
+
+
+def _read_provider(name: str, spec: Dict[str, Any], root: Path, notes: List[str]) -> Tuple[List[Rule], str]:
+    path = _resolve_local(str(spec.get("url", "")), root)
+    if path is not None and path.suffix == ".mrs":
+        # the binary form is converted from the text file next to it
+        src = path.with_suffix(".txt")
+        path = src if src.is_file() else None
+    if path is None:
+        notes.append(f"provider {name}: {spec.get('url')} has no local text source; treated as empty")
+        return [], name
+    origin = str(path.relative_to(root))
+    if path.suffix in (".yaml", ".yml"):
+        import yaml
+        payload = [str(x) for x in (yaml.safe_load(path.read_text(encoding="utf-8")) or {}).get("payload") or []]
+    else:
+        with open(path, encoding="utf-8") as fh:
+            payload = [ln.strip() for ln in fh]
+    behavior = spec.get("behavior", "classical")
+    rules: List[Rule] = []
+    for lineno, line in enumerate(payload, 1):
+        if not line or line[0] == "#":
+            continue
+        if behavior == "domain":
+            rules.append(_clash_domain(line, lineno))
+        elif behavior == "ipcidr":
+            rules.append(Atom("IP-CIDR", line, (), lineno))
+        elif behavior == "classical":
+            try:
+                r = parse_rule(line, lineno)
+            except RuleSyntaxError:
+                notes.append(f"{origin}:{lineno}: unreadable rule")
+                continue
+            if _classical_ok(r):
+                rules.append(r)
+        else:
+            notes.append(f"provider {name}: unknown behavior {behavior}; treated as empty")
+            break
+    return rules, origin
+
+
+def _clash_domain(v: str, lineno: int) -> Rule:
+    # mihomo domain payload: "+.x" x and below, ".x" below only, "*" one label
+    if v.startswith("+."):
+        return Atom("DOMAIN-SUFFIX", v[2:], (), lineno)
+    if v.startswith("."):
+        return Atom("DOMAIN-WILDCARD", "*" + v, (), lineno)
+    if "*" in v:
+        return Atom("DOMAIN-REGEX", "^" + re.escape(v).replace(r"\*", "[^.]+") + "$", (), lineno)
+    return Atom("DOMAIN", v, (), lineno)
+
+
+def read_clash(path: Path) -> ReadResult:
+    import yaml
+
+    root = path.resolve().parent.parent
+    doc = yaml.safe_load(path.read_text(encoding="utf-8")) or {}
+    providers = doc.get("rule-providers") or {}
+    groups: List[Group] = []
+    notes: List[str] = []
+    provider_cache: Dict[str, Tuple[List[Rule], str]] = {}
+    for i, line in enumerate(doc.get("rules") or [], 1):
+        kind, _, rest = str(line).partition(",")
+        kind = kind.strip().upper()
+        if kind == "RULE-SET":
+            name, _, policy = rest.partition(",")
+            name = name.strip()
+            policy = policy.partition(",")[0].strip()
+            if name not in provider_cache:
+                spec = providers.get(name)
+                if spec is None:
+                    notes.append(f"rules[{i}]: unknown provider {name}")
+                    provider_cache[name] = ([], name)
+                else:
+                    provider_cache[name] = _read_provider(name, spec, root, notes)
+            rules, origin = provider_cache[name]
+            for r in rules:
+                _append(groups, policy, r, origin)
+            continue
+        try:
+            rule, policy = _split_policy_line(str(line), i)
+        except RuleSyntaxError as e:
+            notes.append(f"rules[{i}]: unreadable rule ({e.reason})")
+            continue
+        if not (isinstance(rule, Atom) and rule.rtype == "FINAL") and not _classical_ok(rule):
+            notes.append(f"rules[{i}]: mihomo has no rule type {kind}")
+            continue
+        _append(groups, policy, rule, path.name)
+    return groups, notes
+
+
+# ---- sing-box ----
+
+def _all_groups(groups: List[List[Rule]], lineno: int) -> List[Rule]:
+    """
+    Alternatives (OR-ed rules) equal to the AND of `groups`, each an OR list.
+    A lone group stays a flat list so the matcher can index its atoms.
+    """
+    if any(not g for g in groups):
+        return []
+    if len(groups) == 1:
+        return groups[0]
+    return [Logical("AND", [_any_of(g) for g in groups], lineno)]
+
+
+def _singbox_rules(
+    node: Dict[str, Any],
+    lineno: int,
+    notes: List[str],
+    where: str,
+    rule_sets: Dict[str, List[Rule]],
+) -> Optional[List[Rule]]:
+    """
+    One sing-box rule (minus its outbound) as a list of alternatives; None if it
+    matches everything.
+    """
+    if node.get("type") == "logical":
+        items = []
+        for x in node.get("rules", []):
+            alts = _singbox_rules(x, lineno, notes, where, rule_sets)
+            items.append(Atom("FINAL", "", (), lineno) if alts is None else _any_of(alts) or Logical("OR", [], lineno))
+        alts = [Logical("AND" if node.get("mode", "and") == "and" else "OR", items, lineno)]
+    else:
+        # destination fields (domain*, ip_cidr, geoip, rule_set) are OR-ed, and AND-ed with the port fields
+        dest: List[Rule] = []
+        port: List[Rule] = []
+        other = False
+        for key, vals in node.items():
+            if key in ("outbound", "action", "invert", "type"):
+                continue
+            vals = vals if isinstance(vals, list) else [vals]
+            if key == "domain":
+                dest += [Atom("DOMAIN", str(v), (), lineno) for v in vals]
+            elif key == "domain_suffix":
+                dest += [_singbox_suffix(str(v), lineno) for v in vals]
+            elif key == "domain_keyword":
+                dest += [Atom("DOMAIN-KEYWORD", str(v), (), lineno) for v in vals]
+            elif key == "domain_regex":
+                dest += [Atom("DOMAIN-REGEX", str(v), (), lineno) for v in vals]
+            elif key == "ip_cidr":
+                dest += [Atom("IP-CIDR", str(v), (), lineno) for v in vals]
+            elif key == "geoip":
+                dest += [Atom("GEOIP", str(v), (), lineno) for v in vals]
+            elif key == "rule_set":
+                for tag in vals:
+                    if tag not in rule_sets:
+                        notes.append(f"{where}: unknown rule-set {tag}")
+                    dest += rule_sets.get(tag, [])
+            elif key == "port":
+                port += [Atom("DST-PORT", str(v), (), lineno) for v in vals]
+            elif key == "port_range":
+                port += [Atom("DST-PORT", str(v).replace(":", "-"), (), lineno) for v in vals]
+            else:
+                notes.append(f"{where}: field {key} not modelled; rule never matches")
+                other = True
+        groups = [g for g, present in ((dest, _has_any(node, _SB_DEST)), (port, _has_any(node, _SB_PORT))) if present]
+        if other:
+            return []
+        if not groups:
+            alts = None
+        else:
+            alts = _all_groups(groups, lineno)
+    if node.get("invert"):
+        inner = _any_of(alts) if alts is not None else Atom("FINAL", "", (), lineno)
+        return [Logical("NOT", [inner] if inner is not None else [], lineno)]
+    return alts
+
+
+_SB_DEST = ("domain", "domain_suffix", "domain_keyword", "domain_regex", "ip_cidr", "geoip", "rule_set")
+_SB_PORT = ("port", "port_range")
+
+
+def _has_any(node: Dict[str, Any], keys: Tuple[str, ...]) -> bool:
+    return any(k in node for k in keys)
+
+
+def _singbox_suffix(v: str, lineno: int) -> Rule:
+    # ".example.com" only matches below example.com; "example.com" also matches itself
+    if v.startswith("."):
+        return Atom("DOMAIN-WILDCARD", "*" + v, (), lineno)
+    return Atom("DOMAIN-SUFFIX", v, (), lineno)
+
+
+def _singbox_rule_set(entry: Dict[str, Any], root: Path, notes: List[str]) -> List[Rule]:
+    """Alternatives of a route.rule_set entry, read from this checkout."""
+    tag = entry.get("tag", "")
+    where = entry.get("path") or entry.get("url") or ""
+    path = _resolve_local(str(where), root)
+    if path is not None and path.suffix == ".srs":
+        # the binary form is compiled from the source file next to it
+        src = path.with_suffix(".json")
+        path = src if src.is_file() else None
+    if path is None:
+        notes.append(f"rule-set {tag}: no local source file for {where}; treated as empty")
+        return []
+    with open(path, encoding="utf-8") as fh:
+        doc = json.load(fh)
+    alts: List[Rule] = []
+    for i, node in enumerate(doc.get("rules") or [], 1):
+        sub = _singbox_rules(node, i, notes, f"{path.name} rules[{i}]", {})
+        alts += sub if sub is not None else [Atom("FINAL", "", (), i)]
+    return alts
+
+
+def read_singbox(path: Path) -> ReadResult:
+    with open(path, encoding="utf-8") as fh:
+        doc = json.load(fh)
+    route = doc.get("route") or {}
+    root = path.resolve().parent.parent
+    groups: List[Group] = []
+    notes: List[str] = []
+    rule_sets = {e.get("tag", ""): _singbox_rule_set(e, root, notes) for e in route.get("rule_set") or []}
+    for i, node in enumerate(route.get("rules") or [], 1):
+        policy = node.get("outbound", "")
+        alts = _singbox_rules(node, i, notes, f"route.rules[{i}]", rule_sets)
+        if alts is None:
+            alts = [Atom("FINAL", "", (), i)]
+        for r in alts:
+            _append(groups, policy, r, path.name)
+    return groups, notes
+
+
+# ---- v2rayN / v2ray routing ----
+
+def _v2ray_domain(v: str, lineno: int) -> Rule:
+    kind, sep, value = v.partition(":")
+    if not sep:
+        return Atom("DOMAIN-KEYWORD", v, (), lineno)
+    if kind == "domain":
+        return Atom("DOMAIN-SUFFIX", value, (), lineno)
+    if kind == "full":
+        return Atom("DOMAIN", value, (), lineno)
+    if kind == "keyword":
+        return Atom("DOMAIN-KEYWORD", value, (), lineno)
+    if kind == "regexp":
+        return Atom("DOMAIN-REGEX", value, (), lineno)
+    return Atom("V2RAY-" + kind.upper(), value, (), lineno)
+
+
+def _v2ray_ip(v: str, lineno: int) -> Rule:
+    if v.startswith("geoip:"):
+        return Atom("GEOIP", v[6:], (), lineno)
+    if v.startswith(("ext:", "ext-ip:")):
+        # ext:file:tag indirections
+        return Atom("V2RAY-" + v.partition(":")[0].upper(), v, (), lineno)
+    return Atom("IP-CIDR", v, (), lineno)
+
+
+_GEOSITE_TYPES = {0: "DOMAIN-KEYWORD", 1: "DOMAIN-REGEX", 2: "DOMAIN-SUFFIX", 3: "DOMAIN"}
+
+
+def _pb_varint(buf: bytes, i: int) -> Tuple[int, int]:
+    n = shift = 0
+    while True:
+        b = buf[i]
+        i += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n, i
+        shift += 7
+
+
+def _pb_fields(buf: bytes):
+    """(field number, value) of one protobuf message; value is an int or bytes."""
+    i = 0
+    while i < len(buf):
+        key, i = _pb_varint(buf, i)
+        wire = key & 7
+        if wire == 0:
+            val, i = _pb_varint(buf, i)
+        elif wire == 2:
+            size, i = _pb_varint(buf, i)
+            val, i = buf[i:i + size], i + size
+        elif wire in (1, 5):
+            size = 8 if wire == 1 else 4
+            val, i = buf[i:i + size], i + size
+        else:
+            raise ValueError(f"unsupported protobuf wire type {wire}")
+        yield key >> 3, val
+
+
+def _read_geosite(path: Path) -> Dict[str, List[Tuple[int, str]]]:
+    """country_code (upper-cased) -> [(domain type, value)] of a geosite .dat."""
+    sites: Dict[str, List[Tuple[int, str]]] = {}
+    for num, entry in _pb_fields(path.read_bytes()):
+        if num != 1:
+            continue
+        code, domains = "", []
+        for f, val in _pb_fields(entry):
+            if f == 1:
+                code = val.decode("utf-8")
+            elif f == 2:
+                t, v = 0, ""
+                for g, x in _pb_fields(val):
+                    if g == 1:
+                        t = x
+                    elif g == 2:
+                        v = x.decode("utf-8")
+                domains.append((t, v))
+        sites.setdefault(code.upper(), []).extend(domains)
+    return sites
+
+
+def _v2ray_ext(v: str, lineno: int, base: Path, files: Dict[str, Any], notes: List[str]) -> List[Rule]:
+    """Domain rules of an "ext:<file>:<tag>" reference, read from the .dat next to the config."""
+    _, _, ref = v.partition(":")
+    fname, _, tag = ref.partition(":")
+    tag, _, attrs = tag.partition("@")
+    if fname not in files:
+        found = next((p for p in (base / "v2rayn" / fname, base / fname) if p.is_file()), None)
+        files[fname] = _read_geosite(found) if found is not None else None
+        if found is None:
+            notes.append(f"{fname}: not found next to the config; {v} treated as empty")
+    sites = files[fname]
+    if sites is None:
+        return []
+    if attrs:
+        notes.append(f"routing.rules[{lineno}]: attribute filter @{attrs} not modelled; whole list used")
+    if tag.upper() not in sites:
+        notes.append(f"routing.rules[{lineno}]: {fname} has no list {tag}; treated as empty")
+    return [Atom(_GEOSITE_TYPES.get(t, "V2RAY-GEOSITE"), d, (), lineno) for t, d in sites.get(tag.upper(), [])]
+
+
+def read_v2rayn(path: Path) -> ReadResult:
+    with open(path, encoding="utf-8") as fh:
+        doc = json.load(fh)
+    groups: List[Group] = []
+    notes: List[str] = []
+    ext_files: Dict[str, Any] = {}
+    for i, node in enumerate((doc.get("routing") or {}).get("rules") or [], 1):
+        policy = node.get("outboundTag", "")
+        # every field present must match; the values of one field are OR-ed
+        fields: List[List[Rule]] = []
+        for key, vals in node.items():
+            if key in ("type", "outboundTag", "ruleTag"):
+                continue
+            if key == "domain":
+                domains: List[Rule] = []
+                for v in map(str, vals):
+                    if v.startswith("ext:"):
+                        domains += _v2ray_ext(v, i, path.parent, ext_files, notes)
+                    else:
+                        domains.append(_v2ray_domain(v, i))
+                fields.append(domains)
+            elif key == "ip":
+                fields.append([_v2ray_ip(str(v), i) for v in vals])
+            elif key == "port":
+                fields.append([Atom("DST-PORT", p.strip(), (), i) for p in str(vals).split(",")])
+            else:
+                notes.append(f"routing.rules[{i}]: field {key} not modelled; rule never matches")
+                fields.append([])
+        alts = _all_groups(fields, i) if fields else [Atom("FINAL", "", (), i)]
+        for r in alts:
+            _append(groups, policy, r, path.name)
+    return groups, notes
+
+
+# dist file -> reader, in the order the verifier reports them
+DIST_READERS: List[Tuple[str, Callable[[Path], ReadResult]]] = [
+    ("surge.conf", read_surge),
+    ("loon.conf", read_loon),
+    ("stash.yaml", read_clash),
+    ("quantumultx.conf", read_quantumultx),
+    ("clash.yaml", read_clash),
+    ("sing-box.json", read_singbox),
+    ("v2rayn.json", read_v2rayn),
+]
@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+import ipaddress
+import random
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from dsl.ast import Atom, Logical, Rule, rule_text
+from match.engine import NO_MATCH, Match, Matcher, Probe
+from match.readers import DIST_READERS
+from passes.cidr import parse_cidr
+from pipeline.cache import digest_file
+
+
+# Differential check of every dist/ artifact against the source rules.
+#
+# Probes are generated from the source rules themselves (each domain value, a
+# subdomain, a look-alike and the parent; the edges of every CIDR and just
+# outside them; every port and its neighbours) topped up with random hosts and
+# addresses. The source matcher ranks all probes once; each artifact is read
+# back by match.readers, ranked in one pass over the same probe list, and the
+# probes whose policy differs are grouped by the (source rule, target rule)
+# pair responsible. Repeated probes are ranked once per matcher.
+
+
+class Divergence(NamedTuple):
+    count: int
+    probe: Probe                  # first probe that showed it
+    expected: Optional[Match]     # source rule hit (None: no rule matched)
+    actual: Optional[Match]       # target rule hit
+
+
+class TargetReport(NamedTuple):
+    fname: str
+    rules: int
+    divergent: int
+    divergences: List[Divergence]
+    notes: List[str]
+    unsupported: Dict[str, int]
+
+
+def format_probe(p: Probe) -> str:
+    if p.url is not None:
+        return p.url
+    if p.host is not None:
+        text = p.host
+    elif p.ip is not None:
+        text = str(ipaddress.ip_address(p.ip[1]) if p.ip[0] == 6 else ipaddress.IPv4Address(p.ip[1]))
+    else:
+        text = "-"
+    if p.port is not None:
+        text = f"[{text}]:{p.port}" if p.ip is not None and p.ip[0] == 6 else f"{text}:{p.port}"
+    return text
+
+
+def _iter_atoms(r: Rule) -> Iterator[Atom]:
+    if isinstance(r, Logical):
+        for x in r.items:
+            yield from _iter_atoms(x)
+    elif isinstance(r, Atom):
+        yield r
+
+
+_FILLER_LABELS = ("www", "api", "cdn", "m", "static", "login", "img")
+_FILLER_TLDS = ("com", "net", "org", "io", "cn", "dev")
+
+
+def _seed_values(rules_by_policy: List[Tuple[str, List[Rule]]]) -> Tuple[List[str], List[Tuple[int, int]], List[int]]:
+    hosts: List[str] = []
+    ips: List[Tuple[int, int]] = []
+    ports: List[int] = [80, 443]
+    for _, rules in rules_by_policy:
+        for r in rules:
+            for a in _iter_atoms(r):
+                t, v = a.rtype, a.value.strip().lower()
+                if t in ("DOMAIN", "DOMAIN-SUFFIX"):
+                    v = v.rstrip(".")
+                    parent = v.partition(".")[2]
+                    hosts += [v, "www." + v, "a.b." + v, "x" + v]
+                    if parent:
+                        hosts.append(parent)
+                elif t == "DOMAIN-KEYWORD":
+                    hosts += [v + ".com", f"a{v}b.net", v]
+                elif t == "DOMAIN-WILDCARD":
+                    hosts += [v.replace("*", "a").replace("?", "x"), v.replace("*", "a.b").replace("?", "y"),
+                              v.replace("*.", "").replace("*", "").replace("?", "")]
+                elif t in ("IP-CIDR", "IP-CIDR6"):
+                    parsed = parse_cidr(v)
+                    if parsed is not None:
+                        version, first, last = parsed
+                        top = (1 << (32 if version == 4 else 128)) - 1
+                        ips += [(version, first), (version, last), (version, (first + last) // 2)]
+                        if first > 0:
+                            ips.append((version, first - 1))
+                        if last < top:
+                            ips.append((version, last + 1))
+                elif t == "DST-PORT":
+                    lo, _, hi = v.partition("-")
+                    if lo.isdigit():
+                        lo_i = int(lo)
+                        hi_i = int(hi) if hi.isdigit() else lo_i
+                        ports += [lo_i, hi_i, max(lo_i - 1, 0), min(hi_i + 1, 65535)]
+    return [h for h in dict.fromkeys(hosts) if h], list(dict.fromkeys(ips)), list(dict.fromkeys(ports))
+
+
+def generate_probes(rules_by_policy: List[Tuple[str, List[Rule]]], n: int, seed: int = 0) -> List[Probe]:
+    """`n` probes: every seed value at least once (while n allows), then random draws."""
+    rng = random.Random(seed)
+    hosts, ips, ports = _seed_values(rules_by_policy)
+    for _ in range(max(64, n // 20)):
+        hosts.append(".".join(rng.choice(_FILLER_LABELS) for _ in range(rng.randint(1, 2)))
+                     + f"{rng.randrange(1000)}." + rng.choice(_FILLER_TLDS))
+        ips.append((4, rng.getrandbits(32)) if rng.random() < 0.8 else (6, (0x2000 << 112) | rng.getrandbits(112)))
+
+    probes: List[Probe] = []
+    # each seed once, on a rotating port; http gets a URL so URL-REGEX can fire
+    for i, h in enumerate(hosts):
+        port = ports[i % len(ports)]
+        probes.append(Probe(h, None, port, f"http://{h}/" if port == 80 else None))
+    for i, ip in enumerate(ips):
+        probes.append(Probe(None, ip, ports[(i * 7) % len(ports)]))
+    if len(probes) >= n:
+        rng.shuffle(probes)
+        return probes[:n]
+    choice, randrange = rng.choice, rng.randrange
+    n_hosts = len(hosts)
+    while len(probes) < n:
+        # most real traffic is 443/80; the other ports only need to show up
+        port = choice(ports) if randrange(4) == 0 else (443 if randrange(3) else 80)
+        if randrange(3):
+            h = hosts[randrange(n_hosts)]
+            probes.append(Probe(h, None, port, f"http://{h}/" if port == 80 else None))
+        else:
+            probes.append(Probe(None, choice(ips), port))
+    return probes
+
+
+def _policy_table(m: Matcher) -> List[Optional[str]]:
+    # _ranks maps "no match" to len(entries), which reads back as None
+    return [e.policy for e in m.entries] + [None]
+
+
+def _ranks(m: Matcher, probes: List[Probe]) -> List[int]:
+    rank = m.rank
+    last = len(m.entries)
+    return [r if r != NO_MATCH else last for r in map(rank, probes)]
+
+
+def diff(
+    source: Matcher,
+    src_ranks: List[int],
+    target: Matcher,
+    probes: List[Probe],
+    weights: List[int],
+    examples: int,
+) -> Tuple[int, List[Divergence]]:
+    """
+    Number of divergent probes and the `examples` most frequent (source rule,
+    target rule) pairs; probes[i] stands for weights[i] identical probes.
+    """
+    tgt_ranks = _ranks(target, probes)
+    src_pol = _policy_table(source)
+    tgt_pol = _policy_table(target)
+    pairs: Dict[Tuple[int, int], List[int]] = {}
+    total = 0
+    for i, (a, b) in enumerate(zip(src_ranks, tgt_ranks)):
+        if src_pol[a] != tgt_pol[b]:
+            w = weights[i]
+            total += w
+            ent = pairs.get((a, b))
+            if ent is None:
+                pairs[(a, b)] = [w, i]
+            else:
+                ent[0] += w
+    top = sorted(pairs.items(), key=lambda kv: (-kv[1][0], kv[1][1]))[:examples]
+    src_n, tgt_n = len(source.entries), len(target.entries)
+    out = [
+        Divergence(
+            count,
+            probes[first],
+            source.entries[a] if a < src_n else None,
+            target.entries[b] if b < tgt_n else None,
+        )
+        for (a, b), (count, first) in top
+    ]
+    return total, out
+
+
+def verify_dist(
+    dist_dir: Path,
+    rules_by_policy: List[Tuple[str, List[Rule]]],
+    files: Dict[str, str],
+    probes: List[Probe],
+    only: Optional[List[str]] = None,
+    examples: int = 20,
+) -> List[TargetReport]:
+    source = Matcher(rules_by_policy, files)
+    # random draws repeat probes: rank each distinct one once, weighted by its
+    # count (first-seen order, so the examples are the same)
+    counts: Dict[Probe, int] = {}
+    for p in probes:
+        counts[p] = counts.get(p, 0) + 1
+    probes, weights = list(counts), list(counts.values())
+    src_ranks = _ranks(source, probes)
+    reports: List[TargetReport] = []
+    by_digest: Dict[str, TargetReport] = {}
+    for fname, reader in DIST_READERS:
+        if only and fname not in only:
+            continue
+        path = dist_dir / fname
+        if not path.is_file() or path.stat().st_size == 0:
+            continue
+        # identical artifacts (e.g. an unchanged copy) are only checked once
+        digest = digest_file(path)
+        prev = by_digest.get(digest)
+        if prev is not None:
+            reports.append(prev._replace(fname=fname))
+            continue
+        groups, notes = reader(path)
+        target = Matcher([(p, rules) for p, rules, _ in groups], origins=[o for _, _, o in groups])
+        divergent, divs = diff(source, src_ranks, target, probes, weights, examples)
+        rep = TargetReport(fname, len(target.entries), divergent, divs, notes, target.unsupported)
+        by_digest[digest] = rep
+        reports.append(rep)
+    return reports
+
+
+def _describe(m: Optional[Match]) -> str:
+    if m is None:
+        return "no match"
+    return f"{m.policy} via {m.file}:{m.lineno} {rule_text(m.rule)}"
+
+
+def format_reports(reports: List[TargetReport], n_probes: int) -> List[str]:
+    lines: List[str] = []
+    for rep in reports:
+        if not rep.divergent:
+            lines.append(f"{rep.fname}: equivalent on {n_probes} probes ({rep.rules} rules)")
+        else:
+            pct = 100.0 * rep.divergent / n_probes if n_probes else 0.0
+            lines.append(f"{rep.fname}: {rep.divergent} of {n_probes} probes diverge ({pct:.2f}%)")
+            for d in rep.divergences:
+                lines.append(f"  - {d.count}x e.g. {format_probe(d.probe)}")
+                lines.append(f"      source: {_describe(d.expected)}")
+                lines.append(f"      target: {_describe(d.actual)}")
+        if rep.unsupported:
+            kinds = ", ".join(f"{n} {t}" for t, n in sorted(rep.unsupported.items()))
+            lines.append(f"  not evaluable (never match): {kinds}")
+        for note in rep.notes[:20]:
+            lines.append(f"  note: {note}")
+        if len(rep.notes) > 20:
+            lines.append(f"  note: ... {len(rep.notes) - 20} more")
+    return lines
+
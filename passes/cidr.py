@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import socket
+from bisect import bisect_right
+from typing import Dict, List, Optional, Tuple
+
+from dsl.ast import Atom, Rule
+from compiler.base import CompileWarning
+
+
+# IP-CIDR / IP-CIDR6 aggregation.
+#
+# Inside one policy file every rule routes to the same policy, so its prefixes can
+# be merged freely: they are turned into [start, end] integer intervals, sorted,
+# merged when adjacent or overlapping, and re-emitted as the minimal set of CIDR
+# blocks at the position of the group's first rule. Rules are grouped by
+# (type, address family, options) so no-resolve and friends are never mixed.
+#
+# Across files only removal is done: a prefix wholly inside a prefix of an earlier
+# file can never be reached. The earlier rule must carry the same options, or
+# none at all (a resolving rule also catches everything a no-resolve one would).
+
+_CIDR_TYPES = ("IP-CIDR", "IP-CIDR6")
+
+Interval = Tuple[int, int]
+
+
+def parse_cidr(value: str) -> Optional[Tuple[int, int, int]]:
+    """(version, first, last) of a CIDR string, or None if it is not one."""
+    addr, sep, plen = value.strip().partition("/")
+    if ":" in addr:
+        family, version, bits = socket.AF_INET6, 6, 128
+    else:
+        family, version, bits = socket.AF_INET, 4, 32
+    try:
+        ip = int.from_bytes(socket.inet_pton(family, addr), "big")
+        n = int(plen) if sep else bits
+    except (OSError, ValueError):
+        return None
+    if not 0 <= n <= bits:
+        return None
+    host = (1 << (bits - n)) - 1
+    first = ip & ~host
+    return version, first, first | host
+
+
+def format_cidr(version: int, start: int, plen: int) -> str:
+    if version == 4:
+        return f"{socket.inet_ntop(socket.AF_INET, start.to_bytes(4, 'big'))}/{plen}"
+    return f"{socket.inet_ntop(socket.AF_INET6, start.to_bytes(16, 'big'))}/{plen}"
+
+
+def range_to_cidrs(start: int, end: int, bits: int) -> List[Tuple[int, int]]:
+    """Minimal list of (network, prefix length) blocks exactly covering [start, end]."""
+    out: List[Tuple[int, int]] = []
+    while start <= end:
+        size = (start & -start).bit_length() - 1 if start else bits
+        fit = (end - start + 1).bit_length() - 1
+        if fit < size:
+            size = fit
+        out.append((start, bits - size))
+        start += 1 << size
+    return out
+
+
+def merge_intervals(items: List[Tuple[int, int, int]]) -> List[Tuple[int, int, int]]:
+    """Merge (start, end, lineno) intervals that overlap or touch; keeps the smallest lineno."""
+    items.sort()
+    merged: List[List[int]] = []
+    for s, e, ln in items:
+        if merged and s <= merged[-1][1] + 1:
+            m = merged[-1]
+            if e > m[1]:
+                m[1] = e
+            if ln < m[2]:
+                m[2] = ln
+        else:
+            merged.append([s, e, ln])
+    return [(s, e, ln) for s, e, ln in merged]
+
+
+class _Covered:
+    """Merged intervals of earlier files, per (family, options); answers 'fully inside?'."""
+
+    def __init__(self):
+        self._by_key: Dict[Tuple[int, tuple], Tuple[List[int], List[int]]] = {}
+        self._pending: Dict[Tuple[int, tuple], List[Tuple[int, int, int]]] = {}
+
+    def add(self, version: int, options: tuple, start: int, end: int) -> None:
+        self._pending.setdefault((version, options), []).append((start, end, 0))
+
+    def publish(self) -> None:
+        for key, items in self._pending.items():
+            starts, ends = self._by_key.get(key, ([], []))
+            items.extend((s, e, 0) for s, e in zip(starts, ends))
+            merged = merge_intervals(items)
+            self._by_key[key] = ([s for s, _, _ in merged], [e for _, e, _ in merged])
+        self._pending = {}
+
+    def covers(self, version: int, options: tuple, start: int, end: int) -> bool:
+        keys = [(version, options)] if not options else [(version, options), (version, ())]
+        for key in keys:
+            cols = self._by_key.get(key)
+            if cols is None:
+                continue
+            starts, ends = cols
+            i = bisect_right(starts, start) - 1
+            if i >= 0 and ends[i] >= end:
+                return True
+        return False
+
+
+def aggregate_cidrs(
+    rules_by_policy: List[Tuple[str, List[Rule]]],
+    files: Optional[Dict[str, str]] = None,
+) -> Tuple[List[Tuple[str, List[Rule]]], List[CompileWarning], int]:
+    """
+    Merge each file's IP-CIDR prefixes and drop prefixes shadowed by earlier files.
+    Returns the new rule lists, one summary line per changed group, and the number
+    of rules removed.
+    """
+    files = files or {}
+    covered = _Covered()
+    report: List[CompileWarning] = []
+    removed_total = 0
+
+    out: List[Tuple[str, List[Rule]]] = []
+    for policy, rules in rules_by_policy:
+        fname = files.get(policy, policy)
+        groups: Dict[Tuple[str, int, tuple], List[Tuple[int, int, int]]] = {}
+        originals: Dict[Tuple[str, int, tuple], List[Atom]] = {}
+        first_pos: Dict[Tuple[str, int, tuple], int] = {}
+        shadowed = 0
+        rest: List[Optional[Rule]] = []
+
+        for r in rules:
+            if type(r) is Atom and r.rtype in _CIDR_TYPES:
+                parsed = parse_cidr(r.value)
+                if parsed is not None:
+                    version, start, end = parsed
+                    if covered.covers(version, r.options, start, end):
+                        shadowed += 1
+                        continue
+                    key = (r.rtype, version, r.options)
+                    if key not in groups:
+                        groups[key] = []
+                        originals[key] = []
+                        first_pos[key] = len(rest)
+                        rest.append(None)  # placeholder for the merged group
+                    groups[key].append((start, end, r.lineno))
+                    originals[key].append(r)
+                    continue
+            rest.append(r)
+
+        emitted: Dict[int, List[Rule]] = {}
+        for key, items in groups.items():
+            rtype, version, options = key
+            bits = 32 if version == 4 else 128
+            merged = merge_intervals(items)
+            new_rules: List[Rule] = []
+            for s, e, ln in merged:
+                covered.add(version, options, s, e)
+                for net, plen in range_to_cidrs(s, e, bits):
+                    new_rules.append(Atom(rtype, format_cidr(version, net, plen), options, ln))
+            if len(new_rules) == len(originals[key]):
+                # nothing merged: keep the rules exactly as written
+                new_rules = list(originals[key])
+            else:
+                report.append(CompileWarning(
+                    file=fname,
+                    line=f"{len(originals[key])} {rtype}{',' + ','.join(options) if options else ''} prefixes -> {len(new_rules)}",
+                    reason="aggregated",
+                ))
+                removed_total += len(originals[key]) - len(new_rules)
+            emitted[first_pos[key]] = new_rules
+
+        if shadowed:
+            report.append(CompileWarning(file=fname, line=f"{shadowed} prefixes", reason="covered by earlier policies"))
+            removed_total += shadowed
+
+        new_list: List[Rule] = []
+        for i, r in enumerate(rest):
+            if r is None:
+                new_list.extend(emitted[i])
+            else:
+                new_list.append(r)
+        covered.publish()
+        out.append((policy, new_list))
+
+    return out, report, removed_total
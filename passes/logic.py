@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+from typing import Dict, List, Optional, Tuple
+
+from dsl.ast import Atom, Logical, Rule, rule_text
+from compiler.base import CompileWarning
+
+
+# Boolean normalization of AND / OR / NOT rules.
+#
+# normalize_logicals() runs with the other passes and rewrites every logical
+# rule into its canonical form, which all targets then compile:
+#   AND(AND(a, b), c)   -> AND(a, b, c)      nested same-op trees are flattened
+#   OR(a, b, a)         -> OR(a, b)          repeated operands are dropped
+#   AND(a)              -> a                 one operand is that operand
+#   NOT(NOT(a))         -> a
+# Nodes are hash-consed: equal subtrees become one shared object, keyed by their
+# op and the identity of their (already shared) operands, so repeated operands
+# are found by identity and no subtree is hashed more than once.
+#
+# disjuncts() gives the targets without logical rules (Quantumult X, Clash,
+# v2ray) a rule as an OR of terms, each an AND of possibly negated atoms. Every
+# rule of one policy file routes to the same policy, so OR(a, b) compiles to the
+# consecutive rules a and b; a term of several atoms needs a format that can AND
+# them (a v2ray field rule with one atom per field). The expansion is bounded:
+# a tree over MAX_NODES nodes or a DNF over MAX_TERMS terms of MAX_LITERALS
+# atoms is left unexpanded.
+
+MAX_NODES = 256
+MAX_TERMS = 64
+MAX_LITERALS = 8
+
+Literal = Tuple[Atom, bool]  # (atom, negated)
+Term = Tuple[Literal, ...]  # AND of its literals
+
+
+class _Interner:
+    def __init__(self):
+        self.atoms: Dict[Atom, Atom] = {}
+        self.nodes: Dict[Tuple[str, Tuple[int, ...]], Logical] = {}
+
+    def atom(self, a: Atom) -> Atom:
+        return self.atoms.setdefault(a, a)
+
+    def logical(self, op: str, items: List[Rule]) -> Logical:
+        key = (op, tuple(map(id, items)))
+        node = self.nodes.get(key)
+        if node is None:
+            node = self.nodes[key] = Logical(op, items)
+        return node
+
+
+def _normalize(r: Rule, table: _Interner) -> Rule:
+    if type(r) is Atom:
+        return table.atom(r)
+    items = [_normalize(x, table) for x in r.items]
+    if r.op == "NOT":
+        inner = items[0] if len(items) == 1 else table.logical("OR", items)
+        if type(inner) is Logical and inner.op == "NOT":
+            return inner.items[0]
+        return table.logical("NOT", [inner])
+    flat: Dict[int, Rule] = {}
+    for x in items:
+        for y in (x.items if type(x) is Logical and x.op == r.op else (x,)):
+            flat.setdefault(id(y), y)
+    if len(flat) == 1:
+        return next(iter(flat.values()))
+    return table.logical(r.op, list(flat.values()))
+
+
+def _with_lineno(r: Rule, lineno: int) -> Rule:
+    if type(r) is Atom:
+        return Atom(r.rtype, r.value, r.options, lineno)
+    return Logical(r.op, r.items, lineno)
+
+
+def normalize_logicals(
+    rules_by_policy: List[Tuple[str, List[Rule]]],
+    files: Optional[Dict[str, str]] = None,
+) -> Tuple[List[Tuple[str, List[Rule]]], List[CompileWarning], int]:
+    """Returns the new rules, one report line per rewritten rule and the number rewritten."""
+    if not any(type(r) is Logical for _, rules in rules_by_policy for r in rules):
+        return rules_by_policy, [], 0
+    files = files or {}
+    table = _Interner()
+    report: List[CompileWarning] = []
+    out: List[Tuple[str, List[Rule]]] = []
+    for policy, rules in rules_by_policy:
+        fname = files.get(policy, policy)
+        new_rules: List[Rule] = []
+        for r in rules:
+            if type(r) is not Logical:
+                new_rules.append(r)
+                continue
+            n = _normalize(r, table)
+            if n == r:
+                new_rules.append(r)
+                continue
+            new_rules.append(_with_lineno(n, r.lineno))
+            report.append(CompileWarning(file=f"{fname}:{r.lineno}", line=rule_text(r), reason=f"simplified to {rule_text(n)}"))
+        out.append((policy, new_rules))
+    return out, report, len(report)
+
+
+class _TooLarge(Exception):
+    pass
+
+
+def _size(r: Rule) -> int:
+    if type(r) is Atom:
+        return 1
+    return 1 + sum(_size(x) for x in r.items)
+
+
+def _and(a: List[Term], b: List[Term]) -> List[Term]:
+    out: List[Term] = []
+    for x in a:
+        for y in b:
+            lits = dict.fromkeys(x + y)
+            if len(lits) > MAX_LITERALS:
+                raise _TooLarge
+            if any((atom, not neg) in lits for atom, neg in lits):
+                continue  # a and NOT a: the term never matches
+            out.append(tuple(lits))
+            if len(out) > MAX_TERMS:
+                raise _TooLarge
+    return out
+
+
+def _dnf(r: Rule, neg: bool) -> List[Term]:
+    if type(r) is Atom:
+        return [((r, neg),)]
+    if r.op == "NOT":
+        # NOT(a, b) matches when none of its operands does: AND(NOT a, NOT b)
+        conj = not neg
+        neg = not neg
+    else:
+        conj = (r.op == "AND") != neg
+    parts = [_dnf(x, neg) for x in r.items]
+    if conj:
+        out: List[Term] = [()]
+        for p in parts:
+            out = _and(out, p)
+        return out
+    out = [t for p in parts for t in p]
+    if len(out) > MAX_TERMS:
+        raise _TooLarge
+    return out
+
+
+def disjuncts(r: Rule) -> Optional[List[Term]]:
+    """
+    `r` as an OR of terms, without repeated or absorbed terms (an empty list for
+    a rule that never matches); None when it is over the size bounds.
+    """
+    if _size(r) > MAX_NODES:
+        return None
+    try:
+        terms = _dnf(r, False)
+    except _TooLarge:
+        return None
+    sets = [frozenset(t) for t in terms]
+    out: List[Term] = []
+    for i, (t, s) in enumerate(zip(terms, sets)):
+        # a term that implies a shorter (or an earlier equal) one adds nothing to the OR
+        if not any(o < s or (o == s and j < i) for j, o in enumerate(sets) if j != i):
+            out.append(t)
+    return out
+
+
+def term_rule(t: Term) -> Rule:
+    """A term back as a rule: the atom itself, NOT(atom), or an AND of those."""
+    items = [Logical("NOT", [a]) if neg else a for a, neg in t]
+    return items[0] if len(items) == 1 else Logical("AND", items)
@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+import re
+from typing import Dict, List, Optional, Tuple
+
+from dsl.ast import Atom, Rule, rule_text
+from compiler.base import CompileWarning
+
+
+# Pattern lowering, run before the optimizer: replace glob and regex rules by the
+# plain domain matchers every client evaluates through a trie or hash lookup,
+# whenever that cannot change a first-match result.
+#
+#   DOMAIN-WILDCARD,example.com      (no * or ?)       -> DOMAIN,example.com
+#   DOMAIN-WILDCARD,*example*                         -> DOMAIN-KEYWORD,example
+#   DOMAIN-WILDCARD,*.example.com                     -> DOMAIN-SUFFIX,example.com
+#       only when example.com itself is already matched by this policy or an
+#       earlier one: the wildcard does not match the bare domain, the suffix does
+#   URL-REGEX a, URL-REGEX b, ... (one policy)         -> URL-REGEX,(?:a)|(?:b)|...
+#       every rule of one policy file routes to the same policy, so one
+#       alternation matches exactly when one of the rules would
+#
+# host_pattern() does the same for regexes a backend applies to the host name
+# (sing-box domain_regex), and is used by the compilers directly.
+
+_GLOB = set("*?")
+_WILDCARD = "DOMAIN-WILDCARD"
+
+# a lower-case host literal inside a regex: letters, digits, '-', '_' and escaped dots
+_RX_LIT = r"((?:[a-z0-9_-]|\\[.-])+)"
+# prefixes (after "^" where anchored) that make LIT$ match LIT and every subdomain of it
+_RX_SELF_AND_SUB = r"(?:\^\(\?:\.\*\\\.\)\?|\^\(\.\*\\\.\)\?|\^\(\?:\.\+\\\.\)\?|\^\(\.\+\\\.\)\?|\(\?:\^\|\\\.\)|\(\^\|\\\.\)|\^\(\[\^\.\]\+\\\.\)\*)"
+# prefixes that make LIT$ match only the subdomains of LIT
+_RX_SUB_ONLY = r"(?:\\\.|\^\.\*\\\.|\^\.\+\\\.)"
+# prefixes that let LIT appear anywhere in a host ("/" never occurs in one)
+_RX_ANYWHERE = r"(?:|\^\.\*|\.\*|\^\[\^/\]\*|\[\^/\]\*)"
+
+_HOST_PATTERNS = [
+    (re.compile(rf"\^{_RX_LIT}\$"), "DOMAIN"),
+    (re.compile(rf"{_RX_SELF_AND_SUB}{_RX_LIT}\$"), "DOMAIN-SUFFIX"),
+    (re.compile(rf"{_RX_SUB_ONLY}{_RX_LIT}\$"), _WILDCARD),
+    (re.compile(rf"{_RX_ANYWHERE}{_RX_LIT}(?:\.\*)?"), "DOMAIN-KEYWORD"),
+]
+
+# group syntax that does not survive being wrapped into a larger alternation
+_UNMERGEABLE = re.compile(r"\(\?[a-zA-Z]|\(\?P|\(\?<[^=!]|\\[1-9]|\\g")
+
+
+def _literal(s: str) -> bool:
+    return bool(s) and not (_GLOB & set(s))
+
+
+def subdomain_base(pattern: str) -> Optional[str]:
+    """"*.example.com" -> "example.com": a wildcard matching exactly the subdomains of a name."""
+    p = pattern.strip().lower().rstrip(".")
+    if p.startswith("*.") and _literal(p[2:]):
+        return p[2:]
+    return None
+
+
+def lower_wildcard(pattern: str) -> Optional[Tuple[str, str]]:
+    """(rule type, value) equivalent to DOMAIN-WILDCARD,<pattern> for every host, if any."""
+    p = pattern.strip().lower().rstrip(".")
+    if _literal(p):
+        return "DOMAIN", p
+    if len(p) > 2 and p[0] == "*" and p[-1] == "*" and _literal(p[1:-1]):
+        return "DOMAIN-KEYWORD", p[1:-1]
+    return None
+
+
+def host_pattern(rx: str) -> Optional[Tuple[str, str]]:
+    """
+    (rule type, value) equivalent to searching a lower-case host name with the
+    regex `rx`: DOMAIN, DOMAIN-SUFFIX, DOMAIN-KEYWORD, or DOMAIN-WILDCARD "*.x"
+    for the subdomains of x. None when the regex is anything else.
+    """
+    for pat, rtype in _HOST_PATTERNS:
+        m = pat.fullmatch(rx)
+        if m is not None:
+            lit = m.group(1).replace("\\", "")
+            if rtype == _WILDCARD:
+                return rtype, "*." + lit
+            return rtype, lit
+    return None
+
+
+def merge_regexes(patterns: List[str]) -> List[str]:
+    """
+    Patterns searched with "any of them matches" semantics, with every pattern
+    that can be grouped merged into one alternation (placed where the first
+    one was); invalid or flag-carrying patterns are kept as they are.
+    """
+    mergeable: List[str] = []
+    out: List[str] = []
+    at: Optional[int] = None
+    for p in patterns:
+        try:
+            re.compile(p)
+            ok = not _UNMERGEABLE.search(p)
+        except re.error:
+            ok = False
+        if not ok:
+            out.append(p)
+            continue
+        if at is None:
+            at = len(out)
+            out.append(p)
+        mergeable.append(p)
+    # a pattern repeated in the list only makes the alternation slower
+    mergeable = list(dict.fromkeys(mergeable))
+    if len(mergeable) > 1:
+        out[at] = "|".join(f"(?:{p})" for p in mergeable)
+    return out
+
+
+class _Hosts:
+    """Host names matched by the plain DOMAIN / DOMAIN-SUFFIX / DOMAIN-KEYWORD rules seen so far."""
+
+    def __init__(self):
+        self.exact: set = set()
+        self.suffix: set = set()
+        self.keywords: Dict[str, None] = {}
+        self._rx: Optional[re.Pattern] = None
+
+    def add(self, r: Rule) -> None:
+        if type(r) is not Atom or r.options:
+            return
+        v = r.value.strip().lower()
+        if r.rtype == "DOMAIN":
+            self.exact.add(v.rstrip("."))
+        elif r.rtype == "DOMAIN-SUFFIX":
+            self.suffix.add(v.strip("."))
+        elif r.rtype == "DOMAIN-KEYWORD" and v and v not in self.keywords:
+            self.keywords[v] = None
+            self._rx = None
+
+    def covers(self, host: str) -> bool:
+        if host in self.exact or host in self.suffix:
+            return True
+        i = len(host)
+        while True:
+            i = host.rfind(".", 0, i)
+            if i < 0:
+                break
+            if host[i + 1:] in self.suffix:
+                return True
+        if self.keywords:
+            if self._rx is None:
+                self._rx = re.compile("|".join(re.escape(k) for k in self.keywords))
+            return self._rx.search(host) is not None
+        return False
+
+
+def lower_patterns(
+    rules_by_policy: List[Tuple[str, List[Rule]]],
+    files: Optional[Dict[str, str]] = None,
+) -> Tuple[List[Tuple[str, List[Rule]]], List[CompileWarning], int]:
+    """
+    Returns the new rules, one report line per rewrite and the number of
+    pattern rules removed (rewritten into a plain rule or merged away).
+    """
+    if not any(type(r) is Atom and r.rtype in (_WILDCARD, "URL-REGEX") for _, rules in rules_by_policy for r in rules):
+        return rules_by_policy, [], 0
+    files = files or {}
+    report: List[CompileWarning] = []
+    removed = 0
+    seen = _Hosts()  # rules of the earlier policies
+    out: List[Tuple[str, List[Rule]]] = []
+    for policy, rules in rules_by_policy:
+        fname = files.get(policy, policy)
+        here = _Hosts()
+        for r in rules:
+            here.add(r)
+
+        lowered: List[Rule] = []
+        url_regex: List[Atom] = []
+        url_at: Optional[int] = None
+        for r in rules:
+            if type(r) is not Atom or r.options:
+                lowered.append(r)
+                continue
+            if r.rtype == "URL-REGEX":
+                if url_at is None:
+                    url_at = len(lowered)
+                    lowered.append(r)
+                url_regex.append(r)
+                continue
+            if r.rtype != _WILDCARD:
+                lowered.append(r)
+                continue
+            new = lower_wildcard(r.value)
+            base = subdomain_base(r.value)
+            if new is None and base is not None and (here.covers(base) or seen.covers(base)):
+                new = ("DOMAIN-SUFFIX", base)
+            if new is None:
+                lowered.append(r)
+                continue
+            lowered.append(Atom(new[0], new[1], (), r.lineno))
+            removed += 1
+            report.append(CompileWarning(file=f"{fname}:{r.lineno}", line=rule_text(r), reason=f"lowered to {new[0]},{new[1]}"))
+
+        if url_at is not None:
+            # all URL-REGEX rules of the policy go where the first one was
+            merged = merge_regexes([r.value for r in url_regex])
+            by_value = {r.value: r for r in url_regex}
+            lowered[url_at:url_at + 1] = [by_value.get(v) or Atom("URL-REGEX", v, (), url_regex[0].lineno) for v in merged]
+            if len(merged) < len(url_regex):
+                n = len(url_regex) - len(merged) + 1
+                removed += n - 1
+                report.append(CompileWarning(file=fname, line=f"{n} URL-REGEX rules", reason="merged into one alternation"))
+
+        for r in lowered:
+            seen.add(r)
+        out.append((policy, lowered))
+    return out, report, removed
@@ -0,0 +1,272 @@
+from __future__ import annotations
+
+import re
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from dsl.ast import Atom, Logical, Rule, rule_text
+from compiler.base import CompileWarning
+
+
+# Rule-set optimizer, run between load_rules and the compilers.
+#
+# Rules are evaluated first-match across the policy files in POLICY_FILES order,
+# so a rule can be dropped without changing any outcome when:
+#   - it is unreachable: an earlier rule (in this or an earlier file) already
+#     matches everything it matches, or it sits after a FINAL;
+#   - it is redundant inside its own file: another rule of the same file matches
+#     a superset. Every rule of one file routes to the same policy, so whatever
+#     the input falls through to instead still yields that policy.
+#
+# "Matches a superset" is decided for exact duplicates (any type), and for
+# DOMAIN / DOMAIN-SUFFIX / DOMAIN-KEYWORD via a reversed-label domain trie plus
+# keyword containment. Rules with options are only ever treated as duplicates,
+# since options can change how a client matches them.
+
+_SUFFIX = "\0s"
+_EXACT = "\0d"
+
+_DOMAIN_TYPES = ("DOMAIN", "DOMAIN-SUFFIX")
+# characters of a keyword's start indexed by _Keywords (fewer for shorter keywords)
+_HEAD = 3
+# up to this many keywords _Keywords matches with one regex alternation
+_FEW_KEYWORDS = 64
+_HOST_TYPES = ("DOMAIN", "DOMAIN-SUFFIX", "DOMAIN-KEYWORD")
+
+Origin = Tuple[str, int]  # (file name, line number)
+
+
+def _fmt(at: Origin) -> str:
+    return f"{at[0]}:{at[1]}"
+
+
+class _DomainTrie:
+    """
+    Reversed-label domain trie, stored flat: a node is keyed by its dotted label
+    path ("com", "example.com", ...), so walking from the root towards a leaf is
+    an rfind(".") loop with one dict probe per label and inserting is one store.
+    """
+
+    def __init__(self):
+        self.suffix: Dict[str, Origin] = {}
+        self.exact: Dict[str, Origin] = {}
+
+    def add(self, host: str, marker: str, origin: Origin) -> None:
+        d = self.suffix if marker == _SUFFIX else self.exact
+        if host not in d:
+            d[host] = origin
+
+    def covering_suffix(self, host: str, include_self: bool) -> Optional[Origin]:
+        """Origin of a DOMAIN-SUFFIX on the path to `host` (the node itself only if include_self)."""
+        d = self.suffix
+        if d:
+            i = len(host)
+            while True:
+                i = host.rfind(".", 0, i)
+                if i < 0:
+                    break
+                at = d.get(host[i + 1:])
+                if at is not None:
+                    return at
+            if include_self:
+                return d.get(host)
+        return None
+
+
+class _Keywords:
+    """
+    Keyword containment. A few keywords are matched as one regex alternation;
+    sre tries its alternatives one by one at every position, though, so with
+    many keywords the text is probed instead: only at positions where some
+    keyword's first characters occur, and only with the lengths keywords have.
+    Both answer the same: the leftmost keyword, the first-added one on a tie.
+    """
+
+    def __init__(self):
+        self.origins: Dict[str, Origin] = {}
+        self._rank: Dict[str, int] = {}
+        self._lengths: List[int] = []
+        self._head = _HEAD
+        self._heads: set = set()
+        self._rx: Optional[re.Pattern] = None
+
+    def add(self, kw: str, origin: Origin) -> None:
+        if not kw or kw in self.origins:
+            return
+        self._rank[kw] = len(self.origins)
+        self.origins[kw] = origin
+        self._rx = None
+        if len(kw) not in self._lengths:
+            self._lengths = sorted(self._lengths + [len(kw)])
+        if len(kw) < self._head:
+            self._head = len(kw)
+            self._heads = {k[:self._head] for k in self.origins}
+        else:
+            self._heads.add(kw[:self._head])
+
+    def _hits(self, text: str) -> Iterator[Tuple[int, int, str]]:
+        """(position, rank, keyword) for every keyword occurrence, by position."""
+        h, heads, rank, lengths = self._head, self._heads, self._rank, self._lengths
+        n = len(text)
+        for i in range(n - h + 1):
+            if text[i:i + h] in heads:
+                for length in lengths:
+                    if i + length > n:
+                        break
+                    r = rank.get(text[i:i + length])
+                    if r is not None:
+                        yield i, r, text[i:i + length]
+
+    def find(self, text: str) -> Optional[Origin]:
+        """Origin of the leftmost keyword in `text`."""
+        if not self.origins:
+            return None
+        if len(self.origins) <= _FEW_KEYWORDS:
+            if self._rx is None:
+                self._rx = re.compile("|".join(re.escape(k) for k in self.origins))
+            m = self._rx.search(text)
+            return self.origins[m.group()] if m else None
+        best: Optional[Tuple[int, int, str]] = None
+        for hit in self._hits(text):
+            if best is not None and hit[0] != best[0]:
+                break
+            if best is None or hit[1] < best[1]:
+                best = hit
+        return self.origins[best[2]] if best else None
+
+    def inside(self, text: str, skip: Optional[str] = None) -> Optional[Origin]:
+        """Origin of the first-added keyword (other than `skip`) that occurs in `text`."""
+        if len(self.origins) <= _FEW_KEYWORDS:
+            for kw, at in self.origins.items():
+                if kw != skip and kw in text:
+                    return at
+            return None
+        best: Optional[Tuple[int, int, str]] = None
+        for hit in self._hits(text):
+            if hit[2] != skip and (best is None or hit[1] < best[1]):
+                best = hit
+        return self.origins[best[2]] if best else None
+
+
+def _host_value(r: Rule) -> Optional[str]:
+    """Normalized value of a plain (option-less) DOMAIN/DOMAIN-SUFFIX/DOMAIN-KEYWORD rule."""
+    if type(r) is Atom and r.rtype in _HOST_TYPES and not r.options:
+        v = r.value.strip().lower()
+        if r.rtype != "DOMAIN-KEYWORD":
+            v = v.rstrip(".")
+            if "*" in v:
+                return None
+        return v or None
+    return None
+
+
+def optimize_rules(
+    rules_by_policy: List[Tuple[str, List[Rule]]],
+    files: Optional[Dict[str, str]] = None,
+) -> Tuple[List[Tuple[str, List[Rule]]], List[CompileWarning]]:
+    """
+    Drop duplicate, subsumed and shadowed rules. `files` maps a policy to its
+    source file name for the report. Returns the new rule lists and one warning
+    per removed rule.
+    """
+    files = files or {}
+    removed: List[Tuple[Origin, Rule, str]] = []
+
+    g_trie = _DomainTrie()
+    g_keywords = _Keywords()
+    g_seen: Dict[object, Tuple[str, Origin]] = {}
+    final_at: Optional[Origin] = None
+
+    out: List[Tuple[str, List[Rule]]] = []
+    for policy, rules in rules_by_policy:
+        fname = files.get(policy, policy)
+        hosts = [_host_value(r) for r in rules]
+
+        # file-local view: every plain suffix/keyword rule of this file, in any position
+        f_trie = _DomainTrie()
+        f_keywords = _Keywords()
+        for r, host in zip(rules, hosts):
+            if host is not None:
+                if r.rtype == "DOMAIN-SUFFIX":
+                    f_trie.add(host, _SUFFIX, (fname, r.lineno))
+                elif r.rtype == "DOMAIN-KEYWORD":
+                    f_keywords.add(host, (fname, r.lineno))
+
+        f_seen: Dict[object, Origin] = {}
+        kept: List[Tuple[Rule, Optional[str]]] = []
+        for r, host in zip(rules, hosts):
+            at = (fname, r.lineno)
+            reason = None
+            if final_at is not None:
+                reason = f"unreachable after FINAL at {_fmt(final_at)}"
+            else:
+                key = (r.rtype, host) if host is not None else r
+                hit = g_seen.get(key)
+                if hit is not None:
+                    reason = ("duplicate of " if hit[0] == policy else "shadowed by ") + _fmt(hit[1])
+                elif key in f_seen:
+                    reason = f"duplicate of {_fmt(f_seen[key])}"
+                else:
+                    f_seen[key] = at
+                    if host is not None:
+                        reason = _covered(r.rtype, host, g_trie, g_keywords, f_trie, f_keywords)
+
+            if reason is not None:
+                removed.append((at, r, reason))
+                continue
+
+            kept.append((r, host))
+            if type(r) is Atom and r.rtype == "FINAL":
+                final_at = at
+
+        # only now publish this file's rules to the files after it
+        for r, host in kept:
+            at = (fname, r.lineno)
+            key = (r.rtype, host) if host is not None else r
+            if key not in g_seen:
+                g_seen[key] = (policy, at)
+            if host is not None:
+                if r.rtype == "DOMAIN-KEYWORD":
+                    g_keywords.add(host, at)
+                else:
+                    g_trie.add(host, _SUFFIX if r.rtype == "DOMAIN-SUFFIX" else _EXACT, at)
+
+        out.append((policy, [r for r, _ in kept]))
+
+    warnings = [CompileWarning(file=_fmt(at), line=rule_text(r), reason=reason) for at, r, reason in removed]
+    return out, warnings
+
+
+def _covered(
+    t: str,
+    host: str,
+    g_trie: _DomainTrie,
+    g_keywords: _Keywords,
+    f_trie: _DomainTrie,
+    f_keywords: _Keywords,
+) -> Optional[str]:
+    if t == "DOMAIN-KEYWORD":
+        at = g_keywords.inside(host)
+        if at is not None:
+            return f"shadowed by keyword at {_fmt(at)}"
+        at = f_keywords.inside(host, skip=host)
+        if at is not None:
+            return f"subsumed by keyword at {_fmt(at)}"
+        return None
+
+    at = g_trie.covering_suffix(host, include_self=True)
+    if at is None and t == "DOMAIN":
+        at = g_trie.exact.get(host)
+    if at is not None:
+        return f"shadowed by {_fmt(at)}"
+    at = g_keywords.find(host)
+    if at is not None:
+        return f"shadowed by keyword at {_fmt(at)}"
+    # inside the file: a DOMAIN is covered by a suffix equal to it,
+    # a DOMAIN-SUFFIX only by a strictly shorter one
+    at = f_trie.covering_suffix(host, include_self=(t == "DOMAIN"))
+    if at is not None:
+        return f"subsumed by {_fmt(at)}"
+    at = f_keywords.find(host)
+    if at is not None:
+        return f"subsumed by keyword at {_fmt(at)}"
+    return None
@@ -0,0 +1,354 @@
+from __future__ import annotations
+
+import re
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    from re import _compiler as sre_compile, _parser as sre_parse  # 3.11+
+except ImportError:  # pragma: no cover
+    import sre_compile
+    import sre_parse
+
+from dsl.ast import Atom, Logical, Rule, rule_text
+from compiler.base import CompileWarning
+from pipeline.parallel import map_ordered
+
+
+# Build-time cost check for the patterns clients run on every HTTP request:
+# URL-REGEX (a regex searched in the URL) and USER-AGENT (a glob matched against
+# the whole header). Each distinct pattern is
+#   - parsed, and its syntax tree checked for the shapes that backtrack
+#     exponentially or polynomially in a backtracking engine:
+#       nested quantifier       (a+)+, (\w+\s?)*,   the inner repeat can split
+#                               ([a-z]+.)+, (.*a){12} the same text many ways
+#       overlapping alternation (a|aa)+            same, through the branches
+#       adjacent quantifiers    .*.*x, \d+\d+      polynomial
+#   - timed against generated adversarial inputs (the body of each repeat pumped
+#     n times, then a character that makes the match fail) of growing length;
+#     one search over the budget, twice in a row, is a finding.
+# Timings are CPU time in Python's re, which backtracks like the engines of the
+# clients, so a pattern that is slow here is slow there. Findings never carry a
+# measured time, so a pattern flagged on every run reads the same every run.
+# Past POOL_MIN new patterns (and with --jobs > 1) they are checked in a
+# process pool, since the timings are independent.
+
+BUDGET = 0.02          # seconds for one search
+MAX_INPUT = 2048       # adversarial inputs are grown up to this many characters
+POOL_MIN = 32          # distinct new patterns before the check uses a process pool
+
+_UNBOUNDED = 16        # a repeat with a larger max counts as unbounded
+_ALPHABET = [chr(c) for c in range(32, 127)] + ["\t", "\n", "\x00", "\xe9"]
+_SUFFIXES = ("", "!", "\x00", "\n", "/")
+
+_REPEATS = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, "POSSESSIVE_REPEAT", None))
+
+
+def _is_repeat(item) -> bool:
+    return item[0] in _REPEATS
+
+
+def _unbounded(item) -> bool:
+    return _is_repeat(item) and item[1][1] > _UNBOUNDED
+
+
+def _width(state, items) -> Tuple[int, int]:
+    return sre_parse.SubPattern(state, list(items)).getwidth()
+
+
+def _charset(state, items) -> Optional[frozenset]:
+    """Characters matched by a one-character pattern (over a sample alphabet), None for anything wider."""
+    if _width(state, items) != (1, 1):
+        return None
+    try:
+        rx = sre_compile.compile(sre_parse.SubPattern(state, list(items)), 0)
+    except Exception:
+        return None
+    return frozenset(c for c in _ALPHABET if rx.fullmatch(c))
+
+
+def _body(item) -> list:
+    return list(item[1][2])
+
+
+def _flatten(items) -> list:
+    """Items of a sequence with plain groups opened up."""
+    out = []
+    for op, av in items:
+        if op is sre_parse.SUBPATTERN:
+            out += _flatten(av[-1])
+        else:
+            out.append((op, av))
+    return out
+
+
+def _walk(items) -> Iterator[tuple]:
+    for item in items:
+        yield item
+        op, av = item
+        if _is_repeat(item):
+            yield from _walk(av[2])
+        elif op is sre_parse.SUBPATTERN:
+            yield from _walk(av[-1])
+        elif op is sre_parse.BRANCH:
+            for branch in av[1]:
+                yield from _walk(branch)
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            yield from _walk(av[1])
+
+
+_CATEGORY_CHARS = {
+    sre_parse.CATEGORY_DIGIT: "0",
+    sre_parse.CATEGORY_WORD: "a",
+    sre_parse.CATEGORY_SPACE: " ",
+    sre_parse.CATEGORY_NOT_DIGIT: "a",
+    sre_parse.CATEGORY_NOT_WORD: "-",
+    sre_parse.CATEGORY_NOT_SPACE: "a",
+}
+
+
+def _char(state, op, av) -> str:
+    """One character matched by a one-character item."""
+    if op is sre_parse.LITERAL:
+        return chr(av)
+    if op is sre_parse.ANY:
+        return "a"
+    if op is sre_parse.IN and av and av[0][0] is not sre_parse.NEGATE:
+        kind, v = av[0]
+        if kind is sre_parse.LITERAL:
+            return chr(v)
+        if kind is sre_parse.RANGE:
+            return chr(v[0])
+        if kind is sre_parse.CATEGORY and v in _CATEGORY_CHARS:
+            return _CATEGORY_CHARS[v]
+    cs = _charset(state, [(op, av)])
+    return min(cs, key=lambda c: (not c.isalnum(), c)) if cs else "a"
+
+
+def _sample(state, items) -> str:
+    """Some short text matched by `items` (best effort)."""
+    out = []
+    for op, av in items:
+        if op in (sre_parse.LITERAL, sre_parse.IN, sre_parse.ANY, sre_parse.NOT_LITERAL):
+            out.append(_char(state, op, av))
+        elif op is sre_parse.SUBPATTERN:
+            out.append(_sample(state, av[-1]))
+        elif op is sre_parse.BRANCH:
+            out.append(_sample(state, av[1][0]))
+        elif op in _REPEATS:
+            out.append(_sample(state, av[2]) * max(av[0], 1))
+    return "".join(out)
+
+
+def _compiled(state, items):
+    try:
+        return sre_compile.compile(sre_parse.SubPattern(state, list(items)), 0)
+    except Exception:
+        return None
+
+
+def _overlapping_branches(state, body) -> bool:
+    """
+    Whether an alternation in a repeated body lets one text take two paths:
+    two branches can start matching the same text, or one branch may be empty
+    and another starts like the body itself, as (a|aa)+, read as a(|a).
+    """
+    whole = _compiled(state, body)
+    for op, av in body:
+        if op is not sre_parse.BRANCH:
+            continue
+        branches = av[1]
+        sets = [_charset(state, b) for b in branches]
+        sets = [s for s in sets if s]
+        if any(a & b for i, a in enumerate(sets) for b in sets[i + 1:]):
+            return True
+        empty = [_width(state, b)[0] == 0 for b in branches]
+        if sum(empty) > 1:
+            return True
+        samples = [_sample(state, b) for b in branches]
+        rxs = [_compiled(state, b) for b in branches]
+        for i, rx in enumerate(rxs):
+            for j, text in enumerate(samples):
+                if i == j or not text:
+                    continue
+                if rx is not None and not empty[i] and rx.match(text):
+                    return True
+                if empty[i] and whole is not None and whole.match(text):
+                    return True
+    return False
+
+
+def _repeated(item) -> bool:
+    return _is_repeat(item) and item[1][1] > 1
+
+
+def _chars(state, item) -> Optional[frozenset]:
+    """Characters of a one-character item, or of the body of a repeat of one."""
+    if _is_repeat(item):
+        return _charset(state, _body(item))
+    return _charset(state, [item])
+
+
+def _shapes(parsed) -> List[str]:
+    state = parsed.state
+    found: Dict[str, None] = {}
+    for item in _walk(parsed.data):
+        # an inner unbounded repeat backtracks badly under any repeat: (.*a){12}
+        if not _repeated(item):
+            continue
+        body = _flatten(_body(item))
+        for i, inner in enumerate(body):
+            if not _unbounded(inner):
+                continue
+            rest = body[:i] + body[i + 1:]
+            # nested: an unbounded repeat whose other body items may all be empty
+            if _width(state, rest)[0] == 0:
+                found["nested quantifier (exponential backtracking)"] = None
+                continue
+            # or each match the characters it repeats, as ([a-z]+.)+ or (x+x+)+
+            cs = _charset(state, _body(inner))
+            if cs and all(_width(state, [x])[0] == 0 or cs & (_chars(state, x) or frozenset()) for x in rest):
+                found["nested quantifier (exponential backtracking)"] = None
+        if not _unbounded(item):
+            continue
+        # nested: a repeat of something that may be empty, as (a?){25}
+        low, high = _width(state, body)
+        if low == 0 and high > 0:
+            found["nested quantifier (exponential backtracking)"] = None
+        # alternation of overlapping branches under a repeat
+        if _overlapping_branches(state, body):
+            found["overlapping alternation under a quantifier (exponential backtracking)"] = None
+    # adjacent: two unbounded single-character repeats sharing characters, only
+    # optional items between them
+    for seq in _sequences(parsed.data):
+        prev: Optional[frozenset] = None
+        for item in seq:
+            if _unbounded(item):
+                cs = _charset(state, _body(item))
+                if cs and prev and cs & prev:
+                    found["adjacent overlapping quantifiers (polynomial backtracking)"] = None
+                prev = cs
+            elif _width(state, [item])[0] > 0:
+                prev = None
+    return list(found)
+
+
+def _sequences(items) -> Iterator[list]:
+    seq = _flatten(items)
+    yield seq
+    for op, av in seq:
+        if op in _REPEATS:
+            yield from _sequences(av[2])
+        elif op is sre_parse.BRANCH:
+            for branch in av[1]:
+                yield from _sequences(branch)
+
+
+def _inputs(parsed) -> Iterator[Tuple[str, str, str]]:
+    """(text before, pumped body, text after) for every unbounded repeat."""
+    state = parsed.state
+    top = _flatten(parsed.data)
+    prefix = ""
+    for i, item in enumerate(top):
+        for node in _walk([item]):
+            if _unbounded(node):
+                pump = _sample(state, _body(node))
+                if pump:
+                    yield prefix, pump, _sample(state, top[i + 1:i + 2])
+        prefix += _sample(state, [item])
+
+
+def _cpu_time(fn, arg) -> float:
+    # CPU time of this process, not wall time: the check runs in a pool that
+    # may have more workers than free CPUs
+    t0 = time.process_time()
+    fn(arg)
+    return time.process_time() - t0
+
+
+def _slow(rx: "re.Pattern[str]", parsed) -> bool:
+    """Whether an adversarial search takes over BUDGET, twice in a row."""
+    search = rx.search
+    for prefix, pump, rest in _inputs(parsed):
+        n = 2
+        while True:
+            core = prefix + pump * n
+            for suffix in _SUFFIXES + (rest[:1] + "!",):
+                text = core + suffix
+                # confirm with a second run: one slow run can be a cache miss or a page fault
+                if _cpu_time(search, text) > BUDGET and _cpu_time(search, text) > BUDGET:
+                    return True
+            if len(core) >= MAX_INPUT:
+                break
+            n = n + 4 if n < 32 else n * 2
+    return False
+
+
+def glob_to_regex(pattern: str) -> str:
+    # USER-AGENT globs match the whole header
+    return "^" + re.escape(pattern).replace(r"\*", ".*").replace(r"\?", ".") + "$"
+
+
+def analyze(kind: str, pattern: str) -> List[str]:
+    """Findings for one URL-REGEX / USER-AGENT pattern; empty when it looks safe."""
+    rx_text = glob_to_regex(pattern) if kind == "USER-AGENT" else pattern
+    try:
+        parsed = sre_parse.parse(rx_text)
+        rx = re.compile(rx_text)
+    except (re.error, RecursionError, OverflowError) as e:
+        return [f"does not compile: {e}"]
+    findings = _shapes(parsed)
+    if _slow(rx, parsed):
+        findings.append(f"over the {BUDGET * 1000:.0f} ms budget on an adversarial input")
+    return findings
+
+
+# findings per (kind, pattern), kept for the life of the process (build.py --watch)
+_memo: Dict[Tuple[str, str], List[str]] = {}
+
+
+def _analyze_item(item: Tuple[str, str]) -> List[str]:
+    return analyze(*item)
+
+
+def _atoms(r: Rule) -> Iterator[Atom]:
+    if isinstance(r, Logical):
+        for x in r.items:
+            yield from _atoms(x)
+    elif isinstance(r, Atom):
+        yield r
+
+
+def check_patterns(
+    rules_by_policy: List[Tuple[str, List[Rule]]],
+    files: Optional[Dict[str, str]] = None,
+    jobs: int = 1,
+) -> Tuple[List[CompileWarning], int]:
+    """One warning per finding, and the number of rules with findings."""
+    files = files or {}
+    where: Dict[Tuple[str, str], List[Tuple[str, Rule]]] = {}
+    for policy, rules in rules_by_policy:
+        fname = files.get(policy, policy)
+        for r in rules:
+            for a in _atoms(r):
+                if a.rtype in ("URL-REGEX", "USER-AGENT"):
+                    where.setdefault((a.rtype, a.value), []).append((f"{fname}:{r.lineno}", r))
+    patterns = list(where)
+    todo = [p for p in patterns if p not in _memo]
+    if jobs > 1 and len(todo) >= POOL_MIN:
+        results = map_ordered(_analyze_item, todo, jobs)
+    else:
+        results = [_analyze_item(p) for p in todo]
+    _memo.update(zip(todo, results))
+    results = [_memo[p] for p in patterns]
+
+    warnings: List[CompileWarning] = []
+    flagged = 0
+    for key, findings in zip(patterns, results):
+        if not findings:
+            continue
+        for at, r in where[key]:
+            flagged += 1
+            for f in findings:
+                warnings.append(CompileWarning(file=at, line=rule_text(r), reason=f"{key[0]} {f}"))
+    return warnings, flagged
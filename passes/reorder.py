@@ -0,0 +1,351 @@
+from __future__ import annotations
+
+import re
+from bisect import bisect_left, insort
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from dsl.ast import Atom, Rule, rule_text
+from match.engine import NO_MATCH, Matcher, parse_probe
+from passes.cidr import parse_cidr
+from compiler.base import CompileWarning
+
+
+# Profile-guided rule order (build.py --hit-log).
+#
+# Clients that keep the order of a policy's rules (Surge, Loon, Quantumult X)
+# compare a connection with them one by one until one matches, so a hot host
+# below thousands of cold rules pays for all of them on every lookup.
+# reorder_rules() counts which rule each host / IP of a local log hits, with
+# match.engine.Matcher, and moves the hot rules of every policy up, hottest first.
+#
+# Only the order inside a policy changes, and two rules only trade places when
+# no connection can match both ("disjoint"), so every connection is still
+# decided by the same rule:
+#   DOMAIN / DOMAIN-SUFFIX    disjoint unless one name is, or is under, the other suffix
+#   DOMAIN-KEYWORD / -WILDCARD  disjoint from a DOMAIN they do not match; assumed
+#                             to overlap every suffix, keyword and wildcard
+#   IP-CIDR / IP-CIDR6        disjoint ranges of one family, both with or both
+#                             without no-resolve (a resolving rule lets later
+#                             no-resolve rules see the address)
+#   DST-PORT                  disjoint port ranges
+#   AND(...)                  as its DOMAIN* (else DST-PORT) operand, when it has no
+#                             IP operand
+# A host rule and an IP or port rule can match the same connection. Other
+# logical rules, rules with other options and every other type are taken to
+# overlap everything and never move.
+#
+# Hot rules move hottest first, each as far up as it can: past the colder rules
+# above it it is disjoint from, stopping below the first it may overlap or the
+# first hotter one. A rule only ever passes colder ones, so the logged lookups
+# never cost more in total; cold rules keep their order. The cost is counted
+# for a linear scan over all policies: a lookup decided by the rule at position
+# p takes p + 1 comparisons, a lookup nothing matches one per rule.
+
+_HOST, _IP, _PORT = "host", "ip", "port"
+_HOST_TYPES = ("DOMAIN", "DOMAIN-SUFFIX", "DOMAIN-KEYWORD", "DOMAIN-WILDCARD")
+_BULK_TYPES = ("DOMAIN-SUFFIX", "DOMAIN-KEYWORD", "DOMAIN-WILDCARD")
+# types whose evaluation can look up the host's address
+_RESOLVING = ("IP-CIDR", "IP-CIDR6", "GEOIP", "IP-ASN")
+
+# (kind, ...) of a rule that may move; None for one that overlaps everything
+Key = Optional[Tuple[Any, ...]]
+
+
+def read_hit_log(path: Path) -> Tuple[Dict[str, int], int]:
+    """
+    Lookup counts from a log with one host, IP, host:port or URL per line and an
+    optional count before or after it (`sort | uniq -c` output reads as is);
+    blank lines and # comments are skipped. Returns the count per target and
+    the number of lines that could not be read.
+    """
+    counts: Dict[str, int] = {}
+    bad = 0
+    with open(path, encoding="utf-8", errors="replace") as fh:
+        for line in fh:
+            parts = line.replace(",", " ").split()
+            if not parts or parts[0].startswith("#"):
+                continue
+            if len(parts) == 1:
+                target, n = parts[0], 1
+            elif len(parts) == 2 and parts[0].isdigit():
+                n, target = int(parts[0]), parts[1]
+            elif len(parts) == 2 and parts[1].isdigit():
+                target, n = parts[0], int(parts[1])
+            else:
+                bad += 1
+                continue
+            counts[target] = counts.get(target, 0) + n
+    return counts, bad
+
+
+def _glob_regex(pattern: str) -> "re.Pattern[str]":
+    # as match.engine reads DOMAIN-WILDCARD
+    return re.compile(re.escape(pattern).replace(r"\*", ".*").replace(r"\?", "."))
+
+
+def _key(r: Rule) -> Key:
+    if type(r) is not Atom:
+        if r.op != "AND" or any(type(x) is not Atom or x.rtype in _RESOLVING for x in r.items):
+            return None
+        # an AND matches a subset of what each operand matches: placed like its
+        # host (else port) operand, it still overlaps whatever it could. IP
+        # operands are left out: evaluating them may resolve the host.
+        keys = [_key(x) for x in r.items]
+        return next((k for kind in (_HOST, _PORT) for k in keys if k is not None and k[0] == kind), None)
+    t = r.rtype
+    if t in _HOST_TYPES:
+        v = r.value.strip().lower()
+        if t != "DOMAIN-KEYWORD":
+            v = v.rstrip(".")
+        return (_HOST, t, v) if v and not r.options else None
+    if t in ("IP-CIDR", "IP-CIDR6"):
+        parsed = parse_cidr(r.value)
+        if parsed is None or any(o != "no-resolve" for o in r.options):
+            return None
+        return (_IP, "no-resolve" in r.options, *parsed)
+    if t == "DST-PORT":
+        lo, sep, hi = r.value.strip().partition("-")
+        if r.options or not lo.isdigit() or (sep and not hi.isdigit()):
+            return None
+        return (_PORT, int(lo), int(hi) if sep else int(lo))
+    return None
+
+
+def _suffixes(name: str):
+    """The proper dotted suffixes of `name`: a.b.c -> b.c, c."""
+    i = name.find(".")
+    while i >= 0:
+        yield name[i + 1:]
+        i = name.find(".", i + 1)
+
+
+class _Ranges:
+    """Intervals with a position each; finds the positions of those meeting a query interval."""
+
+    def __init__(self):
+        self.items: List[Tuple[int, int, int]] = []  # (first, last, position)
+
+    def freeze(self) -> None:
+        self.items.sort()
+        self.firsts = [a for a, _, _ in self.items]
+        # reach[k]: the largest last of items[:k + 1], to stop the backward walk
+        self.reach: List[int] = []
+        m = -1
+        for _, b, _ in self.items:
+            m = max(m, b)
+            self.reach.append(m)
+
+    def meeting(self, a: int, b: int) -> List[int]:
+        out: List[int] = []
+        k = bisect_left(self.firsts, b + 1) - 1
+        while k >= 0 and self.reach[k] >= a:
+            if self.items[k][1] >= a:
+                out.append(self.items[k][2])
+            k -= 1
+        out.sort()
+        return out
+
+
+class _Index:
+    """One policy's rules (or a subset), looked up by which of them could overlap a key."""
+
+    def __init__(self, keyed: List[Tuple[int, Key]]):
+        self.all: List[int] = []
+        self.barriers: List[int] = []
+        self.kinds: Dict[str, List[int]] = {_HOST: [], _IP: [], _PORT: []}
+        self.names: Dict[Tuple[str, str], List[int]] = {}
+        self.under: Dict[str, List[int]] = {}  # suffix -> DOMAIN / DOMAIN-SUFFIX rules below it
+        self.bulk: Dict[str, List[int]] = {t: [] for t in _BULK_TYPES}
+        self.domains: List[Tuple[int, str]] = []
+        self.keywords: List[Tuple[int, str]] = []
+        self.wildcards: List[Tuple[int, "re.Pattern[str]"]] = []
+        self.resolving: Dict[bool, List[int]] = {False: [], True: []}  # no-resolve -> IP rules
+        self.ranges: Dict[Tuple[Any, ...], _Ranges] = {}
+        for pos, key in keyed:
+            self.all.append(pos)
+            if key is None:
+                self.barriers.append(pos)
+                continue
+            self.kinds[key[0]].append(pos)
+            if key[0] == _HOST:
+                _, t, v = key
+                if t in _BULK_TYPES:
+                    self.bulk[t].append(pos)
+                if t == "DOMAIN-KEYWORD":
+                    self.keywords.append((pos, v))
+                elif t == "DOMAIN-WILDCARD":
+                    self.wildcards.append((pos, _glob_regex(v)))
+                else:
+                    self.names.setdefault((t, v), []).append(pos)
+                    for s in _suffixes(v):
+                        self.under.setdefault(s, []).append(pos)
+                    if t == "DOMAIN":
+                        self.domains.append((pos, v))
+            elif key[0] == _IP:
+                _, nr, version, a, b = key
+                self.resolving[nr].append(pos)
+                self.ranges.setdefault((_IP, nr, version), _Ranges()).items.append((a, b, pos))
+            else:
+                self.ranges.setdefault((_PORT,), _Ranges()).items.append((key[1], key[2], pos))
+        for r in self.ranges.values():
+            r.freeze()
+
+    def overlapping(self, key: Key) -> List[List[int]]:
+        """Sorted position lists that hold every indexed rule which may overlap `key`."""
+        if key is None:
+            return [self.all]
+        kind = key[0]
+        out = [self.barriers] + [v for k, v in self.kinds.items() if k != kind]
+        if kind == _IP:
+            _, nr, version, a, b = key
+            out.append(self.resolving[not nr])
+            ranges = self.ranges.get((_IP, nr, version))
+            if ranges is not None:
+                out.append(ranges.meeting(a, b))
+            return out
+        if kind == _PORT:
+            ranges = self.ranges.get((_PORT,))
+            if ranges is not None:
+                out.append(ranges.meeting(key[1], key[2]))
+            return out
+        _, t, v = key
+        names = self.names
+        if t == "DOMAIN":
+            out += [names.get(("DOMAIN", v), []), names.get(("DOMAIN-SUFFIX", v), [])]
+            out += [names.get(("DOMAIN-SUFFIX", s), []) for s in _suffixes(v)]
+            out.append([pos for pos, k in self.keywords if k in v])
+            out.append([pos for pos, rx in self.wildcards if rx.fullmatch(v)])
+            return out
+        out += [self.bulk["DOMAIN-KEYWORD"], self.bulk["DOMAIN-WILDCARD"]]
+        if t == "DOMAIN-SUFFIX":
+            out += [names.get(("DOMAIN", v), []), names.get(("DOMAIN-SUFFIX", v), []), self.under.get(v, [])]
+            out += [names.get(("DOMAIN-SUFFIX", s), []) for s in _suffixes(v)]
+            return out
+        out.append(self.bulk["DOMAIN-SUFFIX"])
+        if t == "DOMAIN-KEYWORD":
+            out.append([pos for pos, x in self.domains if v in x])
+        else:
+            rx = _glob_regex(v)
+            out.append([pos for pos, x in self.domains if rx.fullmatch(x)])
+        return out
+
+
+def _order(keys: List[Key], hits: List[int]) -> List[int]:
+    """
+    One policy's rules with each hot rule, hottest first, moved up past the
+    colder rules above it that it is disjoint from.
+    """
+    cold = [i for i, h in enumerate(hits) if not h]
+    hot = sorted((i for i, h in enumerate(hits) if h), key=lambda i: (-hits[i], i))
+    cold_index = _Index([(i, keys[i]) for i in cold])
+    waiting = sorted(hot)  # hot rules not moved yet
+    hot_index = _Index([(i, keys[i]) for i in waiting])
+    # The rules not moved yet keep their order; a moved rule sits in the list of
+    # the one it follows (-1: the top). A rule stops below the first rule above
+    # it that it may overlap, or that is hotter (has moved already).
+    pending = set(hot)
+    moved: Dict[int, List[int]] = {}
+    anchors: List[int] = []  # sorted keys of moved
+    for i in hot:
+        key = keys[i]
+        stop = max((ps[k - 1] for ps in cold_index.overlapping(key) for k in (bisect_left(ps, i),) if k), default=-1)
+        for ps in hot_index.overlapping(key):
+            for p in reversed(ps[:bisect_left(ps, i)]):
+                if p <= stop:
+                    break
+                if p in pending:
+                    stop = p
+                    break
+        k = bisect_left(anchors, i)
+        if k and anchors[k - 1] > stop:
+            stop = anchors[k - 1]
+        k = bisect_left(waiting, i)
+        waiting.pop(k)
+        pending.discard(i)
+        c = bisect_left(cold, i)
+        prev = max(waiting[k - 1] if k else -1, cold[c - 1] if c else -1)
+        if stop not in moved:
+            insort(anchors, stop)
+        moved.setdefault(stop, []).append(i)
+        below = moved.pop(i, None)
+        if below:
+            # the rules that had moved up to just below this one stay where they are
+            anchors.remove(i)
+            if prev not in moved:
+                insort(anchors, prev)
+            moved.setdefault(prev, []).extend(below)
+    out = list(moved.get(-1, ()))
+    for i in sorted(cold + waiting):
+        out.append(i)
+        out += moved.get(i, ())
+    return out
+
+
+def reorder_rules(
+    rules_by_policy: List[Tuple[str, List[Rule]]],
+    lookups: Dict[str, int],
+    files: Optional[Dict[str, str]] = None,
+    log_name: str = "hit log",
+) -> Tuple[List[Tuple[str, List[Rule]]], List[CompileWarning], int, Dict[str, Any]]:
+    """
+    Returns the reordered rules, the report (the saving, then one line per rule
+    moved up), the number of rules moved up and a summary for build_report.json.
+    `lookups` maps a host, IP, host:port or URL to how often it was looked up.
+    """
+    files = files or {}
+    matcher = Matcher(rules_by_policy, files)
+    hits = [0] * len(matcher.entries)
+    total = unmatched = 0
+    for target, n in lookups.items():
+        rank = matcher.rank(parse_probe(target))
+        total += n
+        if rank == NO_MATCH:
+            unmatched += n
+        else:
+            hits[rank] += n
+
+    out: List[Tuple[str, List[Rule]]] = []
+    report: List[CompileWarning] = []
+    by_policy: Dict[str, Dict[str, int]] = {}
+    cost_before = cost_after = unmatched * len(hits)
+    moved = base = 0
+    for policy, rules in rules_by_policy:
+        fname = files.get(policy, policy)
+        h = hits[base:base + len(rules)]
+        order = _order([_key(r) for r in rules], h) if any(h) else range(len(rules))
+        before = after = up = 0
+        for new, old in enumerate(order):
+            if not h[old]:
+                continue
+            before += h[old] * (base + old + 1)
+            after += h[old] * (base + new + 1)
+            if new < old:
+                up += 1
+                r = rules[old]
+                report.append(CompileWarning(file=f"{fname}:{r.lineno}", line=rule_text(r), reason=f"moved from #{old + 1} to #{new + 1} ({h[old]} hits)"))
+        out.append((policy, [rules[i] for i in order]))
+        by_policy[policy] = {"hits": sum(h), "moved": up, "comparisons_before": before, "comparisons_after": after}
+        cost_before += before
+        cost_after += after
+        moved += up
+        base += len(rules)
+
+    per_before = cost_before / total if total else 0.0
+    per_after = cost_after / total if total else 0.0
+    saved = 100 * (1 - per_after / per_before) if per_before else 0.0
+    report.insert(0, CompileWarning(
+        file=log_name,
+        line=f"{total} lookups, {unmatched} unmatched",
+        reason=f"rule comparisons per lookup {per_before:.1f} -> {per_after:.1f} (-{saved:.1f}%)",
+    ))
+    summary = {
+        "log": log_name,
+        "lookups": total,
+        "unmatched": unmatched,
+        "moved": moved,
+        "comparisons_per_lookup": {"before": round(per_before, 2), "after": round(per_after, 2)},
+        "reduction_percent": round(saved, 2),
+        "by_policy": by_policy,
+    }
+    return out, report, moved, summary
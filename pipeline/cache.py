@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import marshal
+import os
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+from dsl.ast import Atom, Logical, Rule
+from dsl.table import RuleTable
+
+
+# Incremental build state, kept under .cache/:
+#   manifest.json      content digests of inputs, per-target input keys, output digests
+#   ast/<file>.bin     marshal snapshot of the parsed rules of one rules file
+#
+# Input digests are re-used while a file's (size, mtime_ns) is unchanged, so a
+# no-op rebuild only stats the inputs and never reads or parses them. A snapshot
+# is also keyed by the sources that produce and lay it out (SNAPSHOT_SOURCES),
+# so editing the parser or the table format invalidates it.
+
+MANIFEST_VERSION = 1
+SNAPSHOT_VERSION = 2
+
+_ROOT = Path(__file__).resolve().parent.parent
+SNAPSHOT_SOURCES = ("dsl/parser.py", "dsl/ast.py", "dsl/table.py")
+
+_CHUNK = 1 << 20
+
+
+def digest_bytes(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def digest_file(path: Path) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as fh:
+        while True:
+            chunk = fh.read(_CHUNK)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def digest_parts(parts: Iterable[str]) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for p in parts:
+        h.update(p.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class BuildCache:
+    def __init__(self, cache_dir: Path, enabled: bool = True):
+        self.dir = cache_dir
+        self.enabled = enabled
+        self.manifest: Dict[str, Any] = {"version": MANIFEST_VERSION, "files": {}, "targets": {}}
+        self._sources_key: Optional[str] = None
+        if enabled:
+            self._load()
+
+    def _load(self) -> None:
+        try:
+            data = json.loads((self.dir / "manifest.json").read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return
+        if data.get("version") == MANIFEST_VERSION:
+            self.manifest = data
+
+    def save(self) -> None:
+        if not self.enabled:
+            return
+        self.dir.mkdir(parents=True, exist_ok=True)
+        tmp = self.dir / "manifest.json.tmp"
+        tmp.write_text(json.dumps(self.manifest, sort_keys=True), encoding="utf-8")
+        os.replace(tmp, self.dir / "manifest.json")
+
+    # ---- inputs ----
+
+    def file_digest(self, path: Path) -> str:
+        """Content digest of `path`, re-hashing only when its size or mtime changed."""
+        st = path.stat()
+        key = str(path)
+        ent = self.manifest["files"].get(key)
+        if ent and ent["size"] == st.st_size and ent["mtime_ns"] == st.st_mtime_ns:
+            return ent["digest"]
+        d = digest_file(path)
+        self.manifest["files"][key] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "digest": d}
+        return d
+
+    def sources_key(self) -> str:
+        """Digest of SNAPSHOT_SOURCES; snapshots written by other sources are stale."""
+        if self._sources_key is None:
+            self._sources_key = digest_parts(self.file_digest(_ROOT / src) for src in SNAPSHOT_SOURCES)
+        return self._sources_key
+
+    def load_snapshot(self, name: str, digest: str) -> Optional[List[Rule]]:
+        if not self.enabled:
+            return None
+        try:
+            data = (self.dir / "ast" / f"{name}.bin").read_bytes()
+            version, sources, snap_digest, cols = marshal.loads(data)
+        except (OSError, ValueError, EOFError, TypeError):
+            return None
+        if version != SNAPSHOT_VERSION or sources != self.sources_key() or snap_digest != digest:
+            return None
+        return decode_rules(cols)
+
+    def store_snapshot(self, name: str, digest: str, rules: List[Rule]) -> None:
+        if not self.enabled:
+            return
+        d = self.dir / "ast"
+        d.mkdir(parents=True, exist_ok=True)
+        tmp = d / f"{name}.bin.tmp"
+        tmp.write_bytes(marshal.dumps((SNAPSHOT_VERSION, self.sources_key(), digest, encode_rules(rules))))
+        os.replace(tmp, d / f"{name}.bin")
+
+    # ---- targets / outputs ----
+
+    def target(self, name: str) -> Dict[str, Any]:
+        return self.manifest["targets"].get(name, {})
+
+    def set_target(self, name: str, entry: Dict[str, Any]) -> None:
+        self.manifest["targets"][name] = entry
+
+    def target_fresh(self, name: str, key: str, out_dir: Path, field: str = "key") -> bool:
+        """
+        True when `name` was last built from `key` and its outputs are untouched.
+        `field` is the entry's key compared: "key" (the rules files) or "rules"
+        (the lowered rules the target was compiled from).
+        """
+        if not self.enabled:
+            return False
+        ent = self.target(name)
+        if ent.get(field) != key:
+            return False
+        for fname, rec in ent.get("outputs", {}).items():
+            try:
+                st = (out_dir / fname).stat()
+            except OSError:
+                return False
+            if st.st_size != rec["size"] or st.st_mtime_ns != rec["mtime_ns"]:
+                return False
+        return True
+
+
+# A snapshot stores one rules file column-wise so marshal can write it compactly:
+#   (table, logicals)
+# where table is dsl.table.RuleTable.columns() of the file's atoms (type codes,
+# indices into a deduplicated value pool, line numbers; options sparse) and
+# logicals maps row -> (nested (op, items) tuples, lineno) for non-atom rows.
+def encode_rules(rules: List[Rule]) -> tuple:
+    table = RuleTable()
+    logicals: Dict[int, tuple] = {}
+    for row, r in enumerate(rules):
+        if type(r) is Atom:
+            table.append("", r)
+        else:
+            logicals[row] = (_encode_logical(r), r.lineno)
+    return (table.compact().columns(), logicals)
+
+
+def decode_rules(cols: tuple) -> List[Rule]:
+    table, logicals = cols
+    atoms = RuleTable.from_columns(table).atoms()
+    if not logicals:
+        return atoms
+    rules: List[Rule] = []
+    append = rules.append
+    it = iter(atoms)
+    for row in range(len(atoms) + len(logicals)):
+        t = logicals.get(row)
+        append(next(it) if t is None else _decode_logical(*t))
+    return rules
+
+
+def _encode_logical(r: Rule) -> tuple:
+    if isinstance(r, Atom):
+        return (r.rtype, r.value, r.options)
+    if isinstance(r, Logical):
+        return (r.op, tuple(_encode_logical(x) for x in r.items))
+    raise TypeError(f"cannot snapshot {r!r}")
+
+
+def _decode_logical(t: tuple, lineno: int = 0) -> Rule:
+    if len(t) == 3:
+        return Atom(t[0], t[1], t[2], lineno)
+    return Logical(t[0], [_decode_logical(x) for x in t[1]], lineno)
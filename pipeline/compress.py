@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import gzip
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+try:
+    import brotli  # optional: pip install brotli
+except ImportError:
+    brotli = None
+
+from pipeline.cache import digest_bytes
+from pipeline.writer import AtomicWriter
+
+
+# Precompressed variants of served files, keyed by content digest:
+#   .cache/compressed/<digest>.gz   gzip, level 9
+#   .cache/compressed/<digest>.br   brotli, quality 11 (only with the brotli module)
+#
+# They live outside dist/ so the committed artifacts stay as they are, and since
+# the key is the content digest a file that did not change is never compressed
+# again. `build.py --precompress` writes them; `build.py serve` sends them to
+# clients that accept the encoding.
+
+# (Content-Encoding token, file suffix), preferred first
+ENCODINGS: List[Tuple[str, str]] = ([("br", ".br")] if brotli is not None else []) + [("gzip", ".gz")]
+
+# below this a compressed variant saves less than its response headers cost
+MIN_SIZE = 1024
+
+
+def variant_path(store: Path, digest: str, suffix: str) -> Path:
+    return store / f"{digest}{suffix}"
+
+
+def _compress(data: bytes, suffix: str) -> bytes:
+    if suffix == ".br":
+        return brotli.compress(data, quality=11)
+    # mtime=0: the same content always gives the same bytes
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def precompress(item: Tuple[str, str, str]) -> Dict[str, int]:
+    """
+    Write the missing variants of one file; `item` is (source path, its content
+    digest, store directory). Returns {suffix: size} of the variants written.
+    A module-level function of one argument, so it can run in map_ordered.
+    """
+    src, digest, store = item
+    missing = [s for _, s in ENCODINGS if not variant_path(Path(store), digest, s).exists()]
+    if not missing:
+        return {}
+    data = Path(src).read_bytes()
+    if len(data) < MIN_SIZE or digest_bytes(data) != digest:
+        # too small, or rewritten since it was hashed
+        return {}
+    Path(store).mkdir(parents=True, exist_ok=True)
+    out: Dict[str, int] = {}
+    for suffix in missing:
+        packed = _compress(data, suffix)
+        if len(packed) >= len(data):
+            continue
+        with AtomicWriter(variant_path(Path(store), digest, suffix)) as w:
+            w.write_bytes(packed)
+        out[suffix] = len(packed)
+    return out
@@ -0,0 +1,289 @@
+from __future__ import annotations
+
+import gzip
+import ipaddress
+import re
+import sys
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Set, TextIO, Tuple
+
+from pipeline.writer import AtomicWriter
+
+
+# `build.py import`: third-party block/region lists -> rules/*.list lines.
+#
+#   hosts     "0.0.0.0 ads.example.com [more names]"      -> DOMAIN
+#   adblock   "||example.com^" (optionally "$important")  -> DOMAIN-SUFFIX
+#   dnsmasq   "server=/a.com/b.com/1.2.3.4", "address=/", "local=/" -> DOMAIN-SUFFIX
+#   domains   one name per line ("+." / "." / "*." prefix = suffix) -> --plain-type
+#
+# Anything else (adblock exceptions, cosmetic or option-restricted filters,
+# paths, wildcards) is counted and left out: it has no exact DSL equivalent.
+#
+# Sources are read in large chunks and lower-cased and scanned with one regex per
+# chunk, so only the extracted names reach Python code; memory stays at a chunk
+# plus the duplicate filter whatever the size of the list. Names are normalized
+# (case, IDNA, trailing dots) and validated, exact duplicates are dropped with a
+# fixed-size fingerprint table, and the output is written through AtomicWriter.
+# Duplicates across rule types (a DOMAIN under a DOMAIN-SUFFIX) are left to the
+# optimizer at build time.
+
+_CHUNK = 1 << 20
+_SNIFF = 1 << 16
+# memory per key of BoundedSet: an int object plus its share of the set table
+_ENTRY_BYTES = 72
+
+_LINE_RES: Dict[str, "re.Pattern[str]"] = {
+    "hosts": re.compile(r"^[ \t]*([0-9a-f.:]+(?:%\w+)?)[ \t]+([^#\n]*[^#\s])", re.M),
+    "adblock": re.compile(r"^\|\|([^\s^$/|*]+)\^(?:\$important)?[ \t]*$", re.M),
+    "dnsmasq": re.compile(r"^[ \t]*(?:server|address|local)=/([^#\n]+?)/[^/\n]*$", re.M),
+    "domains": re.compile(r"^[ \t]*(\+?\.|\*\.)?([^\s#!;/|^$]+)[ \t]*(?:#.*)?$", re.M),
+}
+FORMATS = tuple(_LINE_RES)
+
+_LABEL = r"[a-z0-9_](?:[a-z0-9_-]{0,61}[a-z0-9_])?"
+_HOST_RE = re.compile(rf"(?:{_LABEL}\.)*{_LABEL}")
+# "TYPE,name" lines are validated a block at a time: the names in a block that
+# passes these checks are all valid and already normalized, and normalize_host
+# only runs on the parts of a chunk that fail them
+_ENTRIES_RE = re.compile(r"(?:[A-Z-]+,(?:[a-z0-9_-]{1,63}\.)*[a-z0-9_-]{1,63}\n)*")
+_NUMERIC_TLD_RES = (re.compile(r"\.[0-9]+\n"), re.compile(r",[0-9]+\n"))
+_HYPHEN_EDGES = ("-.", ".-", ",-", "-\n")
+# longer entries may hold a name over 253 characters ("DOMAIN," is the shortest type)
+_ENTRY_MAX = len("DOMAIN,") + 253
+# blocks that fail are split down to this size before names are checked one by one
+_ENTRIES_SPLIT = 256
+
+# names hosts files map for the local machine, not for blocking
+_LOCAL_NAMES = frozenset((
+    "localhost", "localhost.localdomain", "local", "broadcasthost", "ip6-localhost",
+    "ip6-loopback", "ip6-localnet", "ip6-mcastprefix", "ip6-allnodes", "ip6-allrouters",
+    "ip6-allhosts", "0.0.0.0",
+))
+
+
+class BoundedSet:
+    """
+    Exact-duplicate filter in bounded memory: keeps the 64-bit hash() of each
+    key instead of the key, about _ENTRY_BYTES apiece, up to `max_bytes`. Once
+    full, new keys are no longer recorded (`full` is set) and later duplicates
+    of them pass through; a hash collision (about n^2 / 2^65) drops a key.
+    """
+
+    def __init__(self, max_bytes: int):
+        self._hashes: Set[int] = set()
+        self.limit = max(1, max_bytes // _ENTRY_BYTES)
+        self.full = False
+
+    @property
+    def size(self) -> int:
+        return len(self._hashes)
+
+    def new(self, keys: List[str]) -> List[str]:
+        """The keys not seen before (first occurrence only), in order; records them."""
+        hashes = self._hashes
+        if len(hashes) + len(keys) <= self.limit:
+            add = hashes.add
+            return [k for k, h in zip(keys, map(hash, keys)) if not (h in hashes or add(h))]
+        out: List[str] = []
+        for k in keys:
+            h = hash(k)
+            if h in hashes:
+                continue
+            out.append(k)
+            if len(hashes) < self.limit:
+                hashes.add(h)
+            else:
+                self.full = True
+        return out
+
+
+def normalize_host(name: str) -> Optional[str]:
+    """Lower-case ASCII (IDNA) form of a host name without trailing dots; None if it is not one."""
+    name = name.rstrip(".").lower()
+    if not name.isascii():
+        try:
+            name = name.encode("idna").decode("ascii")
+        except UnicodeError:
+            return None
+    if len(name) > 253 or not _HOST_RE.fullmatch(name):
+        return None
+    if name.rpartition(".")[2].isdigit():
+        # an IPv4 address, or a name no resolver would look up
+        return None
+    return name
+
+
+def open_source(src: str) -> TextIO:
+    """A list file as text ("-" for stdin, *.gz decompressed on the fly)."""
+    if src == "-":
+        return sys.stdin
+    if src.endswith(".gz"):
+        return gzip.open(src, "rt", encoding="utf-8", errors="replace")
+    return open(src, encoding="utf-8", errors="replace", buffering=1 << 20)
+
+
+def sniff_format(head: str) -> Optional[str]:
+    """The format most lines of `head` (the start of a list) are in."""
+    head = head.lower().replace("\r", "")
+    counts = {fmt: sum(1 for _ in rx.finditer(head)) for fmt, rx in _LINE_RES.items()}
+    # the patterns exclude each other's lines; a tie goes to the format listed first
+    best = max(FORMATS, key=lambda f: counts[f])
+    return best if counts[best] else None
+
+
+def _chunks(fh: TextIO, head: str = "") -> Iterator[str]:
+    """Whole lines, lower-cased, in blocks of about _CHUNK characters; `head` was already read from `fh`."""
+    carry = head
+    while True:
+        block = fh.read(_CHUNK)
+        if not block:
+            break
+        block = carry + block
+        cut = block.rfind("\n") + 1
+        if cut == 0:
+            carry = block
+            continue
+        carry = block[cut:]
+        yield block[:cut].lower().replace("\r", "")
+    if carry:
+        yield carry.lower().replace("\r", "") + ("" if carry.endswith("\n") else "\n")
+
+
+def _is_ip(token: str, memo: Dict[str, bool]) -> bool:
+    known = memo.get(token)
+    if known is None:
+        try:
+            ipaddress.ip_address(token.partition("%")[0])
+            known = True
+        except ValueError:
+            known = False
+        memo[token] = known
+    return known
+
+
+def _scan(fmt: str, chunk: str, plain_type: str) -> Tuple[int, List[str]]:
+    """Lines of one chunk of a `fmt` list that hold entries, and the entries as "TYPE,raw name"."""
+    rx = _LINE_RES[fmt]
+    if fmt == "adblock":
+        names = rx.findall(chunk)
+        return len(names), ["DOMAIN-SUFFIX," + n for n in names]
+    if fmt == "domains":
+        found = rx.findall(chunk)
+        plain = plain_type + ","
+        return len(found), [("DOMAIN-SUFFIX," if prefix else plain) + n for prefix, n in found]
+    lines = 0
+    out: List[str] = []
+    if fmt == "hosts":
+        memo: Dict[str, bool] = {}
+        for addr, names in rx.findall(chunk):
+            if _is_ip(addr, memo):
+                lines += 1
+                out += ["DOMAIN," + n for n in names.split() if n not in _LOCAL_NAMES]
+    else:
+        for names in rx.findall(chunk):
+            lines += 1
+            out += ["DOMAIN-SUFFIX," + n for n in names.split("/")]
+    return lines, out
+
+
+class ImportStats:
+    __slots__ = ("lines", "written", "duplicates", "invalid", "ignored")
+
+    def __init__(self):
+        self.lines = self.written = self.duplicates = self.invalid = self.ignored = 0
+
+    def __str__(self) -> str:
+        return (f"{self.lines} lines: {self.written} rules written, {self.duplicates} duplicates, "
+                f"{self.invalid} invalid names, {self.ignored} other lines ignored")
+
+
+def import_lists(
+    sources: List[str],
+    out: Path,
+    fmt: Optional[str] = None,
+    plain_type: str = "DOMAIN-SUFFIX",
+    append: bool = False,
+    dedup_bytes: int = 128 << 20,
+    log: Callable[[str], None] = lambda s: None,
+) -> Tuple[ImportStats, BoundedSet]:
+    """
+    Convert `sources` (format `fmt`, or sniffed per file) into DSL lines and
+    atomically replace `out` with them. With `append`, the current lines of
+    `out` come first, unchanged, and count for the duplicate filter.
+    """
+    stats = ImportStats()
+    seen = BoundedSet(dedup_bytes)
+    w = AtomicWriter(out)
+    try:
+        if append and out.exists():
+            with open(out, encoding="utf-8") as fh:
+                for line in fh:
+                    text = line.strip()
+                    if text and text[0] not in "#;":
+                        seen.new([text])
+                    w.write(line if line.endswith("\n") else line + "\n")
+        for src in sources:
+            with open_source(src) as fh:
+                src_fmt = fmt
+                head = ""
+                if src_fmt is None:
+                    head = fh.read(_SNIFF)
+                    src_fmt = sniff_format(head)
+                    if src_fmt is None:
+                        raise ValueError(f"{src}: not a hosts, adblock, dnsmasq or plain domain list")
+                s = _import_one(fh, head, src_fmt, plain_type, seen, w)
+            log(f"{src} ({src_fmt}): {s}")
+            for f in ImportStats.__slots__:
+                setattr(stats, f, getattr(stats, f) + getattr(s, f))
+    except BaseException:
+        w.abort()
+        raise
+    w.commit()
+    return stats, seen
+
+
+def _entries_valid(entries: List[str]) -> bool:
+    if max(map(len, entries)) > _ENTRY_MAX:
+        return False
+    block = "\n".join(entries) + "\n"
+    if not _ENTRIES_RE.fullmatch(block) or any(h in block for h in _HYPHEN_EDGES):
+        return False
+    return not any(rx.search(block) for rx in _NUMERIC_TLD_RES)
+
+
+def _normalize_entries(entries: List[str]) -> Tuple[List[str], int]:
+    """Entries with normalized names, and how many were dropped as invalid."""
+    if _entries_valid(entries):
+        return entries, 0
+    if len(entries) > _ENTRIES_SPLIT:
+        mid = len(entries) // 2
+        head, bad_head = _normalize_entries(entries[:mid])
+        tail, bad_tail = _normalize_entries(entries[mid:])
+        return head + tail, bad_head + bad_tail
+    out: List[str] = []
+    for entry in entries:
+        rtype, _, raw = entry.partition(",")
+        name = normalize_host(raw)
+        if name is not None:
+            out.append(f"{rtype},{name}")
+    return out, len(entries) - len(out)
+
+
+def _import_one(fh: TextIO, head: str, fmt: str, plain_type: str, seen: BoundedSet, w: AtomicWriter) -> ImportStats:
+    stats = ImportStats()
+    for chunk in _chunks(fh, head):
+        lines = chunk.count("\n")
+        matched, entries = _scan(fmt, chunk, plain_type)
+        stats.lines += lines
+        stats.ignored += lines - matched
+        if not entries:
+            continue
+        entries, invalid = _normalize_entries(entries)
+        stats.invalid += invalid
+        out = seen.new(entries)
+        stats.duplicates += len(entries) - len(out)
+        if out:
+            stats.written += len(out)
+            w.write("\n".join(out) + "\n")
+    return stats
@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from dsl.ast import Rule
+from compiler.ir import RuleIR
+from pipeline.cache import decode_rules, encode_rules
+
+
+# Process-pool helpers behind `build.py --jobs N`.
+#
+# Parse workers hand rules back in the column encoding used by the snapshots
+# (lists of strings + packed arrays), which pickles far faster than AST objects.
+# Compile workers receive the lowered rules (compiler.ir.RuleIR) once, through
+# the pool initializer: with the fork start method that is a copy-on-write
+# inheritance, elsewhere a single pickle per worker. Results are always collected in submission order,
+# so the output does not depend on scheduling.
+
+_worker_ir: Optional[RuleIR] = None
+
+
+def resolve_jobs(jobs: int) -> int:
+    if jobs <= 0:
+        return os.cpu_count() or 1
+    return jobs
+
+
+def _context():
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("fork" if "fork" in methods else None)
+
+
+def parse_files(
+    parse: Callable[[Path], List[Rule]],
+    paths: Sequence[Path],
+    jobs: int,
+) -> List[List[Rule]]:
+    """Run `parse` over `paths` in a process pool; results are in `paths` order."""
+    workers = min(jobs, len(paths))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=_context()) as ex:
+        futures = [ex.submit(_parse_encoded, parse, p) for p in paths]
+        return [decode_rules(f.result()) for f in futures]
+
+
+def _parse_encoded(parse: Callable[[Path], List[Rule]], path: Path) -> tuple:
+    return encode_rules(parse(path))
+
+
+def compile_targets(
+    compile_one: Callable[..., Any],
+    names: Sequence[str],
+    ir: RuleIR,
+    args_by_name: Dict[str, tuple],
+    jobs: int,
+) -> Dict[str, Any]:
+    """
+    Call compile_one(name, ir, *args_by_name[name]) for every name
+    in a process pool and return {name: result}.
+    """
+    workers = min(jobs, len(names))
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=_context(),
+        initializer=_init_compile_worker,
+        initargs=(ir,),
+    ) as ex:
+        futures = [(n, ex.submit(_compile_in_worker, compile_one, n, args_by_name[n])) for n in names]
+        return {n: f.result() for n, f in futures}
+
+
+def _init_compile_worker(ir: RuleIR) -> None:
+    global _worker_ir
+    _worker_ir = ir
+
+
+def _compile_in_worker(compile_one: Callable[..., Any], name: str, args: tuple) -> Any:
+    return compile_one(name, _worker_ir, *args)
+
+
+def map_ordered(fn: Callable[[Any], Any], items: Sequence[Any], jobs: int, chunksize: int = 16) -> List[Any]:
+    """[fn(x) for x in items] in a process pool; `fn` must be a module-level function."""
+    workers = min(jobs, len(items))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=_context()) as ex:
+        return list(ex.map(fn, items, chunksize=chunksize))
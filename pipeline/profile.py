@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import cProfile
+import marshal
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from pipeline.writer import io_time
+
+
+# Per-stage cost accounting behind dist/build_report.json.
+#
+# Every stage gets wall and CPU time. A stage opened with `write=` has the time
+# AtomicWriter spent writing artifacts moved out into a separate write stage, so
+# "compile:clash" is the compiler itself and "write:clash" its file output.
+# With profiling on, each stage also runs under tracemalloc (peak of the stage)
+# and cProfile; only the profile of the slowest stage is kept for the dump.
+#
+# Stages must not nest (the tracemalloc peak is process-wide). Compile workers
+# of a parallel build measure their stages with their own StageProfiler and
+# hand back export(); merge() folds that into the parent's.
+
+
+class StageProfiler:
+    def __init__(self, profile: bool = False):
+        self.profile = profile
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self._slowest: Optional[Tuple[float, str, Dict[Any, Any]]] = None
+        if profile and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name: str, write: Optional[str] = None) -> Iterator[None]:
+        prof = None
+        if self.profile:
+            tracemalloc.reset_peak()
+            prof = cProfile.Profile()
+            prof.enable()
+        io_wall, io_cpu = io_time()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            if prof is not None:
+                prof.disable()
+            w_wall = w_cpu = 0.0
+            if write is not None:
+                w_wall, w_cpu = io_time()
+                w_wall, w_cpu = w_wall - io_wall, w_cpu - io_cpu
+            entry = {"wall": round(wall - w_wall, 4), "cpu": round(cpu - w_cpu, 4)}
+            peak = round(tracemalloc.get_traced_memory()[1] / 2**20, 2) if self.profile else None
+            if peak is not None:
+                entry["peak_mb"] = peak
+            self.stages[name] = entry
+            if write is not None:
+                self.stages[write] = {"wall": round(w_wall, 4), "cpu": round(w_cpu, 4)}
+                if peak is not None:
+                    # one allocation peak covers both halves
+                    self.stages[write]["peak_mb"] = peak
+            if prof is not None:
+                self._keep(wall - w_wall, name, _stats(prof))
+
+    def _keep(self, wall: float, name: str, stats: Dict[Any, Any]) -> None:
+        if self._slowest is None or wall > self._slowest[0]:
+            self._slowest = (wall, name, stats)
+
+    def export(self) -> Tuple[Dict[str, Dict[str, float]], Optional[Tuple[float, str, Dict[Any, Any]]]]:
+        return self.stages, self._slowest
+
+    def merge(self, exported: Tuple[Dict[str, Dict[str, float]], Optional[Tuple[float, str, Dict[Any, Any]]]]) -> None:
+        stages, slowest = exported
+        self.stages.update(stages)
+        if slowest is not None:
+            self._keep(*slowest)
+
+    def dump_slowest(self, path: Path) -> Optional[str]:
+        """Write the cProfile stats of the slowest stage (pstats format); returns its name."""
+        if self._slowest is None:
+            return None
+        with open(path, "wb") as fh:
+            marshal.dump(self._slowest[2], fh)
+        return self._slowest[1]
+
+
+def _stats(prof: cProfile.Profile) -> Dict[Any, Any]:
+    # the dict Profile.dump_stats() marshals; plain tuples, so it also pickles
+    # back from a worker process
+    prof.create_stats()
+    return prof.stats
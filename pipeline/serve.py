@@ -0,0 +1,384 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import os
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Set, Tuple
+from urllib.parse import unquote
+
+from pipeline.compress import ENCODINGS, MIN_SIZE, precompress, variant_path
+
+
+# `build.py serve`: dist/ and rules/ over HTTP, as a local stand-in for the raw
+# URL given to --base-raw-url (http://127.0.0.1:8080/dist/clash/... etc.).
+#
+# Clients poll their providers on a timer, so the server is built around
+# revalidation: every response carries a strong ETag (the content digest the
+# build cache already recorded for the file), and If-None-Match answers 304
+# without touching the body. Bodies go out with sendfile, as the precompressed
+# .gz/.br variant when the client accepts one (see pipeline/compress.py; a file
+# without a variant is compressed once in the background) or as a byte range of
+# the plain file. One asyncio loop serves all connections, so thousands of idle
+# keep-alive pollers cost a socket each and no thread.
+#
+# Only GET and HEAD of regular files below a mount are served; dotfiles (the
+# writers' temp files among them) are never visible.
+
+_MAX_LINE = 8192
+_MAX_HEADERS = 64
+_KEEPALIVE = 15.0
+_HASH_CHUNK = 1 << 20
+
+_TYPES = {
+    ".conf": "text/plain; charset=utf-8",
+    ".list": "text/plain; charset=utf-8",
+    ".txt": "text/plain; charset=utf-8",
+    ".yaml": "text/yaml; charset=utf-8",
+    ".json": "application/json",
+}
+
+_REASONS = {
+    200: "OK",
+    206: "Partial Content",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    416: "Range Not Satisfiable",
+}
+
+
+class _BadRequest(Exception):
+    pass
+
+
+def _digest_fd(fd: int, size: int) -> str:
+    # same digest as pipeline.cache.digest_file, read with pread so the file
+    # position stays free for sendfile
+    h = hashlib.blake2b(digest_size=16)
+    pos = 0
+    while pos < size:
+        chunk = os.pread(fd, min(_HASH_CHUNK, size - pos), pos)
+        if not chunk:
+            break
+        h.update(chunk)
+        pos += len(chunk)
+    return h.hexdigest()
+
+
+def parse_range(value: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    (first, last) byte of a single-range "bytes=" header; None when the header
+    should be ignored (another unit, several ranges, malformed). Raises
+    ValueError when the range lies outside the file.
+    """
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first_s, dash, last_s = (x.strip() for x in spec.partition("-"))
+    if not dash or not (first_s or last_s) or any(x and not x.isdigit() for x in (first_s, last_s)):
+        return None
+    if not first_s:
+        # suffix range: the last N bytes
+        if int(last_s) == 0 or size == 0:
+            raise ValueError(value)
+        return max(0, size - int(last_s)), size - 1
+    first = int(first_s)
+    last = int(last_s) if last_s else size - 1
+    if first >= size:
+        raise ValueError(value)
+    if last < first:
+        return None
+    return first, min(last, size - 1)
+
+
+def _accepted(header: str) -> Set[str]:
+    """Content codings of an Accept-Encoding header with a non-zero q ("*" included)."""
+    out: Set[str] = set()
+    for part in header.split(","):
+        token, _, params = part.partition(";")
+        token = token.strip().lower()
+        q = 1.0
+        for p in params.split(";"):
+            name, _, v = p.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        if token and q > 0:
+            out.add(token)
+    return out
+
+
+def _etag_matches(header: str, digest: str) -> bool:
+    # weak comparison (RFC 9110 13.1.2): any representation of this content
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        tag = tag.strip('"')
+        if tag == digest or tag.startswith(digest + "-"):
+            return True
+    return False
+
+
+class ArtifactServer:
+    def __init__(self, mounts: Dict[str, Path], cache_dir: Path, fill: bool = True):
+        """
+        `mounts`: first URL path segment -> directory. Digests come from the
+        build cache manifest in `cache_dir` when it knows the file as it is on
+        disk, otherwise the server hashes the file once per (size, mtime).
+        `fill`: compress files that have no variant yet, in the background.
+        """
+        self.mounts = mounts
+        self.store = cache_dir / "compressed"
+        self.manifest_path = cache_dir / "manifest.json"
+        self.fill = fill
+        self._digests: Dict[str, Tuple[int, int, str]] = {}
+        self._manifest_sig: Optional[Tuple[int, int]] = None
+        self._pending: Set[str] = set()
+        self._compressor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="precompress")
+        self.requests = 0
+
+    # ---- digests ----
+
+    def _load_manifest(self) -> None:
+        try:
+            st = self.manifest_path.stat()
+        except OSError:
+            return
+        if (st.st_size, st.st_mtime_ns) == self._manifest_sig:
+            return
+        self._manifest_sig = (st.st_size, st.st_mtime_ns)
+        try:
+            manifest = json.loads(self.manifest_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return
+        for key, rec in manifest.get("files", {}).items():
+            self._digests[key] = (rec["size"], rec["mtime_ns"], rec["digest"])
+        dist = self.mounts.get("dist")
+        if dist is not None:
+            for ent in manifest.get("targets", {}).values():
+                for fname, rec in ent.get("outputs", {}).items():
+                    self._digests[str(dist / fname)] = (rec["size"], rec["mtime_ns"], rec["digest"])
+
+    async def digest(self, path: Path, fh: BinaryIO, st: os.stat_result) -> str:
+        key = str(path)
+        for attempt in range(2):
+            known = self._digests.get(key)
+            if known is not None and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+                return known[2]
+            if attempt == 0:
+                self._load_manifest()
+        d = await asyncio.get_running_loop().run_in_executor(None, _digest_fd, fh.fileno(), st.st_size)
+        self._digests[key] = (st.st_size, st.st_mtime_ns, d)
+        return d
+
+    # ---- requests ----
+
+    def resolve(self, target: str) -> Optional[Path]:
+        path = unquote(target.split("?", 1)[0])
+        if not path.startswith("/"):
+            return None
+        parts = path[1:].split("/")
+        root = self.mounts.get(parts[0])
+        if root is None or len(parts) < 2:
+            return None
+        for p in parts[1:]:
+            if not p or p.startswith(".") or "\\" in p or "\0" in p:
+                return None
+        return root.joinpath(*parts[1:])
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(_read_request(reader), _KEEPALIVE)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except (_BadRequest, asyncio.LimitOverrunError, ValueError):
+                    _send_head(writer, 400, {"Connection": "close", "Content-Length": "0"})
+                    break
+                if request is None:
+                    break
+                self.requests += 1
+                method, target, version, headers = request
+                conn = headers.get("connection", "").lower()
+                keep = "close" not in conn if version == "HTTP/1.1" else "keep-alive" in conn
+                await self.respond(writer, method, target, headers, keep)
+                await writer.drain()
+                if not keep:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def respond(self, writer: asyncio.StreamWriter, method: str, target: str, headers: Dict[str, str], keep: bool) -> None:
+        base = {"Connection": "keep-alive" if keep else "close"}
+        if method not in ("GET", "HEAD"):
+            _send_head(writer, 405, dict(base, Allow="GET, HEAD", **{"Content-Length": "0"}))
+            return
+        path = self.resolve(target)
+        fh = None
+        if path is not None:
+            try:
+                fh = open(path, "rb")
+            except OSError:
+                fh = None
+        if fh is None:
+            _send_head(writer, 404, dict(base, **{"Content-Length": "0"}))
+            return
+        with fh:
+            st = os.fstat(fh.fileno())
+            if not stat.S_ISREG(st.st_mode):
+                _send_head(writer, 404, dict(base, **{"Content-Length": "0"}))
+                return
+            digest = await self.digest(path, fh, st)
+            await self._send_file(writer, method, path, fh, st, digest, headers, base)
+
+    async def _send_file(
+        self,
+        writer: asyncio.StreamWriter,
+        method: str,
+        path: Path,
+        fh: BinaryIO,
+        st: os.stat_result,
+        digest: str,
+        headers: Dict[str, str],
+        base: Dict[str, str],
+    ) -> None:
+        h = dict(base)
+        h["Last-Modified"] = formatdate(st.st_mtime, usegmt=True)
+        h["Cache-Control"] = "no-cache"
+        h["Vary"] = "Accept-Encoding"
+        h["Accept-Ranges"] = "bytes"
+
+        inm = headers.get("if-none-match")
+        if inm is not None:
+            fresh = _etag_matches(inm, digest)
+        else:
+            fresh = _not_modified_since(headers.get("if-modified-since"), st.st_mtime)
+        rng = headers.get("range")
+
+        body, size, enc = fh, st.st_size, None
+        if rng is None and st.st_size >= MIN_SIZE:
+            accepted = _accepted(headers.get("accept-encoding", ""))
+            for token, suffix in ENCODINGS:
+                if token not in accepted and "*" not in accepted:
+                    continue
+                vp = variant_path(self.store, digest, suffix)
+                try:
+                    body = open(vp, "rb")
+                except OSError:
+                    self._schedule(path, digest)
+                    continue
+                size, enc = os.fstat(body.fileno()).st_size, token
+                break
+        h["ETag"] = f'"{digest}-{enc}"' if enc else f'"{digest}"'
+        try:
+            if fresh:
+                _send_head(writer, 304, h)
+                return
+            if enc:
+                h["Content-Encoding"] = enc
+            h["Content-Type"] = _TYPES.get(path.suffix, "application/octet-stream")
+
+            first, count, status = 0, size, 200
+            if rng is not None and _if_range_holds(headers.get("if-range"), h["ETag"], h["Last-Modified"]):
+                try:
+                    span = parse_range(rng, size)
+                except ValueError:
+                    _send_head(writer, 416, dict(base, **{"Content-Range": f"bytes */{size}", "Content-Length": "0"}))
+                    return
+                if span is not None:
+                    first, count, status = span[0], span[1] - span[0] + 1, 206
+                    h["Content-Range"] = f"bytes {span[0]}-{span[1]}/{size}"
+            h["Content-Length"] = str(count)
+            _send_head(writer, status, h)
+            if method == "HEAD" or not count:
+                return
+            await writer.drain()
+            await asyncio.get_running_loop().sendfile(writer.transport, body, first, count)
+        finally:
+            if body is not fh:
+                body.close()
+
+    def _schedule(self, path: Path, digest: str) -> None:
+        if not self.fill or digest in self._pending:
+            return
+        self._pending.add(digest)
+        # a file that does not compress stays in _pending, so it is tried once
+        self._compressor.submit(precompress, (str(path), digest, str(self.store)))
+
+
+async def _read_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, str, Dict[str, str]]]:
+    line = await reader.readline()
+    if not line:
+        return None
+    if len(line) > _MAX_LINE or not line.endswith(b"\n"):
+        raise _BadRequest()
+    parts = line.decode("latin-1").split()
+    if len(parts) != 3 or not parts[2].startswith("HTTP/1."):
+        raise _BadRequest()
+    headers: Dict[str, str] = {}
+    for _ in range(_MAX_HEADERS + 1):
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n"):
+            return parts[0], parts[1], parts[2], headers
+        if not line.endswith(b"\n") or len(line) > _MAX_LINE:
+            raise _BadRequest()
+        name, colon, value = line.decode("latin-1").partition(":")
+        if not colon:
+            raise _BadRequest()
+        name = name.strip().lower()
+        value = value.strip()
+        headers[name] = f"{headers[name]}, {value}" if name in headers else value
+    raise _BadRequest()
+
+
+def _send_head(writer: asyncio.StreamWriter, status: int, headers: Dict[str, str]) -> None:
+    lines: List[str] = [f"HTTP/1.1 {status} {_REASONS[status]}", f"Date: {formatdate(usegmt=True)}", "Server: rulelist"]
+    lines += [f"{k}: {v}" for k, v in headers.items()]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+
+def _not_modified_since(value: Optional[str], mtime: float) -> bool:
+    if not value:
+        return False
+    try:
+        return int(mtime) <= parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+def _if_range_holds(value: Optional[str], etag: str, last_modified: str) -> bool:
+    # If-Range needs a strong match, of the ETag or of the exact date
+    return value is None or value.strip() in (etag, last_modified)
+
+
+async def serve(host: str, port: int, mounts: Dict[str, Path], cache_dir: Path, fill: bool = True) -> None:
+    server = ArtifactServer(mounts, cache_dir, fill)
+    srv = await asyncio.start_server(server.handle, host, port, limit=_MAX_LINE * 2, backlog=4096)
+    where = ", ".join(f"http://{s.getsockname()[0]}:{s.getsockname()[1]}" for s in srv.sockets)
+    print(f"[serve] {' and '.join(f'{name}/' for name in mounts)} on {where} (Ctrl-C to stop)", flush=True)
+    t0 = time.monotonic()
+    try:
+        async with srv:
+            await srv.serve_forever()
+    finally:
+        server._compressor.shutdown(wait=False, cancel_futures=True)
+        print(f"[serve] {server.requests} requests in {time.monotonic() - t0:.0f}s", flush=True)
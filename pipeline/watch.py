@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import time
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional, Set, Tuple
+
+from dsl.ast import Atom, Logical, Rule
+from dsl.parser import iter_rules
+from pipeline.cache import digest_bytes
+
+
+# Building blocks of `build.py --watch`:
+#   Poller        detects changed files by polling (size, mtime_ns); no
+#                 platform notifier, so it behaves the same everywhere
+#   ResidentFile  one rules file kept parsed in memory; after an edit only the
+#                 lines between the unchanged head and tail are parsed again, and
+#                 the rules of the tail are renumbered
+
+Signature = Optional[Tuple[int, int]]
+
+
+def _signature(path: Path) -> Signature:
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+class Poller:
+    def __init__(self, paths: Iterable[Path]):
+        self.paths = list(paths)
+        self._sigs = {p: _signature(p) for p in self.paths}
+
+    def changed(self) -> Set[Path]:
+        out: Set[Path] = set()
+        for p in self.paths:
+            sig = _signature(p)
+            if sig != self._sigs[p]:
+                self._sigs[p] = sig
+                out.add(p)
+        return out
+
+    def wait(self, interval: float, debounce: float) -> Set[Path]:
+        """
+        Block until a file changes, then until nothing has changed for `debounce`
+        seconds (editors and generators often write in several steps); returns
+        every path that changed meanwhile.
+        """
+        changed: Set[Path] = set()
+        while not changed:
+            time.sleep(interval)
+            changed = self.changed()
+        quiet_since = time.monotonic()
+        while time.monotonic() - quiet_since < debounce:
+            time.sleep(min(interval, debounce))
+            more = self.changed()
+            if more:
+                changed |= more
+                quiet_since = time.monotonic()
+        return changed
+
+
+def _renumber(r: Rule, lineno: int) -> Rule:
+    if isinstance(r, Logical):
+        return Logical(r.op, r.items, lineno)
+    return Atom(r.rtype, r.value, r.options, lineno)
+
+
+class ResidentFile:
+    def __init__(self, path: Path, cached: Optional[Callable[[str], Optional[List[Rule]]]] = None):
+        """`cached(digest)`: the parsed rules of that content if known (a build cache snapshot)."""
+        self.path = path
+        self.lines, self.digest = self._read()
+        rules = cached(self.digest) if cached is not None else None
+        if rules is None:
+            rules = [r for _, r in iter_rules(self.lines)]
+        self.rules: List[Rule] = rules
+
+    def _read(self) -> Tuple[List[str], str]:
+        """Lines of the file and the content digest of exactly those lines (as BuildCache computes it)."""
+        try:
+            data = self.path.read_bytes()
+        except FileNotFoundError:
+            data = b""
+        # split on "\n" only, as iter_file_rules does (a stray \r is stripped with the line)
+        lines = data.decode("utf-8").split("\n")
+        if lines[-1] == "":
+            lines.pop()
+        return lines, digest_bytes(data)
+
+    def update(self) -> bool:
+        """Re-read the file; returns False when its lines did not change. Raises RuleSyntaxError and keeps the old state on a bad line."""
+        new, digest = self._read()
+        old = self.lines
+        if new == old:
+            self.digest = digest
+            return False
+        head = 0
+        limit = min(len(old), len(new))
+        while head < limit and old[head] == new[head]:
+            head += 1
+        tail = 0
+        while tail < limit - head and old[-1 - tail] == new[-1 - tail]:
+            tail += 1
+
+        # lines head+1 .. len-tail (1-based) changed; rules before and after are kept
+        middle = [r for _, r in iter_rules(new[head:len(new) - tail], first_lineno=head + 1)]
+        linenos = [r.lineno for r in self.rules]
+        lo = bisect_right(linenos, head)
+        hi = bisect_left(linenos, len(old) - tail + 1)
+        shift = len(new) - len(old)
+        after = self.rules[hi:]
+        if shift:
+            after = [_renumber(r, r.lineno + shift) for r in after]
+        self.rules = self.rules[:lo] + middle + after
+        self.lines = new
+        self.digest = digest
+        return True
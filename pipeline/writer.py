@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import subprocess
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from pipeline.cache import digest_file
+
+
+# Every dist artifact goes through AtomicWriter: the compiler streams chunks into
+# a temp file in the destination directory, and commit() renames it over the
+# target in one step. Readers (clients polling raw URLs, a local server) only ever
+# see the previous or the new complete file. If the new bytes equal what is
+# already there the temp file is dropped and the old file (and its mtime) stays.
+
+_BUFSIZE = 1 << 20
+_TEXT_BATCH = 1 << 16
+
+# wall and CPU seconds this process spent encoding, hashing, writing and
+# committing artifacts; build.py reports it as each target's write stage
+_io_time = [0.0, 0.0]
+
+
+def io_time() -> Tuple[float, float]:
+    return _io_time[0], _io_time[1]
+
+
+class _IOClock:
+    __slots__ = ("wall", "cpu")
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+
+    def __exit__(self, *exc):
+        _io_time[0] += time.perf_counter() - self.wall
+        _io_time[1] += time.process_time() - self.cpu
+
+
+
+class AtomicWriter:
+    def __init__(self, path: Path, encoding: str = "utf-8"):
+        self.path = Path(path)
+        self.encoding = encoding
+        self._tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        self._fh = open(self._tmp, "wb", buffering=_BUFSIZE)
+        self._hash = hashlib.blake2b(digest_size=16)
+        self._size = 0
+        self._pending: List[str] = []
+        self._pending_len = 0
+        self.record: Optional[Dict[str, object]] = None
+
+    def write(self, s: str) -> int:
+        # compilers write line-sized chunks; encode and hash them in batches
+        self._pending.append(s)
+        self._pending_len += len(s)
+        if self._pending_len >= _TEXT_BATCH:
+            self._flush_pending()
+        return len(s)
+
+    def _flush_pending(self) -> None:
+        if self._pending:
+            with _IOClock():
+                data = "".join(self._pending).encode(self.encoding)
+            self._pending = []
+            self._pending_len = 0
+            self._write(data)
+
+    def write_bytes(self, data: bytes) -> None:
+        self._flush_pending()
+        self._write(data)
+
+    def _write(self, data: bytes) -> None:
+        with _IOClock():
+            self._fh.write(data)
+            self._hash.update(data)
+        self._size += len(data)
+
+    def commit(self) -> Dict[str, object]:
+        """Finish the file; returns {"size", "mtime_ns", "digest"} of what is now on disk."""
+        self._flush_pending()
+        with _IOClock():
+            return self._commit()
+
+    def _commit(self) -> Dict[str, object]:
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._fh.close()
+        digest = self._hash.hexdigest()
+        try:
+            st = self.path.stat()
+            same = st.st_size == self._size and digest_file(self.path) == digest
+        except OSError:
+            same = False
+        if same:
+            os.unlink(self._tmp)
+        else:
+            os.replace(self._tmp, self.path)
+        st = self.path.stat()
+        self.record = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "digest": digest}
+        return self.record
+
+    def abort(self) -> None:
+        if not self._fh.closed:
+            self._fh.close()
+        try:
+            os.unlink(self._tmp)
+        except OSError:
+            pass
+
+    def __enter__(self) -> "AtomicWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+def write_text_atomic(path: Path, text: str) -> Dict[str, object]:
+    with AtomicWriter(path) as w:
+        w.write(text)
+    return w.record
+
+
+def copy_atomic(src: Path, dst: Path) -> Dict[str, object]:
+    """Atomically replace `dst` with a copy of `src` (skipped when already identical)."""
+    w = AtomicWriter(dst)
+    try:
+        with open(src, "rb") as fh:
+            while True:
+                chunk = fh.read(_BUFSIZE)
+                if not chunk:
+                    break
+                w.write_bytes(chunk)
+    except BaseException:
+        w.abort()
+        raise
+    return w.commit()
+
+
+def run_tool_atomic(argv: List[str], dst: Path) -> Dict[str, object]:
+    """
+    Run an external compiler whose output path is the "{out}" argument of
+    `argv`, then atomically replace `dst` with what it wrote.
+    """
+    tmp = dst.with_name(f".{dst.name}.{os.getpid()}.tool")
+    try:
+        subprocess.run([a.replace("{out}", str(tmp)) for a in argv], check=True, capture_output=True)
+        return copy_atomic(tmp, dst)
+    finally:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass